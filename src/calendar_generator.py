@@ -1,22 +1,77 @@
+import hashlib
 import json
 import logging
+import random
+import re
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
 import pytz
 from dateutil.rrule import rrulestr
-from google.api_core.client_options import ClientOptions
-from google.cloud import documentai_v1beta3 as documentai
-from google.oauth2 import service_account
-from groq import Groq
+from groq import APIConnectionError, APIStatusError, Groq, InternalServerError, RateLimitError
 from ics.grammar.parse import ContentLine
 
 from ics import Calendar, Event
-from utils import get_next_valid_date, setup_logging, get_geolocation
+from ocr_backends import OCRPreprocessor, create_backend, get_mime_type
+from utils import TokenBucket, content_digest, get_next_valid_date, get_geolocation
 
 logger = logging.getLogger(__name__)
 
+# Campos que puede tener cada evento extraído y su tipo
+EVENT_FIELDS = {
+    "SUMMARY": str,
+    "DTSTART": str,
+    "DTEND": str,
+    "LOCATION": str,
+    "RRULE": str,
+    "ALL_DAY": bool,
+}
+# Formatos de fecha que entiende EntityExtractor.process_event_date
+EVENT_DATE_PATTERN = re.compile(
+    r"^(?:\d{4}-\d{2}-\d{2}(?:T\d{2}:\d{2}(?::\d{2})?)?"
+    r"|\d{1,2}-\d{1,2}(?:T\d{2}:\d{2}:\d{2})?"
+    r"|\d{1,2}:\d{2}"
+    r"|\d{1,2}[-\s]\d{1,2}:\d{2})$"
+)
+# Formatos de EVENT_DATE_PATTERN que traen día y mes, y no solo la hora
+EVENT_DAY_MONTH_PATTERN = re.compile(r"^(?:\d{4}-)?\d{1,2}-\d{1,2}(?:T|$)")
+
+
+# Partes del prompt de extracción, compartidas por el prompt de un cartel
+# (get_improved_prompt) y el de varios a la vez (get_batch_prompt)
+EXTRACTION_RULES = """1. Para fechas y horas, usa estos formatos:
+   - Si se menciona un año específico: YYYY-MM-DDTHH:MM:SS
+   - Si no se menciona año: MM-DD
+   - Si solo hay hora: HH:MM
+2. Todas las fechas y horas deben estar en la zona horaria de España (Europe/Madrid).
+3. Para eventos recurrentes, proporciona una regla RRULE adecuada.
+4. NO inventes ni infieras fechas que no estén explícitamente mencionadas en el texto.
+5. NO incluyas el campo DTEND si no se menciona explícitamente una hora o fecha de finalización.
+6. No inventes un año que no exista literalmente en el texto. 
+7. Si en el texto no se lee claramente un año (por ejemplo, '2024', '2025', etc.), no asumas uno. 
+8. Devuelve siempre MM-DD u HH:MM si el año no se menciona explícitamente."""
+
+EVENT_SCHEMA = """    {
+    "SUMMARY": "Título del evento",
+    "DTSTART": formatos según el caso:
+        - Con año: "YYYY-MM-DDTHH:MM:SS"
+        - Sin año: "MM-DD"
+        - Solo hora: "HH:MM",
+    "DTEND": mismo formato que DTSTART (omitir si no se especifica),
+    "LOCATION": "Ubicación del evento",
+    "RRULE": "Regla de recurrencia en formato ICS estándar",
+    "ALL_DAY": true/false
+    }"""
+
+RRULE_RULES = """Reglas para RRULE:
+- Para eventos de un solo día: deja el campo vacío.
+- Para eventos recurrentes: proporciona la regla completa (ej: "FREQ=WEEKLY;BYDAY=WE")
+- NO incluyas fechas específicas en la RRULE a menos que estén explícitamente mencionadas en el texto."""
+
 
 class OCRReader:
     SUPPORTED_FORMATS = [
@@ -30,89 +85,153 @@ class OCRReader:
         ".gif",
     ]
 
-    def __init__(self, service: str, google_config: Optional[Dict[str, str]] = None):
+    def __init__(self, service: str, google_config: Optional[Dict[str, str]] = None,
+                 db_manager=None, client=None, ocr_config: Optional[Dict] = None):
         self.service = service
-        if service == "documentai":
-            if not google_config:
-                raise ValueError("Google Document AI configuration is missing.")
-            self.project_id = google_config["project_id"]
-            self.location = google_config["location"]
-            self.processor_id = google_config["processor_id"]
-            self.credentials = service_account.Credentials.from_service_account_file(
-                google_config["credentials_path"]
-            )
-            self.client_options = ClientOptions(
-                api_endpoint=f"{self.location}-documentai.googleapis.com"
-            )
-        else:
-            raise ValueError(
-                "Invalid OCR service. Only 'documentai' is supported."
-            )
-
-    def read(self, image_path: Path) -> Optional[str]:
-        if image_path.suffix.lower() not in OCRReader.SUPPORTED_FORMATS:
+        # Caché de resultados por contenido de la imagen (si hay db_manager)
+        self.db_manager = db_manager
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.bytes_saved = 0
+        # Motor de OCR según el registro de ocr_backends (documentai,
+        # tesseract, easyocr, hybrid); client sustituye al de Document AI
+        self.backend = create_backend(service, ocr_config, google_config, client)
+        # Reducción opcional de la imagen antes de enviarla (ocr.preprocess)
+        self.preprocessor = OCRPreprocessor((ocr_config or {}).get("preprocess"))
+        self.processor_key = self.backend.cache_key
+        if self.preprocessor.enabled:
+            self.processor_key += f"|{self.preprocessor.cache_key}"
+        self.max_workers = self.backend.max_workers
+
+    def get_client(self):
+        """Cliente de Document AI del motor (documentai o hybrid); None con motores solo locales."""
+        backend = getattr(self.backend, "remote", self.backend)
+        if not hasattr(backend, "get_client"):
             return None
+        return backend.get_client()
 
-        try:
-            if self.service == "documentai":
-                docai_client = documentai.DocumentProcessorServiceClient(
-                    client_options=self.client_options, credentials=self.credentials
-                )
-                resource_name = docai_client.processor_path(
-                    self.project_id, self.location, self.processor_id
-                )
+    def read(self, image_path: Path, content: Optional[bytes] = None) -> Optional[str]:
+        """
+        Extrae el texto de la imagen. Si ya se tienen sus bytes en memoria
+        se pasan en content y no se vuelve a leer el archivo.
+        """
+        return self.read_many([(image_path, content)])[0]
 
-                with open(image_path, "rb") as image:
-                    image_content = image.read()
+    def read_many(self, images, max_workers: Optional[int] = None):
+        """
+        Extrae el texto de varias imágenes, dadas como lista de
+        (ruta, bytes o None), en un solo lote del motor de OCR (con hasta
+        max_workers peticiones a la vez en Document AI). Devuelve los textos
+        en el mismo orden (None si una falla).
 
-                raw_document = documentai.RawDocument(
-                    content=image_content, mime_type=self.get_mime_type(image_path)
-                )
-                request = documentai.ProcessRequest(
-                    name=resource_name, raw_document=raw_document
-                )
-                result = docai_client.process_document(request=request)
+        La caché se consulta y se actualiza desde el hilo que llama, porque
+        la conexión SQLite no se puede compartir entre hilos.
+        """
+        results = [None] * len(images)
+        pending = []
+        for index, (image_path, content) in enumerate(images):
+            if image_path.suffix.lower() not in OCRReader.SUPPORTED_FORMATS:
+                continue
+            try:
+                if content is not None:
+                    image_content = content
+                else:
+                    with open(image_path, "rb") as image:
+                        image_content = image.read()
+
+                digest = content_digest(image_content)
+                cached_text = self.get_cached_text(digest)
+                if cached_text is not None:
+                    self.cache_hits += 1
+                    self.bytes_saved += len(image_content)
+                    logger.info(f"OCR cache hit for {image_path.name}")
+                    results[index] = cached_text
+                    continue
+                self.cache_misses += 1
+                pending.append((index, image_path, image_content, digest))
+            except Exception as e:
+                logger.exception("Error during text extraction: %s", e)
 
-                document_object = result.document
-                combined_text = document_object.text
-                
-            logger.info(f"Raw extracted document: {combined_text}")
-            return combined_text
-        except Exception as e:
-            logger.exception("Error during text extraction: %s", e)
+        if not pending:
+            return results
+
+        batch_results = self.backend.read_batch(
+            [self.preprocessor.process(image_path, image_content)
+             for _, image_path, image_content, _ in pending],
+            max_workers
+        )
+        for (index, _, _, digest), result in zip(pending, batch_results):
+            if result is None:
+                continue
+            results[index] = result[0]
+            self.cache_text(digest, result[0])
+        return results
+
+    def get_cached_text(self, digest: str) -> Optional[str]:
+        if self.db_manager is None:
             return None
+        return self.db_manager.get_ocr_text(digest, self.processor_key)
+
+    def cache_text(self, digest: str, text: str):
+        if self.db_manager is not None and text is not None:
+            self.db_manager.add_ocr_text(digest, self.processor_key, text)
+
+    def cache_stats(self) -> Dict[str, float]:
+        """Aciertos, fallos y bytes que no se enviaron al OCR gracias a la caché."""
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "hit_rate": self.cache_hits / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+        }
+
+    def preprocess_stats(self) -> Dict[str, float]:
+        """Bytes de las imágenes antes y después del preprocesado."""
+        return self.preprocessor.stats()
 
     def get_mime_type(self, image_path: Path) -> str:
-        suffix = image_path.suffix.lower()
-        if suffix in [".jpg", ".jpeg"]:
-            return "image/jpeg"
-        elif suffix == ".png":
-            return "image/png"
-        elif suffix == ".bmp":
-            return "image/bmp"
-        elif suffix in [".tiff", ".tif"]:
-            return "image/tiff"
-        elif suffix == ".gif":
-            return "image/gif"
-        elif suffix == ".pdf":
-            return "application/pdf"
-        else:
-            raise ValueError(f"Unsupported file extension: {suffix}")
+        return get_mime_type(image_path)
 
 
 class EntityExtractor:
-    def __init__(self, config):
+    # Versión de get_improved_prompt y del esquema de eventos: forma parte de
+    # la clave de la caché de respuestas, así que hay que subirla al cambiarlos
+    PROMPT_VERSION = 2
+
+    def __init__(self, config, db_manager=None):
         self.config = config
-        self.max_retries = 3
+        external_api = config.get("external_api", {})
+        self.max_retries = external_api.get("max_retries", 3)
         self.client = None
+        # Caché de las respuestas del modelo por texto normalizado (si hay db_manager)
+        self.db_manager = db_manager
+        self.cache_ttl = external_api.get("cache_ttl_days", 30) * 86400
+        self.cache_max_entries = external_api.get("cache_max_entries", 5000)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Pedir a la API una respuesta que sea siempre JSON (response_format)
+        self.json_mode = config.get("external_api", {}).get("json_mode", True)
+        # Varios carteles por petición (extract_many), hasta batch_token_budget tokens de texto
+        self.batch_extraction = external_api.get("batch_extraction", False)
+        self.batch_token_budget = external_api.get("batch_token_budget", 2000)
+        # Peticiones simultáneas de extract_many y límites por minuto del
+        # proveedor, compartidos por todas las peticiones de este extractor
+        self.max_workers = external_api.get("max_concurrent_requests", 4)
+        requests_per_minute = external_api.get("requests_per_minute", 30)
+        tokens_per_minute = external_api.get("tokens_per_minute", 6000)
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_backoff = external_api.get("max_backoff_seconds", 60)
 
         # Verificar si se debe usar la API externa
         if config.get("external_api", {}).get("use"):
             if config["external_api"]["service"] == "groq":
                 try:
                     api_key = config["external_api"]["api_key"]
-                    # Inicializar el cliente Groq con solo la api_key
-                    self.client = Groq(api_key=api_key)
+                    # Sin reintentos propios del cliente: los hace request_completion
+                    # respetando los límites de ritmo
+                    self.client = Groq(api_key=api_key, max_retries=0)
                 except Exception as e:
                     logger.error(f"Error initializing Groq client: {str(e)}")
                     self.client = None
@@ -232,37 +351,14 @@ class EntityExtractor:
     def get_improved_prompt(self, text: str) -> str:
         return f"""Analiza el siguiente texto y extrae la información del evento principal en un formato JSON estructurado. Sigue estas reglas estrictamente:
 
-1. Para fechas y horas, usa estos formatos:
-   - Si se menciona un año específico: YYYY-MM-DDTHH:MM:SS
-   - Si no se menciona año: MM-DD
-   - Si solo hay hora: HH:MM
-2. Todas las fechas y horas deben estar en la zona horaria de España (Europe/Madrid).
-3. Para eventos recurrentes, proporciona una regla RRULE adecuada.
-4. NO inventes ni infieras fechas que no estén explícitamente mencionadas en el texto.
-5. NO incluyas el campo DTEND si no se menciona explícitamente una hora o fecha de finalización.
-6. No inventes un año que no exista literalmente en el texto. 
-7. Si en el texto no se lee claramente un año (por ejemplo, '2024', '2025', etc.), no asumas uno. 
-8. Devuelve siempre MM-DD u HH:MM si el año no se menciona explícitamente.
+{EXTRACTION_RULES}
 
-Estructura JSON requerida:
-[
-    {{
-    "SUMMARY": "Título del evento",
-    "DTSTART": formatos según el caso:
-        - Con año: "YYYY-MM-DDTHH:MM:SS"
-        - Sin año: "MM-DD"
-        - Solo hora: "HH:MM",
-    "DTEND": mismo formato que DTSTART (omitir si no se especifica),
-    "LOCATION": "Ubicación del evento",
-    "RRULE": "Regla de recurrencia en formato ICS estándar",
-    "ALL_DAY": true/false
-    }}
-]
+Estructura JSON requerida (un objeto con la lista de eventos en "events"):
+{{"events": [
+{EVENT_SCHEMA}
+]}}
 
-Reglas para RRULE:
-- Para eventos de un solo día: deja el campo vacío.
-- Para eventos recurrentes: proporciona la regla completa (ej: "FREQ=WEEKLY;BYDAY=WE")
-- NO incluyas fechas específicas en la RRULE a menos que estén explícitamente mencionadas en el texto.
+{RRULE_RULES}
 
 Texto a analizar:
 
@@ -270,23 +366,193 @@ Texto a analizar:
 
 Proporciona solo la respuesta en formato JSON, sin explicaciones adicionales. Si algún campo no tiene información específica, omítelo del JSON."""
 
-    def validate_and_fix_json(self, json_data: str) -> dict:
+    def cache_key(self, text: str) -> str:
+        """Hash del texto normalizado (Unicode y espacios), el modelo y la versión del prompt."""
+        normalized = " ".join(unicodedata.normalize("NFKC", text).split())
+        model = self.config["external_api"]["model_name"]
+        key = f"{self.PROMPT_VERSION}\0{model}\0{normalized}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get_cached_events(self, cache_key: str) -> Optional[List[dict]]:
+        if self.db_manager is None:
+            return None
+        response = self.db_manager.get_llm_response(cache_key, self.cache_ttl)
+        if response is None:
+            self.cache_misses += 1
+            return None
+        self.cache_hits += 1
+        return json.loads(response)
+
+    def cache_events(self, cache_key: str, event_data_list: List[dict]):
+        # Solo respuestas con eventos: las vacías pueden ser un fallo puntual
+        if self.db_manager is None or not event_data_list:
+            return
+        self.db_manager.add_llm_response(
+            cache_key, self.config["external_api"]["model_name"],
+            json.dumps(event_data_list, ensure_ascii=False),
+            self.cache_ttl, self.cache_max_entries
+        )
+
+    def cache_stats(self) -> Dict[str, float]:
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "hit_rate": self.cache_hits / lookups if lookups else 0.0,
+        }
+
+    def request_completion(self, prompt: str) -> str:
         """
-        Llama a la API de Groq para validar y corregir el JSON, 
-        o devuelve el JSON parseado si no hay cliente o hay algún error.
+        Una llamada a la API; en json_mode la respuesta es siempre un objeto
+        JSON. Espera a que los límites por minuto lo permitan y, ante un 429,
+        un 5xx o un fallo de conexión, reintenta con espera exponencial (o la
+        que indique Retry-After) hasta max_retries veces.
         """
+        options = {"response_format": {"type": "json_object"}} if self.json_mode else {}
+        prompt_tokens = self.estimate_tokens(prompt)
+        attempt = 0
+        while True:
+            if self.request_bucket:
+                self.request_bucket.acquire()
+            if self.token_bucket:
+                self.token_bucket.acquire(prompt_tokens)
+            try:
+                chat_completion = self.client.chat.completions.create(
+                    messages=[{"role": "user", "content": prompt}],
+                    model=self.config["external_api"]["model_name"],
+                    **options,
+                )
+                break
+            except (RateLimitError, InternalServerError, APIConnectionError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.retry_delay(attempt, e)
+                logger.warning(f"Error transitorio de la API ({e}); reintento en {delay:.1f} s")
+                time.sleep(delay)
+                attempt += 1
+
+        logger.info(f"Respuesta recibida de la API de Groq: {chat_completion}")
+        # Cobrar en el cubo los tokens reales (prompt y respuesta) frente a la estimación
+        usage = getattr(chat_completion, "usage", None)
+        if self.token_bucket and usage and getattr(usage, "total_tokens", None):
+            self.token_bucket.consume(usage.total_tokens - prompt_tokens)
+        return chat_completion.choices[0].message.content
+
+    def retry_delay(self, attempt: int, error: Exception) -> float:
+        """Segundos de Retry-After si la respuesta lo trae; si no, 2^attempt con algo de azar."""
+        if isinstance(error, APIStatusError):
+            retry_after = error.response.headers.get("retry-after")
+            try:
+                if retry_after is not None:
+                    return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return min(2 ** attempt + random.uniform(0, 1), self.max_backoff)
+
+    def parse_events(self, content: str) -> List[dict]:
+        """Lista de eventos de la respuesta: {"events": [...]}, una lista o un solo evento."""
+        data = json.loads(content)
+        if isinstance(data, dict):
+            data = data.get("events", data)
+        if isinstance(data, dict):
+            data = [data]
+        if not isinstance(data, list):
+            raise ValueError(f"Respuesta inesperada: {content}")
+        return data
+
+    def normalize_event(self, event_data: dict) -> dict:
+        """Arreglos locales sin llamar a la API: quita campos vacíos o desconocidos."""
+        event = {}
+        for field, value in event_data.items():
+            if field not in EVENT_FIELDS or value is None:
+                continue
+            if isinstance(value, str):
+                value = value.strip()
+                if not value:
+                    continue
+                if field == "ALL_DAY" and value.lower() in ("true", "false"):
+                    value = value.lower() == "true"
+            event[field] = value
+        return event
+
+    def validate_event(self, event_data) -> List[str]:
+        """Errores del evento frente al esquema de EVENT_FIELDS (lista vacía si es válido)."""
+        if not isinstance(event_data, dict):
+            return ["el evento no es un objeto JSON"]
+
+        errors = []
+        for field, value in event_data.items():
+            if not isinstance(value, EVENT_FIELDS[field]):
+                errors.append(f"{field} debe ser {EVENT_FIELDS[field].__name__}")
+        if not any(event_data.get(field) for field in ("SUMMARY", "DTSTART", "LOCATION")):
+            errors.append("faltan SUMMARY, DTSTART y LOCATION")
+
+        for field in ("DTSTART", "DTEND"):
+            value = event_data.get(field)
+            if not isinstance(value, str):
+                continue
+            if not EVENT_DATE_PATTERN.match(value):
+                errors.append(f"{field} '{value}' no tiene un formato válido")
+            elif len(value.split("-")) == 3:
+                try:
+                    datetime.fromisoformat(value)
+                except ValueError:
+                    errors.append(f"{field} '{value}' no es una fecha válida")
+
+        rrule = event_data.get("RRULE")
+        if isinstance(rrule, str):
+            try:
+                rrulestr(rrule, dtstart=datetime.now())
+            except (ValueError, TypeError):
+                errors.append(f"RRULE '{rrule}' no es una regla ICS válida")
+        return errors
+
+    def validate_and_fix_json(self, event_data_list: list) -> list:
+        """
+        Valida los eventos en local y solo pide a la API que corrija los que
+        no cumplen el esquema. Se descartan los que sigan sin cumplirlo.
+        """
+        valid, invalid = [], []
+        for event_data in event_data_list:
+            if isinstance(event_data, dict):
+                event_data = self.normalize_event(event_data)
+            errors = self.validate_event(event_data)
+            if errors:
+                invalid.append((event_data, errors))
+            else:
+                valid.append(event_data)
+
+        if not invalid:
+            return valid
         if not self.client:
             logger.warning(
-                "El cliente Groq no está inicializado. No se puede validar el JSON."
+                "El cliente Groq no está inicializado. Se descartan los eventos no válidos."
             )
-            return json.loads(json_data)
-
+            return valid
+
+        logger.info(f"Corrigiendo {len(invalid)} eventos no válidos: {invalid}")
+        for event_data in self.repair_events(invalid):
+            if isinstance(event_data, dict):
+                event_data = self.normalize_event(event_data)
+            errors = self.validate_event(event_data)
+            if errors:
+                logger.warning(f"Evento descartado tras la corrección: {event_data} ({errors})")
+            else:
+                valid.append(event_data)
+        return valid
+
+    def repair_events(self, invalid: list) -> list:
+        """Pide a la API que corrija los eventos dados como [(evento, errores)]."""
+        records = "\n".join(
+            f"- {json.dumps(event_data, ensure_ascii=False)}\n  Errores: {'; '.join(errors)}"
+            for event_data, errors in invalid
+        )
         prompt = f"""
-        Valida el siguiente JSON para un evento y corrige cualquier problema:
-        {json_data}
+        Corrige los siguientes eventos en JSON, que no cumplen la estructura esperada:
+        {records}
 
-        Asegúrate de que siga esta estructura:
-        [
+        Asegúrate de que sigan esta estructura:
+        {{"events": [
             {{
                 "SUMMARY": "Título del evento",
                 "DTSTART": formatos válidos:
@@ -298,7 +564,7 @@ Proporciona solo la respuesta en formato JSON, sin explicaciones adicionales. Si
                 "RRULE": "Regla de recurrencia en formato ICS estándar" (opcional),
                 "ALL_DAY": true/false
             }}
-        ]
+        ]}}
 
         Reglas:
         1. Si la fecha viene con año específico, usa formato completo: YYYY-MM-DDTHH:MM:SS
@@ -319,171 +585,332 @@ Proporciona solo la respuesta en formato JSON, sin explicaciones adicionales. Si
         retries = 0
         while retries < self.max_retries:
             try:
-                chat_completion = self.client.chat.completions.create(
-                    messages=[{"role": "user", "content": prompt}],
-                    model=self.config["external_api"]["model_name"],
-                )
-                corrected_json = chat_completion.choices[0].message.content
-                return json.loads(corrected_json)
-            except json.JSONDecodeError as e:
+                return self.parse_events(self.request_completion(prompt))
+            except (json.JSONDecodeError, ValueError) as e:
                 logger.error(f"Error al analizar el JSON corregido: {e}")
                 retries += 1
             except Exception as e:
+                # Los errores transitorios ya se han reintentado en request_completion
                 logger.error(
                     f"Error durante la validación del JSON: {e}", exc_info=True
                 )
-                retries += 1
+                return []
 
         logger.error(
             "No se pudo validar y corregir el JSON después del número máximo de intentos."
         )
-        # Devolver JSON original parseado si fallan todos los intentos
-        return json.loads(json_data)
+        return []
 
-    def extract_event_info(self, text: str, metadata: dict = None):
+    def extract_event_info(self, text: str, metadata: dict = None, check_cache: bool = True):
         """
         Extrae la información del evento del texto proporcionado y agrega metadatos si están disponibles.
         
         Args:
             text (str): El texto del que extraer la información del evento
             metadata (dict, optional): Diccionario con metadatos adicionales (canal, fuente, etc.)
+            check_cache (bool): Consultar la caché de respuestas (extract_many ya lo ha hecho)
         
         Returns:
             list: Lista de diccionarios con la información de los eventos
         """
-        model_type = (
-            self.config["external_api"]["service"]
-            if self.config["external_api"]["use"]
-            else "local_model"
-        )
-        prompt = self.get_improved_prompt(text)
+        if not self.uses_groq():
+            if self.config.get("local_model", {}).get("use"):
+                logger.warning("Local model is not implemented yet.")
+            return []
+
+        # Las fechas se resuelven siempre de nuevo frente a la fecha de
+        # referencia; de la caché solo sale la respuesta ya validada
+        cache_key = self.cache_key(text)
+        event_data_list = self.get_cached_events(cache_key) if check_cache else None
+        if event_data_list is not None:
+            logger.info("Respuesta del modelo tomada de la caché")
+        else:
+            event_data_list = self.request_events(text)
+            if event_data_list is None:
+                return []
+            self.cache_events(cache_key, event_data_list)
+        return self._resolve(event_data_list, metadata)
 
+    def uses_groq(self) -> bool:
+        external_api = self.config["external_api"]
+        return bool(external_api["use"] and external_api["service"] == "groq" and self.client)
+
+    def request_events(self, text: str) -> Optional[List[dict]]:
+        """
+        Pide a la API los eventos de un texto y los valida. Solo hace llamadas
+        a la API (sin caché ni base de datos), así que se puede usar desde
+        otros hilos. Devuelve None si no se consigue una respuesta válida.
+        """
+        prompt = self.get_improved_prompt(text)
         retries = 0
         while retries < self.max_retries:
+            content = None
             try:
-                if model_type == "groq" and self.client:
-                    logger.debug(
-                        f"Enviando solicitud a la API de Groq con el prompt: {prompt}"
-                    )
-                    chat_completion = self.client.chat.completions.create(
-                        messages=[{"role": "user", "content": prompt}],
-                        model=self.config["external_api"]["model_name"],
-                    )
-                    logger.info(
-                        f"Respuesta recibida de la API de Groq: {chat_completion}"
-                    )
-                    content = chat_completion.choices[0].message.content
-                elif model_type == "local_model" and self.config["local_model"]["use"]:
-                    logger.warning("Local model is not implemented yet.")
-                    return []
-
+                logger.debug(
+                    f"Enviando solicitud a la API de Groq con el prompt: {prompt}"
+                )
+                content = self.request_completion(prompt)
                 logger.info(f"Contenido sin procesar: {content}")
-                event_data_list = json.loads(content)
+                event_data_list = self.parse_events(content)
                 logger.info(f"Contenido JSON parseado: {event_data_list}")
 
-                # Validar y corregir JSON
-                validated_event_data_list = self.validate_and_fix_json(json.dumps(event_data_list))
-
-                # If the validated JSON is a single object, convert it to a list
-                if isinstance(validated_event_data_list, dict):
-                    validated_event_data_list = [validated_event_data_list]
-
-                if metadata and metadata.get("telegram_timestamp"):
-                    try:
-                        reference_date = datetime.fromtimestamp(
-                            metadata["telegram_timestamp"], pytz.timezone("Europe/Madrid")
-                        )
-                        logger.info(f"Usando la fecha de publicación del mensaje como referencia: {reference_date}")
-                    except Exception as ex:
-                        logger.warning(f"No se pudo parsear telegram_timestamp ({ex}). Usando fecha del sistema.")
-                        reference_date = datetime.now(pytz.timezone("Europe/Madrid"))
-                else:
-                    reference_date = datetime.now(pytz.timezone("Europe/Madrid"))
-                    logger.info(f"Usando fecha/hora del sistema como referencia: {reference_date}")
-
-                # Process and return all valid events
-                for event_data in validated_event_data_list:
-                    start_str = event_data.get("DTSTART")
-                    if start_str:
-                        start_date_time = self.process_event_date(start_str, reference_date)
-                    else:
-                        logger.warning(
-                            "No se proporcionó fecha/hora de inicio. Usando la fecha/hora actual."
-                        )
-                        start_date_time = reference_date
-
-                    if "RRULE" in event_data:
-                        rrule = event_data["RRULE"].strip()
-                        start_date_time = get_next_valid_date(start_date_time, rrule)
-
-                    event_data["DTSTART"] = start_date_time
-
-                    # Procesar fecha de fin
-                    end_str = event_data.get("DTEND")
-                    if end_str:
-                        end_date_time = self.process_event_date(end_str, reference_date)
-
-                        if end_date_time and end_date_time <= start_date_time:
-                            end_date_time += timedelta(days=1)
-
-                        event_data["DTEND"] = end_date_time
-                    else:
-                        logger.warning(
-                            "No se proporcionó fecha/hora de finalización. El evento no tendrá hora de finalización."
-                        )
-
-                    # Procesar ubicación y geolocalización
-                    if event_data.get("LOCATION"):
-                        logger.info(f"Processing location: {event_data['LOCATION']}")
-                        location_info = get_geolocation(self.config, event_data["LOCATION"])
-                        if location_info:
-                            logger.info(f"Geolocation found: {location_info}")
-                            
-                            # Añadir coordenadas
-                            if 'latitude' in location_info and 'longitude' in location_info:
-                                event_data["place_latitude"] = location_info["latitude"]
-                                event_data["place_longitude"] = location_info["longitude"]
-                            
-                            # Inicializar tags con las categorías base
-                            base_tags = []
-                            if metadata:
-                                base_tags = [
-                                    metadata.get("channel_name", "Canal Desconocido"),
-                                    metadata.get("source", "Fuente Desconocido")
-                                ]
-                            
-                            # Añadir categorías de ubicación a los tags
-                            categories = location_info.get("categories", [])
-                            logger.info(f"Location categories: {categories}")
-                            
-                            event_data["tags"] = base_tags + categories
-                            logger.info(f"Final tags for event: {event_data['tags']}")
-                        else:
-                            logger.warning(f"No geolocation info found for: {event_data['LOCATION']}")
-                            event_data["tags"] = []
-
-                    # Añadir descripción del mensaje de Telegram
-                    if metadata and metadata.get("text"):
-                        event_data["DESCRIPTION"] = metadata["text"]
-
-                logger.info(f"Datos del evento extraídos: {validated_event_data_list}")
-                return validated_event_data_list
-
-            except json.JSONDecodeError as e:
+                # Validar en local; solo los eventos no válidos vuelven a la API
+                return self.validate_and_fix_json(event_data_list)
+            except (json.JSONDecodeError, ValueError) as e:
+                # Respuesta mal formada: se vuelve a pedir
                 logger.error(f"Error al analizar JSON: {e}")
                 logger.debug(f"Contenido sin procesar: {content}")
                 retries += 1
             except Exception as e:
+                # Los errores transitorios ya se han reintentado en request_completion
                 logger.error(
                     f"Error durante la extracción de información del evento: {e}",
                     exc_info=True,
                 )
-                retries += 1
+                return None
 
         logger.error(
             "No se pudo extraer la información completa del evento después del número máximo de intentos."
         )
-        return []
+        return None
+
+    def _resolve(self, event_data_list, metadata):
+        try:
+            return self.resolve_events([dict(event) for event in event_data_list], metadata)
+        except Exception as e:
+            logger.error(f"Error durante la extracción de información del evento: {e}", exc_info=True)
+            return []
+
+    def resolve_events(self, event_data_list: List[dict], metadata: dict = None) -> List[dict]:
+        """
+        Resuelve las fechas frente a la fecha de referencia del mensaje,
+        geolocaliza y añade tags y descripción a los eventos ya validados.
+        """
+        if metadata and metadata.get("telegram_timestamp"):
+            try:
+                reference_date = datetime.fromtimestamp(
+                    metadata["telegram_timestamp"], pytz.timezone("Europe/Madrid")
+                )
+                logger.info(f"Usando la fecha de publicación del mensaje como referencia: {reference_date}")
+            except Exception as ex:
+                logger.warning(f"No se pudo parsear telegram_timestamp ({ex}). Usando fecha del sistema.")
+                reference_date = datetime.now(pytz.timezone("Europe/Madrid"))
+        else:
+            reference_date = datetime.now(pytz.timezone("Europe/Madrid"))
+            logger.info(f"Usando fecha/hora del sistema como referencia: {reference_date}")
+
+        # Process and return all valid events
+        for event_data in event_data_list:
+            start_str = event_data.get("DTSTART")
+            # Lo que dijo el modelo, antes de completarlo con la fecha de referencia
+            event_data["DTSTART_TEXT"] = start_str
+            if start_str:
+                start_date_time = self.process_event_date(start_str, reference_date)
+            else:
+                logger.warning(
+                    "No se proporcionó fecha/hora de inicio. Usando la fecha/hora actual."
+                )
+                start_date_time = reference_date
+
+            if "RRULE" in event_data:
+                rrule = event_data["RRULE"].strip()
+                start_date_time = get_next_valid_date(start_date_time, rrule)
+
+            event_data["DTSTART"] = start_date_time
+
+            # Procesar fecha de fin
+            end_str = event_data.get("DTEND")
+            if end_str:
+                end_date_time = self.process_event_date(end_str, reference_date)
+
+                if end_date_time and end_date_time <= start_date_time:
+                    end_date_time += timedelta(days=1)
+
+                event_data["DTEND"] = end_date_time
+            else:
+                logger.warning(
+                    "No se proporcionó fecha/hora de finalización. El evento no tendrá hora de finalización."
+                )
+
+            # Procesar ubicación y geolocalización
+            if event_data.get("LOCATION"):
+                logger.info(f"Processing location: {event_data['LOCATION']}")
+                location_info = get_geolocation(self.config, event_data["LOCATION"])
+                if location_info:
+                    logger.info(f"Geolocation found: {location_info}")
+
+                    # Añadir coordenadas
+                    if 'latitude' in location_info and 'longitude' in location_info:
+                        event_data["place_latitude"] = location_info["latitude"]
+                        event_data["place_longitude"] = location_info["longitude"]
+
+                    # Inicializar tags con las categorías base
+                    base_tags = []
+                    if metadata:
+                        base_tags = [
+                            metadata.get("channel_name", "Canal Desconocido"),
+                            metadata.get("source", "Fuente Desconocido")
+                        ]
+
+                    # Añadir categorías de ubicación a los tags
+                    categories = location_info.get("categories", [])
+                    logger.info(f"Location categories: {categories}")
+
+                    event_data["tags"] = base_tags + categories
+                    logger.info(f"Final tags for event: {event_data['tags']}")
+                else:
+                    logger.warning(f"No geolocation info found for: {event_data['LOCATION']}")
+                    event_data["tags"] = []
+
+            # Añadir descripción del mensaje de Telegram
+            if metadata and metadata.get("text"):
+                event_data["DESCRIPTION"] = metadata["text"]
+
+        logger.info(f"Datos del evento extraídos: {event_data_list}")
+        return event_data_list
+
+    @staticmethod
+    def has_explicit_date(event_data) -> bool:
+        """
+        Si el modelo dio día y mes para el evento. Una hora suelta (HH:MM)
+        se resuelve a la fecha de referencia, así que tras resolve_events
+        cualquier evento tiene DTSTART; aquí se mira DTSTART_TEXT.
+        """
+        start_str = (event_data or {}).get("DTSTART_TEXT")
+        return isinstance(start_str, str) and bool(EVENT_DAY_MONTH_PATTERN.match(start_str))
+
+    def extract_many(self, items: List[tuple]) -> List[List[dict]]:
+        """
+        Extrae los eventos de varios textos, dados como [(texto, metadata)],
+        y devuelve la lista de eventos de cada uno en el mismo orden.
+
+        Las peticiones van a la vez (hasta max_concurrent_requests) dentro de
+        los límites por minuto. Con batch_extraction los textos que no están
+        en la caché se agrupan en peticiones de hasta batch_token_budget
+        tokens, con un id por cartel; los que faltan o vienen mal en la
+        respuesta se vuelven a pedir uno a uno.
+
+        La caché se consulta y se actualiza desde el hilo que llama, porque
+        la conexión SQLite no se puede compartir entre hilos.
+        """
+        if not self.uses_groq():
+            return [self.extract_event_info(text, metadata) for text, metadata in items]
+
+        responses = {}
+        pending = []
+        for index, (text, _) in enumerate(items):
+            cached_event_data_list = self.get_cached_events(self.cache_key(text))
+            if cached_event_data_list is None:
+                pending.append(index)
+            else:
+                logger.info("Respuesta del modelo tomada de la caché")
+                responses[index] = cached_event_data_list
+
+        fetched = {}
+        if self.batch_extraction and len(pending) > 1:
+            batches = self.pack_batches([(index, items[index][0]) for index in pending])
+            for batch_result in self._run_concurrently(self.request_batch_events, batches):
+                fetched.update(batch_result)
+            retry = [index for index in pending if fetched.get(index) is None]
+            if retry:
+                logger.warning(f"{len(retry)} carteles sin respuesta válida en el lote, se piden por separado")
+        else:
+            retry = pending
+        for index, event_data_list in zip(
+            retry, self._run_concurrently(self.request_events, [items[index][0] for index in retry])
+        ):
+            fetched[index] = event_data_list
+
+        for index, event_data_list in fetched.items():
+            if event_data_list is not None:
+                self.cache_events(self.cache_key(items[index][0]), event_data_list)
+                responses[index] = event_data_list
+
+        return [
+            self._resolve(responses[index], metadata) if index in responses else []
+            for index, (_, metadata) in enumerate(items)
+        ]
+
+    def _run_concurrently(self, func, args: list) -> list:
+        """func sobre cada elemento de args, hasta max_workers a la vez; resultados en orden."""
+        if len(args) <= 1 or self.max_workers <= 1:
+            return [func(arg) for arg in args]
+        results = [None] * len(args)
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(args))) as executor:
+            futures = {executor.submit(func, arg): index for index, arg in enumerate(args)}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        return results
+
+    def request_batch_events(self, batch: List[tuple]) -> Dict[int, Optional[List[dict]]]:
+        """Eventos validados de cada índice del lote; None para los que faltan o vienen mal."""
+        responses = self.request_batch(batch)
+        results = {}
+        for item_id, (index, _) in enumerate(batch):
+            event_data_list = responses.get(str(item_id))
+            results[index] = (
+                self.validate_and_fix_json(event_data_list)
+                if isinstance(event_data_list, list) else None
+            )
+        return results
+
+    def estimate_tokens(self, text: str) -> int:
+        # Aproximación sin tokenizador: unos 4 caracteres por token en castellano
+        return len(text) // 4 + 1
+
+    def pack_batches(self, entries: List[tuple]) -> List[List[tuple]]:
+        """Agrupa [(índice, texto)] en lotes que no pasan de batch_token_budget tokens de texto."""
+        batches, batch, batch_tokens = [], [], 0
+        for entry in entries:
+            tokens = self.estimate_tokens(entry[1])
+            if batch and batch_tokens + tokens > self.batch_token_budget:
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(entry)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def get_batch_prompt(self, texts: List[str]) -> str:
+        posters = "\n\n".join(
+            f"### Cartel {item_id}\n{text}" for item_id, text in enumerate(texts)
+        )
+        return f"""Analiza los siguientes textos, cada uno de un cartel distinto, y extrae la información de los eventos de cada uno en un formato JSON estructurado. Sigue estas reglas estrictamente para cada cartel:
+
+{EXTRACTION_RULES}
+9. Usa solo el texto de cada cartel para sus eventos; no mezcles información entre carteles.
+
+Estructura JSON requerida (un elemento en "posters" por cada cartel, con su id):
+{{"posters": [
+    {{"id": "0", "events": [
+{EVENT_SCHEMA}
+    ]}}
+]}}
+
+{RRULE_RULES}
+
+Textos a analizar:
+
+{posters}
+
+Proporciona solo la respuesta en formato JSON, sin explicaciones adicionales. Si algún campo no tiene información específica, omítelo del JSON. Si un cartel no tiene eventos, devuelve "events": []."""
+
+    def request_batch(self, batch: List[tuple]) -> Dict[str, list]:
+        """Una petición para el lote [(índice, texto)]; devuelve {id: eventos} (vacío si falla)."""
+        prompt = self.get_batch_prompt([text for _, text in batch])
+        try:
+            content = self.request_completion(prompt)
+            logger.info(f"Contenido sin procesar del lote: {content}")
+            data = json.loads(content)
+            posters = data.get("posters", []) if isinstance(data, dict) else data
+            return {
+                str(poster.get("id")): poster.get("events")
+                for poster in posters if isinstance(poster, dict)
+            }
+        except Exception as e:
+            logger.error(f"Error en la extracción por lotes ({len(batch)} carteles): {e}")
+            return {}
 
 
 
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+os.environ['TZ'] = 'Europe/Madrid'
+time.tzset()
+
+from pipeline import PosterPipeline, build_telegram_bot
+from sqlite_tracker import DatabaseManager
+from utils import load_config, setup_logging
+
+logger = logging.getLogger("daemon")
+
+
+class PosterDaemon:
+    """
+    Proceso de larga duración que escucha los canales en tiempo real.
+
+    Los handlers de Telegram descargan cada cartel nuevo y lo ponen en una
+    cola interna; un worker lo pasa por OCR -> extracción -> ICS -> subida
+    reutilizando los mismos clientes. Cada cierto tiempo se hace un
+    download_images completo para recuperar mensajes perdidos durante
+    desconexiones.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.images_folder = Path(config["directories"]["images"])
+        self.resync_interval = (
+            config.get("daemon", {}).get("resync_interval_minutes", 30) * 60
+        )
+        # El bot vive en el hilo del event loop; el pipeline (bloqueante) en
+        # su propio hilo con su propia conexión SQLite.
+        self.db_manager = DatabaseManager(config["event_tracker_db_path"])
+        self.bot = build_telegram_bot(config, self.db_manager)
+        self.queue = asyncio.Queue()
+        self.pipeline = None
+        self._queued = set()
+        self._buffers = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pipeline")
+
+    def _build_pipeline(self):
+        return PosterPipeline(self.config, DatabaseManager(self.config["event_tracker_db_path"]))
+
+    async def _run_in_pipeline(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def enqueue(self, img_file, buffers=None):
+        img_file = Path(img_file)
+        if img_file.name in self._queued:
+            return
+        self._queued.add(img_file.name)
+        if buffers:
+            self._buffers[img_file.name] = buffers
+        await self.queue.put(img_file)
+
+    def _process(self, img_file, buffers):
+        """Procesa y publica un cartel. Se ejecuta en el hilo del pipeline."""
+        processed_events = self.pipeline.process_image(img_file, buffers)
+        ics_file = self.pipeline.ics_output_folder / f"{img_file.stem}.ics"
+        if ics_file.exists():
+            self.pipeline.publish([ics_file])
+        self.pipeline.cleanup(img_file)
+        return processed_events
+
+    async def worker(self):
+        while True:
+            img_file = await self.queue.get()
+            try:
+                buffers = self._buffers.pop(img_file.name, None)
+                processed_events = await self._run_in_pipeline(self._process, img_file, buffers)
+                logger.info(f"Poster {img_file.name} done: {processed_events} events")
+            except Exception as e:
+                logger.error(f"Error processing {img_file.name}: {e}", exc_info=True)
+            finally:
+                self._queued.discard(img_file.name)
+                self.queue.task_done()
+
+    async def resync(self):
+        while True:
+            try:
+                new_images = await self.bot.download_images(self.images_folder)
+                logger.info(f"Resync downloaded {new_images} new images")
+                await self._run_in_pipeline(self.pipeline.log_stats)
+                for img_file in await self._run_in_pipeline(self.pipeline.pending_images):
+                    await self.enqueue(img_file)
+            except Exception as e:
+                logger.error(f"Error during resync: {e}", exc_info=True)
+            await asyncio.sleep(self.resync_interval)
+
+    async def run(self):
+        self.pipeline = await self._run_in_pipeline(self._build_pipeline)
+        await self.bot.start()
+        self.bot.listen(self.images_folder, self.enqueue)
+
+        tasks = [
+            asyncio.create_task(self.worker()),
+            asyncio.create_task(self.resync()),
+        ]
+        try:
+            logger.info("Daemon started, waiting for new posters")
+            await self.bot.client.run_until_disconnected()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.bot.stop()
+            await self._run_in_pipeline(self.pipeline.db_manager.close)
+            self._executor.shutdown(wait=True)
+            self.db_manager.close()
+            logger.info("Daemon stopped")
+
+
+async def run_daemon():
+    config = load_config()
+    setup_logging(config, "daemon")
+
+    if not config["telegram_bot"]["use"]:
+        logger.error("Daemon mode requires telegram_bot.use = true")
+        return
+
+    await PosterDaemon(config).run()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_daemon())
@@ -0,0 +1,282 @@
+import logging
+from datetime import datetime
+
+import numpy as np
+
+from utils import POPCOUNT_TABLE, ROBUST_KEY_BYTES, ROBUST_KEY_VIEWS, HashMatrix, hash_from_string
+
+logger = logging.getLogger(__name__)
+
+
+class HashIndex:
+    """
+    Índice persistente de vecinos cercanos sobre los hashes de image_hashes.
+
+    Usa multi-index hashing: el phash se parte en m trozos de bytes. Si dos
+    phash están a distancia Hamming menor que m, al menos uno de los trozos
+    coincide exactamente (principio del palomar). Basta entonces con buscar
+    en SQLite las imágenes que comparten algún trozo y calcular la distancia
+    ponderada solo para ellas.
+
+    m se elige a partir de similarity_threshold para que no se pierda ningún
+    candidato. Si harían falta más trozos que bytes tiene el phash, el índice
+    recorre todos los hashes en memoria (con HashMatrix).
+
+    Junto a cada hash se guarda la miniatura de regiones de la imagen, para
+    poder hacer la comparación por regiones cuando el archivo ya se borró.
+    Se guarda la miniatura entera (3 * region_size² bytes por vista, unos
+    12 KB con 64 px) y no un resumen por celda porque _compare_region_features
+    compara píxel a píxel dentro de cada celda (diferencia media y gradientes),
+    algo que no se puede reconstruir a partir de medias o desviaciones; con un
+    resumen, una imagen borrada se compararía con otro criterio que una viva.
+
+    Con robust_keys, cada imagen se indexa además bajo sus claves robustas
+    (sin bordes, centro y pHash DCT, de 64 bits), partidas en trozos de la
+    misma forma. Como las claves tienen 8 bytes, el palomar solo vale hasta
+    7 bits de robust_key_threshold; por encima, las claves se comparan todas
+    en memoria (una HashMatrix por tipo de clave) para no perder ninguna.
+    """
+
+    def __init__(self, db_manager, detector):
+        self.db_manager = db_manager
+        self.detector = detector
+        phash_bits = detector.hash_size * detector.hash_size
+        self.hash_bytes = -(-phash_bits // 8)
+        max_phash_distance = int(
+            detector.similarity_threshold / detector.HASH_WEIGHTS["phash"]
+        )
+        self.num_chunks = max_phash_distance + 1
+        self.exhaustive = self.num_chunks > self.hash_bytes
+        self.layout = f"phash:{self.hash_bytes}:{self.num_chunks}"
+        self.bounds = np.linspace(0, self.hash_bytes, self.num_chunks + 1).astype(int)
+        self._matrix = None
+
+        self.key_threshold = detector.robust_key_threshold
+        self.key_chunks = self.key_threshold + 1
+        self.keys_exhaustive = self.key_chunks > ROBUST_KEY_BYTES
+        self.key_bounds = np.linspace(0, ROBUST_KEY_BYTES, self.key_chunks + 1).astype(int)
+        self._key_matrices = None
+
+        if detector.robust_keys:
+            if self.keys_exhaustive:
+                self._load_key_matrices()
+            else:
+                self.backfill_keys()
+
+        if self.exhaustive:
+            logger.info(
+                f"Hash index: threshold too high for {self.hash_bytes}-byte phash, "
+                "using exhaustive search"
+            )
+            self._load_matrix()
+        else:
+            self.backfill()
+
+    def _chunks(self, phash, bounds=None):
+        bounds = self.bounds if bounds is None else bounds
+        return [
+            phash[start:end].tobytes()
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+
+    def key_layout(self, key_type):
+        return f"key:{key_type}:{self.key_chunks}"
+
+    def _deserialize(self, hash_info):
+        try:
+            hashes = self.detector.deserialize_hashes(hash_info)
+        except (KeyError, TypeError, ValueError):
+            return None
+        if hashes["phash"].shape != (self.hash_bytes,):
+            return None
+        return hashes
+
+    def _load_matrix(self):
+        self._matrix = self.detector.new_hash_matrix()
+        for image_name, hash_info in self.db_manager.get_image_hash_infos():
+            hashes = self._deserialize(hash_info)
+            if hashes:
+                self._matrix.add(image_name, hashes)
+
+    def _load_key_matrices(self):
+        self._key_matrices = {key_type: HashMatrix({key_type: 1}) for key_type in ROBUST_KEY_VIEWS}
+        for image_name, hash_info in self.db_manager.get_image_hash_infos():
+            keys = {
+                key_type: hash_from_string(stored_key)
+                for key_type, stored_key in hash_info.get("keys", {}).items()
+                if key_type in self._key_matrices
+            }
+            self._add_to_key_matrices(image_name, keys)
+
+    def _add_to_key_matrices(self, image_name, keys):
+        for key_type, key in keys.items():
+            self._key_matrices[key_type].add(image_name, {key_type: key})
+
+    def backfill(self):
+        """Indexa los hashes guardados que aún no están en el índice."""
+        indexed = 0
+        for image_name, hash_info in self.db_manager.get_unindexed_image_hashes(self.layout):
+            hashes = self._deserialize(hash_info)
+            if hashes:
+                self.db_manager.add_hash_chunks(
+                    self.layout, image_name, self._chunks(hashes["phash"])
+                )
+                indexed += 1
+        if indexed:
+            logger.info(f"Hash index: indexed {indexed} stored hashes ({self.layout})")
+
+    def backfill_keys(self):
+        """Indexa las claves robustas guardadas en hash_info que aún no están en el índice."""
+        for key_type in ROBUST_KEY_VIEWS:
+            layout = self.key_layout(key_type)
+            indexed = 0
+            for image_name, hash_info in self.db_manager.get_unindexed_image_hashes(layout):
+                stored_key = hash_info.get("keys", {}).get(key_type)
+                if stored_key:
+                    self.db_manager.add_hash_chunks(
+                        layout, image_name, self._chunks(hash_from_string(stored_key), self.key_bounds)
+                    )
+                    indexed += 1
+            if indexed:
+                logger.info(f"Hash index: indexed {indexed} stored keys ({layout})")
+
+    def add_keys(self, image_name, keys):
+        """Indexa las claves robustas de una imagen (también deben estar en su hash_info)."""
+        if self.keys_exhaustive:
+            self._add_to_key_matrices(image_name, keys)
+            return
+        for key_type, key in keys.items():
+            self.db_manager.add_hash_chunks(
+                self.key_layout(key_type), image_name, self._chunks(key, self.key_bounds)
+            )
+
+    def key_matches(self, keys):
+        """
+        Imágenes con alguna clave robusta a distancia <= robust_key_threshold,
+        como lista de (image_name, {tipo de clave: distancia}), primero las
+        que coinciden en más claves y luego las más cercanas.
+        """
+        if self.keys_exhaustive:
+            found = {}
+            for key_type, key in keys.items():
+                matrix = self._key_matrices.get(key_type)
+                if matrix is None:
+                    continue
+                for image_name, distance in matrix.within({key_type: key}, self.key_threshold):
+                    found.setdefault(image_name, {})[key_type] = int(distance)
+            matches = list(found.items())
+            matches.sort(key=lambda match: (-len(match[1]), min(match[1].values())))
+            return matches
+
+        names = set()
+        for key_type, key in keys.items():
+            names.update(self.db_manager.find_hash_chunk_matches(
+                self.key_layout(key_type), self._chunks(key, self.key_bounds)
+            ))
+
+        matches = []
+        for image_name, hash_info in self.db_manager.get_image_hash_infos(names):
+            distances = {}
+            for key_type, stored_key in hash_info.get("keys", {}).items():
+                if key_type not in keys:
+                    continue
+                stored_key = hash_from_string(stored_key)
+                if stored_key.shape != keys[key_type].shape:
+                    continue
+                distance = int(POPCOUNT_TABLE[stored_key ^ keys[key_type]].sum())
+                if distance <= self.key_threshold:
+                    distances[key_type] = distance
+            if distances:
+                matches.append((image_name, distances))
+        matches.sort(key=lambda match: (-len(match[1]), min(match[1].values())))
+        return matches
+
+    def register(self, image_name, image, hashes, digest=None):
+        """
+        Registra una imagen nueva: sus hashes en image_hashes y en el índice,
+        sus firmas de regiones, sus claves robustas (si están activadas) y
+        su digest de contenido.
+        """
+        detector = self.detector
+        serialized_hashes = detector.serialize_hashes(hashes)
+        hash_info = {
+            "processed_date": datetime.now().isoformat(),
+            "hash_size": detector.hash_size,
+            **serialized_hashes
+        }
+        robust_keys = None
+        if detector.robust_keys:
+            robust_keys = detector.calculate_robust_keys(image)
+        if robust_keys:
+            hash_info["keys"] = detector.serialize_hashes(robust_keys)
+        self.db_manager.add_image_hash_with_info(image_name, serialized_hashes["phash"], hash_info)
+        self.add(image_name, hashes)
+        self.add_region_signature(image_name, image)
+        if robust_keys:
+            self.add_keys(image_name, robust_keys)
+            for view in ("trim", "center"):
+                self.add_region_signature(image_name, image, view)
+        if digest is not None:
+            detector.record_digest(digest, image_name)
+
+    def add(self, image_name, hashes):
+        """Añade una imagen al índice (sus hashes ya deben estar en image_hashes)."""
+        if hashes["phash"].shape != (self.hash_bytes,):
+            return
+        if self.exhaustive:
+            self._matrix.add(image_name, hashes)
+        else:
+            self.db_manager.add_hash_chunks(
+                self.layout, image_name, self._chunks(hashes["phash"])
+            )
+
+    def add_region_signature(self, image_name, image, view="full"):
+        """
+        Guarda la miniatura de regiones de una vista de la imagen (ruta o
+        bytes), en crudo: ver la nota sobre su tamaño en la clase.
+        """
+        thumbnail = self.detector.get_region_features(image, view)["thumbnail"]
+        self.db_manager.add_region_signature(
+            image_name, thumbnail.shape[0], thumbnail.tobytes(), view
+        )
+
+    def region_features(self, image_name, view="full", grid_size=None):
+        """Características por región guardadas para image_name, o None."""
+        row = self.db_manager.get_region_signature(image_name, view)
+        if row is None:
+            return None
+        side, signature = row
+        try:
+            return self.detector.region_features_from_signature(side, signature, grid_size)
+        except ValueError:
+            return None
+
+    def candidates(self, hashes):
+        """
+        Imágenes que comparten algún trozo de phash con hashes, como lista de
+        (image_name, hashes). Incluye todas las que están a distancia
+        <= similarity_threshold, pero también algunas más lejanas.
+        """
+        if hashes["phash"].shape != (self.hash_bytes,):
+            return []
+        if self.exhaustive:
+            return list(self._matrix.items())
+
+        names = self.db_manager.find_hash_chunk_matches(self.layout, self._chunks(hashes["phash"]))
+        result = []
+        for image_name, hash_info in self.db_manager.get_image_hash_infos(names):
+            stored_hashes = self._deserialize(hash_info)
+            if stored_hashes:
+                result.append((image_name, stored_hashes))
+        return result
+
+    def query(self, hashes, threshold=None):
+        """Lista de (image_name, distancia) a distancia <= threshold, de menor a mayor."""
+        if threshold is None:
+            threshold = self.detector.similarity_threshold
+        if self.exhaustive:
+            return self._matrix.within(hashes, threshold)
+        matrix = self.detector.new_hash_matrix()
+        for image_name, stored_hashes in self.candidates(hashes):
+            matrix.add(image_name, stored_hashes)
+        return matrix.within(hashes, threshold)
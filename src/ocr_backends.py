@@ -0,0 +1,440 @@
+import importlib
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from google.api_core.client_options import ClientOptions
+from google.cloud import documentai_v1beta3 as documentai
+from google.oauth2 import service_account
+from PIL import Image, ImageOps
+
+from utils import trim_borders
+
+logger = logging.getLogger(__name__)
+
+# Motores de OCR disponibles por nombre (ver register_backend)
+OCR_BACKENDS = {}
+
+# Modelos locales ya cargados, compartidos por todos los lectores del proceso
+_MODELS = {}
+_MODELS_LOCK = threading.Lock()
+
+
+def register_backend(name):
+    def decorator(backend_class):
+        OCR_BACKENDS[name] = backend_class
+        return backend_class
+    return decorator
+
+
+def load_model(key, loader):
+    """Carga un modelo la primera vez que se pide y lo reutiliza después."""
+    with _MODELS_LOCK:
+        if key not in _MODELS:
+            logger.info(f"Loading OCR model: {key}")
+            _MODELS[key] = loader()
+        return _MODELS[key]
+
+
+def import_optional(module_name, backend_name):
+    try:
+        return importlib.import_module(module_name)
+    except ImportError as e:
+        raise RuntimeError(
+            f"OCR backend '{backend_name}' requires the '{module_name}' package"
+        ) from e
+
+
+def get_mime_type(image_path: Path) -> str:
+    suffix = image_path.suffix.lower()
+    if suffix in [".jpg", ".jpeg"]:
+        return "image/jpeg"
+    elif suffix == ".png":
+        return "image/png"
+    elif suffix == ".bmp":
+        return "image/bmp"
+    elif suffix in [".tiff", ".tif"]:
+        return "image/tiff"
+    elif suffix == ".gif":
+        return "image/gif"
+    elif suffix == ".pdf":
+        return "application/pdf"
+    else:
+        raise ValueError(f"Unsupported file extension: {suffix}")
+
+
+class OCRPreprocessor:
+    """
+    Prepara la imagen antes del OCR para subir menos bytes: la reduce a
+    max_long_edge píxeles (o a target_dpi si la imagen trae su resolución),
+    la pasa a escala de grises, recorta los bordes uniformes y la vuelve a
+    codificar en output_format. Si el resultado no es más pequeño se usa el
+    original.
+
+    Las imágenes cuya decodificación completa supera memory_budget_mb se
+    decodifican ya reducidas (draft de JPEG); si el formato no lo permite
+    se envían sin tocar.
+    """
+
+    # Formatos de mapa de bits que se pueden reescribir sin perder páginas
+    # ni fotogramas (PDF y GIF se envían tal cual)
+    RASTER_FORMATS = {"JPEG", "PNG", "BMP", "TIFF"}
+
+    def __init__(self, settings: Optional[Dict] = None):
+        settings = settings or {}
+        self.enabled = settings.get("enabled", False)
+        self.max_long_edge = settings.get("max_long_edge", 2000)
+        self.target_dpi = settings.get("target_dpi")
+        self.grayscale = settings.get("grayscale", True)
+        self.trim = settings.get("trim_borders", True)
+        self.output_format = settings.get("output_format", "JPEG").upper()
+        self.quality = settings.get("quality", 85)
+        self.memory_budget = settings.get("memory_budget_mb", 64) * 2 ** 20
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.images = 0
+
+    @property
+    def cache_key(self):
+        """Identifica los ajustes, que cambian el texto que devuelve el OCR."""
+        if not self.enabled:
+            return ""
+        return (
+            f"pre:{self.max_long_edge}:{self.target_dpi}:{int(self.grayscale)}:"
+            f"{int(self.trim)}:{self.output_format}:{self.quality}"
+        )
+
+    def process(self, image_path: Path, content: bytes) -> Tuple[Path, bytes]:
+        """Devuelve (ruta, bytes) a enviar al OCR; la ruta lleva la extensión del nuevo formato."""
+        if not self.enabled:
+            return image_path, content
+        try:
+            processed = None if image_path.suffix.lower() in (".pdf", ".gif") else self._process(content)
+        except Exception as e:
+            logger.warning(f"OCR preprocessing failed for {image_path.name}: {e}")
+            processed = None
+
+        self.images += 1
+        self.bytes_in += len(content)
+        if processed is None or len(processed) >= len(content):
+            self.bytes_out += len(content)
+            return image_path, content
+
+        self.bytes_out += len(processed)
+        logger.debug(f"OCR preprocessing {image_path.name}: {len(content)} -> {len(processed)} bytes")
+        suffix = ".jpg" if self.output_format == "JPEG" else f".{self.output_format.lower()}"
+        return image_path.with_suffix(suffix), processed
+
+    def _target_scale(self, size, dpi) -> float:
+        scale = 1.0
+        if self.max_long_edge:
+            scale = min(scale, self.max_long_edge / max(size))
+        if self.target_dpi and dpi:
+            scale = min(scale, self.target_dpi / dpi)
+        return scale
+
+    def _process(self, content: bytes) -> Optional[bytes]:
+        with Image.open(io.BytesIO(content)) as img:
+            if img.format not in self.RASTER_FORMATS:
+                return None
+            dpi = float((img.info.get("dpi") or (0,))[0])
+            scale = self._target_scale(img.size, dpi)
+            full_width = img.width
+            mode = "L" if self.grayscale else "RGB"
+            bands = 1 if self.grayscale else 3
+
+            if img.format == "JPEG":
+                # draft escala al decodificar (1/2, 1/4 o 1/8) sin bajar del tamaño final
+                img.draft(mode, (int(img.width * scale), int(img.height * scale)))
+            # Imagen decodificada más la copia convertida a mode
+            if img.width * img.height * (len(img.getbands()) + bands) > self.memory_budget:
+                logger.warning(
+                    f"OCR preprocessing skipped: {img.width}x{img.height} exceeds memory budget"
+                )
+                return None
+
+            # draft reduce también la resolución efectiva
+            dpi = dpi * img.width / full_width
+            img = ImageOps.exif_transpose(img).convert(mode)
+            if self.trim:
+                img = trim_borders(img)
+            scale = self._target_scale(img.size, dpi)
+            if scale < 1.0:
+                img = img.resize(
+                    (max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                    Image.LANCZOS
+                )
+
+            buffer = io.BytesIO()
+            if self.output_format == "JPEG":
+                img.save(buffer, "JPEG", quality=self.quality, optimize=True)
+            else:
+                img.save(buffer, self.output_format, optimize=True)
+            return buffer.getvalue()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "images": self.images,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "reduction": 1 - self.bytes_out / self.bytes_in if self.bytes_in else 0.0,
+        }
+
+
+class OCRBackend:
+    """
+    Motor de OCR. read_batch recibe [(ruta, bytes)] y devuelve, en el mismo
+    orden, (texto, confianza entre 0 y 1) o None si la imagen falla.
+    cache_key identifica el motor y su configuración en la caché de OCR.
+    """
+
+    cache_key = None
+    max_workers = 1
+
+    def read_one(self, image_path: Path, content: bytes) -> Tuple[str, float]:
+        raise NotImplementedError
+
+    def read_batch(self, images: List[Tuple[Path, bytes]],
+                   max_workers: Optional[int] = None) -> List[Optional[Tuple[str, float]]]:
+        max_workers = max_workers or self.max_workers
+        results = [None] * len(images)
+        if len(images) <= 1 or max_workers == 1:
+            for index, (image_path, content) in enumerate(images):
+                results[index] = self._safe_read(image_path, content)
+            return results
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(images))) as executor:
+            futures = {
+                executor.submit(self._safe_read, image_path, content): index
+                for index, (image_path, content) in enumerate(images)
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        return results
+
+    def _safe_read(self, image_path, content):
+        try:
+            return self.read_one(image_path, content)
+        except Exception as e:
+            logger.exception("Error during text extraction from %s: %s", image_path.name, e)
+            return None
+
+
+@register_backend("documentai")
+class DocumentAIBackend(OCRBackend):
+    """
+    Google Document AI. Un único cliente (y canal gRPC) para todas las
+    lecturas; se puede pasar uno ya creado, por ejemplo un procesador local
+    en los tests.
+    """
+
+    def __init__(self, ocr_config=None, google_config=None, client=None):
+        if not google_config:
+            raise ValueError("Google Document AI configuration is missing.")
+        self.project_id = google_config["project_id"]
+        self.location = google_config["location"]
+        self.processor_id = google_config["processor_id"]
+        self.processor_version = google_config.get("processor_version")
+        self.cache_key = f"documentai:{self.processor_id}:{self.processor_version or 'default'}"
+        self.credentials_path = google_config.get("credentials_path")
+        self.max_workers = google_config.get("max_concurrent_requests", 4)
+        self.client_options = ClientOptions(
+            api_endpoint=f"{self.location}-documentai.googleapis.com"
+        )
+        self._client = client
+        self._client_lock = threading.Lock()
+        self._resource_name = None
+
+    def get_client(self):
+        """Cliente de Document AI, creado la primera vez que se necesita."""
+        with self._client_lock:
+            if self._client is None:
+                credentials = service_account.Credentials.from_service_account_file(
+                    self.credentials_path
+                )
+                self._client = documentai.DocumentProcessorServiceClient(
+                    client_options=self.client_options, credentials=credentials
+                )
+            if self._resource_name is None:
+                if self.processor_version:
+                    self._resource_name = self._client.processor_version_path(
+                        self.project_id, self.location, self.processor_id, self.processor_version
+                    )
+                else:
+                    self._resource_name = self._client.processor_path(
+                        self.project_id, self.location, self.processor_id
+                    )
+            return self._client
+
+    def read_one(self, image_path, content):
+        docai_client = self.get_client()
+        raw_document = documentai.RawDocument(
+            content=content, mime_type=get_mime_type(image_path)
+        )
+        request = documentai.ProcessRequest(
+            name=self._resource_name, raw_document=raw_document
+        )
+        result = docai_client.process_document(request=request)
+
+        combined_text = result.document.text
+        logger.info(f"Raw extracted document: {combined_text}")
+        return combined_text, 1.0
+
+
+@register_backend("tesseract")
+class TesseractBackend(OCRBackend):
+    """
+    Tesseract en CPU, sin red. Necesita el paquete pytesseract y el binario
+    tesseract con el idioma configurado (tesseract_lang, 'spa' por defecto).
+    Cada imagen es un proceso de tesseract, así que el lote se reparte en
+    max_workers hilos.
+    """
+
+    def __init__(self, ocr_config=None, google_config=None, client=None):
+        ocr_config = ocr_config or {}
+        self.lang = ocr_config.get("tesseract_lang", "spa")
+        self.max_workers = ocr_config.get("max_workers", 2)
+        self.cache_key = f"tesseract:{self.lang}"
+
+    def _load(self):
+        pytesseract = import_optional("pytesseract", "tesseract")
+        logger.info(f"Using tesseract {pytesseract.get_tesseract_version()}")
+        return pytesseract
+
+    def read_one(self, image_path, content):
+        pytesseract = load_model("tesseract", self._load)
+        with Image.open(io.BytesIO(content)) as img:
+            data = pytesseract.image_to_data(
+                img, lang=self.lang, output_type=pytesseract.Output.DICT
+            )
+
+        lines = {}
+        confidences = []
+        for i, word in enumerate(data["text"]):
+            confidence = float(data["conf"][i])
+            if not word.strip() or confidence < 0:
+                continue
+            line_key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+            lines.setdefault(line_key, []).append(word)
+            confidences.append(confidence)
+
+        text = "\n".join(" ".join(words) for words in lines.values())
+        confidence = sum(confidences) / len(confidences) / 100 if confidences else 0.0
+        return text, confidence
+
+
+@register_backend("easyocr")
+class EasyOCRBackend(OCRBackend):
+    """
+    EasyOCR en CPU. El modelo se carga una vez por proceso. Cada lote se lee
+    con readtext_batched: las imágenes del mismo tamaño comparten una sola
+    pasada del detector, y los recortes de texto se reconocen en lotes de
+    batch_size. Con batch_image_size ([ancho, alto]) todas las imágenes se
+    redimensionan a ese tamaño y van en una única llamada.
+    """
+
+    def __init__(self, ocr_config=None, google_config=None, client=None):
+        ocr_config = ocr_config or {}
+        self.languages = list(ocr_config.get("languages", ["es"]))
+        self.batch_size = ocr_config.get("batch_size", 8)
+        self.batch_image_size = ocr_config.get("batch_image_size")
+        self.cache_key = f"easyocr:{'+'.join(self.languages)}"
+        if self.batch_image_size:
+            width, height = self.batch_image_size
+            self.cache_key += f":{width}x{height}"
+
+    def _load(self):
+        easyocr = import_optional("easyocr", "easyocr")
+        return easyocr.Reader(self.languages, gpu=False)
+
+    @staticmethod
+    def _decode(content):
+        with Image.open(io.BytesIO(content)) as img:
+            return np.array(ImageOps.exif_transpose(img).convert("RGB"))
+
+    @staticmethod
+    def _result(detections):
+        text = "\n".join(detection[1] for detection in detections)
+        confidences = [float(detection[2]) for detection in detections]
+        confidence = sum(confidences) / len(confidences) if confidences else 0.0
+        return text, confidence
+
+    def read_batch(self, images, max_workers=None):
+        # El modelo ya usa todos los núcleos: no se reparte en hilos
+        results = [None] * len(images)
+        groups = {}
+        for index, (image_path, content) in enumerate(images):
+            try:
+                pixels = self._decode(content)
+            except Exception as e:
+                logger.exception("Error during text extraction from %s: %s", image_path.name, e)
+                continue
+            shape = None if self.batch_image_size else pixels.shape
+            groups.setdefault(shape, []).append((index, pixels))
+
+        if not groups:
+            return results
+        reader = load_model(self.cache_key, self._load)
+        width, height = self.batch_image_size or (None, None)
+        for group in groups.values():
+            try:
+                batch_detections = reader.readtext_batched(
+                    [pixels for _, pixels in group], n_width=width, n_height=height,
+                    detail=1, batch_size=self.batch_size
+                )
+            except Exception as e:
+                names = ", ".join(images[index][0].name for index, _ in group)
+                logger.exception("Error during text extraction from %s: %s", names, e)
+                continue
+            for (index, _), detections in zip(group, batch_detections):
+                results[index] = self._result(detections)
+        return results
+
+
+@register_backend("hybrid")
+class HybridBackend(OCRBackend):
+    """
+    Primero el motor local (local_backend); las imágenes con confianza por
+    debajo de min_confidence, o sin texto, se vuelven a leer con Document AI.
+    """
+
+    def __init__(self, ocr_config=None, google_config=None, client=None):
+        ocr_config = ocr_config or {}
+        local_name = ocr_config.get("local_backend", "tesseract")
+        if local_name not in OCR_BACKENDS or local_name in ("hybrid", "documentai"):
+            raise ValueError(f"Invalid local OCR backend for hybrid mode: {local_name}")
+        self.local = OCR_BACKENDS[local_name](ocr_config, google_config)
+        self.remote = DocumentAIBackend(ocr_config, google_config, client)
+        self.min_confidence = ocr_config.get("min_confidence", 0.75)
+        self.max_workers = self.remote.max_workers
+        self.cache_key = f"hybrid:{self.local.cache_key}:{self.min_confidence}|{self.remote.cache_key}"
+        self.fallbacks = 0
+
+    def read_batch(self, images, max_workers=None):
+        results = self.local.read_batch(images)
+        fallback = [
+            index for index, result in enumerate(results)
+            if result is None or not result[0].strip() or result[1] < self.min_confidence
+        ]
+        if fallback:
+            logger.info(f"Hybrid OCR: {len(fallback)} of {len(images)} images sent to Document AI")
+            self.fallbacks += len(fallback)
+            remote_results = self.remote.read_batch([images[index] for index in fallback], max_workers)
+            for index, result in zip(fallback, remote_results):
+                # Si Document AI también falla, mejor el texto local que nada
+                if result is not None:
+                    results[index] = result
+        return results
+
+
+def create_backend(service: str, ocr_config: Optional[Dict] = None,
+                   google_config: Optional[Dict] = None, client=None) -> OCRBackend:
+    if service not in OCR_BACKENDS:
+        raise ValueError(
+            f"Invalid OCR service '{service}'. Options: {', '.join(sorted(OCR_BACKENDS))}"
+        )
+    return OCR_BACKENDS[service](ocr_config, google_config, client)
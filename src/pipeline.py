@@ -0,0 +1,532 @@
+import json
+import logging
+from pathlib import Path
+
+from calendar_generator import EntityExtractor, ICSExporter, OCRReader
+from hash_index import HashIndex
+from ics_uploader import extract_event_details_from_ics, process_events_batch
+from telegram_bot import TelegramBot
+from utils import DuplicateDetector, caption_is_complete
+
+logger = logging.getLogger(__name__)
+
+
+def build_telegram_bot(config, db_manager, start_date=None):
+    """Crear el TelegramBot a partir de la configuración."""
+    telegram_config = config["telegram_bot"]
+    # Convertir la lista de canales del config a un formato utilizable
+    channels = [
+        {"id": channel["id"], "name": channel["name"]}
+        for channel in telegram_config["channels"]
+    ]
+    return TelegramBot(
+        telegram_config["api_id"],
+        telegram_config["api_hash"],
+        telegram_config["phone"],
+        telegram_config["session_file"],
+        db_manager,
+        channels,
+        start_date.strftime("%Y-%m-%d") if start_date else None,
+        telegram_config.get("max_posters_per_day", 50),
+        max_concurrent_channels=telegram_config.get("max_concurrent_channels", 4),
+        max_downloads_per_channel=telegram_config.get("max_downloads_per_channel", 2),
+        max_concurrent_downloads=telegram_config.get("max_concurrent_downloads", 8),
+        initial_lookback_days=telegram_config.get("initial_lookback_days", 1),
+        skip_seen_media=telegram_config.get("skip_seen_media", True),
+        ocr_min_long_edge=telegram_config.get("ocr_min_long_edge", 0),
+        max_download_attempts=telegram_config.get("max_download_attempts", 3),
+    )
+
+
+class PosterPipeline:
+    """
+    Pasos OCR -> extracción -> ICS -> subida para cada cartel.
+
+    Mantiene los clientes (Document AI, Groq) inicializados para que tanto
+    la ejecución por cron como el daemon los reutilicen entre carteles.
+    """
+
+    def __init__(self, config, db_manager):
+        self.config = config
+        self.db_manager = db_manager
+        self.images_folder = Path(config["directories"]["images"])
+        self.text_output_folder = Path(config["directories"]["plain_texts"])
+        self.ics_output_folder = Path(config["directories"]["ics"])
+        self.text_output_folder.mkdir(exist_ok=True)
+        self.ics_output_folder.mkdir(exist_ok=True)
+        self.channels = config["telegram_bot"]["channels"]
+
+        self.duplicate_detector = DuplicateDetector(config, db_manager)
+        # Índice persistente de todos los hashes procesados (de esta y de
+        # anteriores ejecuciones)
+        self.hash_index = HashIndex(db_manager, self.duplicate_detector)
+        ocr_service = config["ocr_service"]
+        google_config = config.get("google_document_ai")
+        logger.info(f"Initializing OCR reader with service: {ocr_service}")
+        self.reader = OCRReader(
+            ocr_service, google_config, db_manager, ocr_config=config.get("ocr", {})
+        )
+        self.extractor = EntityExtractor(config, db_manager)
+        self.exporter = ICSExporter()
+        # Si el texto del post ya trae fecha, hora y lugar se extrae de él
+        # sin OCR; el OCR queda solo para cuando esa extracción falla
+        ocr_config = config.get("ocr", {})
+        self.caption_first = ocr_config.get("caption_first", True)
+        self.caption_min_length = ocr_config.get("caption_min_length", 40)
+        self.caption_only_posters = 0
+
+    def pending_images(self):
+        """
+        Imágenes descargadas que todavía no se han procesado.
+        Las fotos secundarias de un álbum se procesan con su imagen principal.
+        """
+        album_members = set()
+        for json_file in self.images_folder.glob("*.json"):
+            try:
+                with open(json_file, 'r', encoding='utf-8') as f:
+                    album_members.update(json.load(f).get("album", []))
+            except Exception as e:
+                logger.error(f"Error loading metadata from {json_file}: {e}")
+
+        return [
+            img_file
+            for img_file in sorted(self.images_folder.iterdir())
+            if img_file.suffix.lower() in OCRReader.SUPPORTED_FORMATS
+            and img_file.name not in album_members
+            and not self.db_manager.is_image_processed(img_file.name)
+        ]
+
+    def album_files(self, img_file, metadata):
+        """Fotos secundarias del álbum al que pertenece img_file."""
+        if not metadata:
+            return []
+        album_files = [img_file.parent / name for name in metadata.get("album", [])]
+        return [path for path in album_files if path.exists()]
+
+    def load_image_bytes(self, img_file, buffers):
+        """Bytes de la imagen, leídos de disco una sola vez por cartel."""
+        if img_file.name not in buffers:
+            buffers[img_file.name] = img_file.read_bytes()
+        return buffers[img_file.name]
+
+    def poster_images(self, img_file, album_files, buffers):
+        """Fotos de un cartel que hay que leer; en un álbum, solo las no duplicadas entre sí."""
+        images = [img_file]
+        if album_files:
+            for album_file in album_files:
+                self.load_image_bytes(album_file, buffers)
+            images = self.duplicate_detector.filter_duplicates([img_file] + album_files, buffers)
+            logger.info(
+                f"Album {img_file.name}: {len(images)} distinct of {len(album_files) + 1} images"
+            )
+        return images
+
+    def mark_processed(self, img_file, album_files):
+        for path in [img_file] + album_files:
+            self.db_manager.mark_image_as_processed(path.name)
+
+    def is_duplicate(self, img_file, image_data=None, current_hashes=None):
+        """
+        Comprueba duplicados y registra el hash si la imagen es nueva.
+        current_hashes trae los hashes si ya se han calculado (hash_images).
+        """
+        duplicate_detector = self.duplicate_detector
+        image_source = image_data if image_data is not None else img_file
+
+        # Copias idénticas byte a byte: basta con el digest, sin decodificar
+        try:
+            digest, exact_match = duplicate_detector.find_exact_duplicate(image_source, img_file.name)
+        except OSError as e:
+            logger.error(f"Error reading {img_file.name}: {e}")
+            return False
+        if exact_match:
+            logger.info(f"Skipping duplicate image: {img_file.name} (identical to: {exact_match})")
+            return True
+
+        if current_hashes is None:
+            current_hashes = duplicate_detector.calculate_image_hash(image_source)
+        if not current_hashes:
+            return False
+
+        is_duplicate, matching_file = duplicate_detector.check_duplicate(
+            img_file,
+            {},
+            [],
+            current_hashes=current_hashes,
+            image_data=image_data,
+            hash_index=self.hash_index
+        )
+
+        if is_duplicate:
+            matching_name = matching_file.name if isinstance(matching_file, Path) else str(matching_file)
+            logger.info(f"Skipping duplicate image: {img_file.name} (duplicate of: {matching_name})")
+            return True
+        serialized_hashes = duplicate_detector.serialize_hashes(current_hashes)
+        if self.db_manager.is_hash_processed(serialized_hashes["phash"]):  # Use perceptual hash for DB check
+            logger.info(f"Hash already processed: {img_file.name}")
+            return True
+
+        # Process new image
+        logger.info(f"Processing new image: {img_file.name}")
+
+        # Store hash information
+        self.hash_index.register(img_file.name, image_source, current_hashes, digest)
+        return False
+
+    def load_metadata(self, img_file):
+        """Cargar metadata del archivo JSON asociado."""
+        json_file_path = img_file.with_suffix('.json')
+        metadata = None
+        if json_file_path.exists():
+            try:
+                with open(json_file_path, 'r', encoding='utf-8') as f:
+                    metadata = json.load(f)
+                logger.info(f"Loaded metadata for {img_file.name}: {metadata}")
+            except Exception as e:
+                logger.error(f"Error loading metadata from {json_file_path}: {e}")
+        return metadata
+
+    def prepare_poster(self, img_file, buffers=None, hashes=None):
+        """
+        Primera parte de process_image: descarta duplicados y decide qué fotos
+        hay que leer. Devuelve None si no hay nada que procesar.
+        """
+        img_file = Path(img_file)
+        if self.db_manager.is_image_processed(img_file.name):
+            return None
+
+        buffers = dict(buffers or {})
+        metadata = self.load_metadata(img_file)
+        album_files = self.album_files(img_file, metadata)
+        image_data = self.load_image_bytes(img_file, buffers)
+        if self.is_duplicate(img_file, image_data, hashes):
+            self.mark_processed(img_file, album_files)
+            return None
+
+        caption = (metadata or {}).get("text")
+        return {
+            "img_file": img_file,
+            "metadata": metadata,
+            "album_files": album_files,
+            "buffers": buffers,
+            "images": self.poster_images(img_file, album_files, buffers),
+            "caption_complete": self.caption_first
+            and caption_is_complete(caption, self.caption_min_length),
+        }
+
+    def finish_from_caption(self, poster, extracted_data_list=None):
+        """
+        Extracción y ICS solo con el texto del post, sin OCR. Devuelve None
+        si de ahí no sale ningún evento con día y mes (una hora suelta no
+        basta), para leer entonces el cartel.
+        extracted_data_list trae la extracción si ya se ha hecho por lotes.
+        """
+        img_file = poster["img_file"]
+        metadata = poster["metadata"]
+        caption = metadata["text"]
+        logger.info(f"Caption of {img_file.name} looks complete, extracting without OCR")
+
+        if extracted_data_list is None:
+            extracted_data_list = self.extractor.extract_event_info(caption, metadata)
+        if not any(self.extractor.has_explicit_date(data) for data in extracted_data_list or []):
+            logger.info(f"No dated event in caption of {img_file.name}, falling back to OCR")
+            return None
+
+        self.caption_only_posters += 1
+        with open(self.text_output_folder / (img_file.stem + ".txt"), "w", encoding="utf-8") as text_file:
+            text_file.write(caption)
+        processed_events = self.export_events(
+            img_file, extracted_data_list, metadata, self.ics_output_folder / (img_file.stem + ".ics")
+        )
+        self.mark_processed(img_file, poster["album_files"])
+        return processed_events
+
+    def combine_text(self, poster, texts):
+        """Texto del post seguido del texto leído en las fotos."""
+        metadata = poster["metadata"]
+        text = "\n".join(text for text in texts if text)
+
+        combined_text = ""
+        if metadata and metadata.get('text'):
+            combined_text = metadata['text']
+        if text:
+            combined_text = f"{combined_text}\n{text}" if combined_text else text
+        return combined_text
+
+    def finish_poster(self, poster, texts, extracted_data_list=None):
+        """
+        Segunda parte de process_image: extracción y ICS a partir del texto
+        leído. extracted_data_list trae la extracción si ya se ha hecho por lotes.
+        """
+        img_file = poster["img_file"]
+        metadata = poster["metadata"]
+        processed_events = 0
+        text_file_path = self.text_output_folder / (img_file.stem + ".txt")
+        ics_file_path = self.ics_output_folder / (img_file.stem + ".ics")
+        combined_text = self.combine_text(poster, texts)
+
+        if combined_text:
+            with open(text_file_path, "w", encoding="utf-8") as text_file:
+                text_file.write(combined_text)
+            logger.info(f"Extracting event info from: {combined_text[:100]}...")
+
+            if extracted_data_list is None:
+                extracted_data_list = self.extractor.extract_event_info(combined_text, metadata)
+            processed_events = self.export_events(
+                img_file, extracted_data_list, metadata, ics_file_path
+            )
+        else:
+            logger.warning(f"No text extracted from image {img_file.name}")
+
+        self.mark_processed(img_file, poster["album_files"])
+        return processed_events
+
+    def ocr_posters(self, posters):
+        """OCR de las fotos de varios carteles a la vez; devuelve los textos de cada uno."""
+        images = [
+            (image, poster["buffers"].get(image.name))
+            for poster in posters for image in poster["images"]
+        ]
+        texts = iter(self.reader.read_many(images))
+        return [[next(texts) for _ in poster["images"]] for poster in posters]
+
+    def process_image(self, img_file, buffers=None):
+        """
+        Procesa un cartel completo y genera su ICS.
+        buffers puede traer los bytes ya descargados de cada foto por nombre.
+        Devuelve el número de eventos exportados.
+        """
+        poster = self.prepare_poster(img_file, buffers)
+        if poster is None:
+            return 0
+        if poster["caption_complete"]:
+            processed_events = self.finish_from_caption(poster)
+            if processed_events is not None:
+                return processed_events
+        return self.finish_poster(poster, self.ocr_posters([poster])[0])
+
+    def process_images(self, img_files, batch_size=None):
+        """
+        Procesa varios carteles por lotes: la detección de duplicados va en
+        orden, pero el OCR de cada lote se hace con peticiones concurrentes.
+        img_files puede traer rutas o pares (ruta, hashes), como los que
+        genera DuplicateDetector.hash_images, para no recalcular los hashes.
+        Devuelve el número total de eventos exportados.
+        """
+        batch_size = batch_size or self.reader.max_workers
+        processed_events = 0
+        batch = []
+        for item in img_files:
+            img_file, hashes = item if isinstance(item, tuple) else (item, None)
+            poster = self.prepare_poster(img_file, hashes=hashes)
+            if poster is not None:
+                batch.append(poster)
+            if len(batch) >= batch_size:
+                processed_events += self._finish_batch(batch)
+                batch = []
+        if batch:
+            processed_events += self._finish_batch(batch)
+        return processed_events
+
+    def _finish_batch(self, posters):
+        """
+        Termina un lote: primero los carteles que se resuelven con el texto
+        del post y después el OCR del resto. La extracción de cada fase se
+        pide de una vez con extract_many (varios carteles por petición si
+        external_api.batch_extraction está activo).
+        """
+        processed_events = 0
+        caption_posters = [poster for poster in posters if poster["caption_complete"]]
+        ocr_pending = [poster for poster in posters if not poster["caption_complete"]]
+
+        caption_results = self.extractor.extract_many(
+            [(poster["metadata"]["text"], poster["metadata"]) for poster in caption_posters]
+        )
+        for poster, extracted_data_list in zip(caption_posters, caption_results):
+            try:
+                events = self.finish_from_caption(poster, extracted_data_list)
+            except Exception as e:
+                logger.error(f"Error processing {poster['img_file'].name}: {e}", exc_info=True)
+                continue
+            if events is not None:
+                processed_events += events
+            else:
+                ocr_pending.append(poster)
+
+        if not ocr_pending:
+            return processed_events
+        texts = self.ocr_posters(ocr_pending)
+        combined_texts = [self.combine_text(poster, poster_texts) for poster, poster_texts in zip(ocr_pending, texts)]
+        results = iter(self.extractor.extract_many([
+            (combined_text, poster["metadata"])
+            for poster, combined_text in zip(ocr_pending, combined_texts) if combined_text
+        ]))
+        for poster, poster_texts, combined_text in zip(ocr_pending, texts, combined_texts):
+            try:
+                extracted_data_list = next(results) if combined_text else None
+                processed_events += self.finish_poster(poster, poster_texts, extracted_data_list)
+            except Exception as e:
+                logger.error(f"Error processing {poster['img_file'].name}: {e}", exc_info=True)
+        return processed_events
+
+    def export_events(self, img_file, extracted_data_list, metadata, ics_file_path):
+        processed_events = 0
+        if not extracted_data_list:
+            logger.warning(
+                f"Failed to extract complete data for image {img_file.name}"
+            )
+            logger.warning(f"Extracted data: {extracted_data_list}")
+            return 0
+
+        for extracted_data in extracted_data_list:
+            if extracted_data and any(
+                [
+                    extracted_data.get("SUMMARY"),
+                    extracted_data.get("DTSTART"),
+                    extracted_data.get("LOCATION"),
+                ]
+            ):
+                logger.info(f"Processing extracted data: {extracted_data}")
+                try:
+                    start_date = extracted_data.get("DTSTART")
+                    end_date = extracted_data.get("DTEND")
+
+                    if start_date is None:
+                        logger.error(f"Unable to determine start date for event: {extracted_data.get('SUMMARY')}")
+                        continue
+
+                    # Crear un ID único para el evento que incluya el canal
+                    channel_prefix = f"{metadata['channel_name']}_" if metadata and metadata.get('channel_name') else ""
+                    event_id = f"{channel_prefix}{extracted_data.get('SUMMARY')}_{start_date.isoformat()}_{extracted_data.get('LOCATION')}"
+
+                    if not self.db_manager.is_event_sent(event_id):
+                        # Preparar los datos del evento incluyendo tags y metadatos
+                        event_data = {
+                            "summary": extracted_data.get("SUMMARY"),
+                            "dtstart": start_date,
+                            "location": extracted_data.get("LOCATION"),
+                            "description": extracted_data.get("DESCRIPTION", ""),
+                            "rrule": extracted_data.get("RRULE"),
+                        }
+
+                        # Agregar tags si existen
+                        if "tags" in extracted_data:
+                            event_data["tags"] = extracted_data["tags"]
+
+                        if end_date:
+                            event_data["dtend"] = end_date
+
+                        logger.debug(f"Event data before export: {event_data}")
+                        self.exporter.export(event_data, ics_file_path)
+                        logger.info(f"ICS file successfully generated: {img_file.name}")
+                        self.db_manager.add_event_title(extracted_data.get("SUMMARY"))
+                        self.db_manager.add_event(extracted_data)
+                        processed_events += 1
+                    else:
+                        logger.info(f"Skipping already processed event: {event_id}")
+                except Exception as e:
+                    logger.error(f"Error processing event data: {str(e)}", exc_info=True)
+                    logger.error(f"Problematic data: {extracted_data}")
+                    for key, value in extracted_data.items():
+                        logger.error(f"{key}: {value}")
+        return processed_events
+
+    def collect_events(self, ics_files):
+        """Lee los ICS generados y prepara los eventos pendientes de envío."""
+        all_events = []
+        for ics_file in ics_files:
+            events = extract_event_details_from_ics(ics_file)
+            for event in events:
+                # Incluir el nombre base del archivo en los detalles del evento
+                event['base_filename'] = ics_file.stem
+
+                # Buscar el nombre del canal en la configuración
+                channel_id = ics_file.stem.split('_')[0] if '_' in ics_file.stem else None
+                channel_name = None
+                if channel_id:
+                    for channel in self.channels:
+                        if str(channel['id']) == channel_id:
+                            channel_name = channel['name']
+                            break
+
+                existing_tags = event.get('categories', [])
+                event['tags'] = existing_tags + ["Generado automáticamente"]
+                if channel_name:
+                    event['tags'].insert(0, channel_name)
+
+                # Preparar ID del evento
+                event_id = f"{channel_name+'_' if channel_name else ''}{event['title']}_{event['start_datetime']}_{event['place_name']}"
+
+                # Añadir imagen si existe
+                image_path = self.images_folder / f"{ics_file.stem}.jpg"
+                if image_path.exists():
+                    event['image_path'] = str(image_path)
+
+                # Solo añadir si no ha sido enviado
+                if not self.db_manager.is_event_sent(event_id):
+                    all_events.append(event)
+                else:
+                    logger.info(f"Skipping already sent event: {event_id}")
+        return all_events
+
+    def publish(self, ics_files=None):
+        """Envía a la API los eventos de los ICS indicados (por defecto, todos)."""
+        if ics_files is None:
+            ics_files = [
+                ics_file
+                for ics_file in self.ics_output_folder.iterdir()
+                if ics_file.suffix.lower() == ".ics"
+            ]
+        ics_files = [ics_file for ics_file in ics_files if Path(ics_file).exists()]
+        logger.info(f"Found {len(ics_files)} ICS files to process")
+
+        all_events = self.collect_events(ics_files)
+
+        # Procesar todos los eventos en lotes
+        if all_events:
+            logger.info(f"Processing {len(all_events)} events in batches")
+            process_events_batch(self.config, all_events, self.db_manager)
+            logger.info(f"Finished processing all events")
+        else:
+            logger.info("No new events to process")
+        return len(all_events)
+
+    def log_stats(self):
+        stats = self.duplicate_detector.hash_cache.stats()
+        logger.info(
+            f"Hash cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"(hit rate {stats['hit_rate']:.0%})"
+        )
+        stats = self.reader.cache_stats()
+        logger.info(
+            f"OCR cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"(hit rate {stats['hit_rate']:.0%}), {stats['bytes_saved']} bytes not sent"
+        )
+        stats = self.extractor.cache_stats()
+        logger.info(
+            f"LLM cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"(hit rate {stats['hit_rate']:.0%})"
+        )
+        if self.caption_only_posters:
+            logger.info(f"Caption-only extraction: {self.caption_only_posters} posters without OCR")
+        stats = self.reader.preprocess_stats()
+        if stats["images"]:
+            logger.info(
+                f"OCR preprocessing: {stats['images']} images, {stats['bytes_in']} -> "
+                f"{stats['bytes_out']} bytes ({stats['reduction']:.0%} less)"
+            )
+
+    def cleanup(self, img_file):
+        """Borra los archivos intermedios de un cartel ya publicado."""
+        img_file = Path(img_file)
+        album_files = self.album_files(img_file, self.load_metadata(img_file))
+        for path in album_files + [
+            img_file,
+            img_file.with_suffix(".json"),
+            self.text_output_folder / (img_file.stem + ".txt"),
+            self.ics_output_folder / (img_file.stem + ".ics"),
+        ]:
+            try:
+                path.unlink(missing_ok=True)
+            except Exception as e:
+                logger.error(f"Failed to delete file {path}: {e}")
@@ -39,6 +39,66 @@ class DatabaseManager:
             ("event_titles", "title TEXT PRIMARY KEY"),
             ("events", "id TEXT PRIMARY KEY, summary TEXT, dtstart TEXT, location TEXT"),
             ("sent_events", "event_id TEXT PRIMARY KEY"),
+            ("seen_media", """
+                photo_id INTEGER,
+                origin_channel_id INTEGER,
+                origin_message_id INTEGER,
+                channel_id TEXT,
+                message_id INTEGER,
+                seen_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            """),
+            ("hash_chunks", """
+                layout TEXT NOT NULL,
+                chunk_index INTEGER NOT NULL,
+                chunk_value BLOB NOT NULL,
+                image_name TEXT NOT NULL
+            """),
+            ("image_digests", """
+                digest TEXT PRIMARY KEY,
+                image_name TEXT NOT NULL,
+                created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            """),
+            ("region_signatures", """
+                image_name TEXT NOT NULL,
+                view TEXT NOT NULL DEFAULT 'full',
+                side INTEGER NOT NULL,
+                signature BLOB NOT NULL,
+                created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (image_name, view)
+            """),
+            ("ocr_cache", """
+                digest TEXT NOT NULL,
+                processor TEXT NOT NULL,
+                text TEXT NOT NULL,
+                created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (digest, processor)
+            """),
+            ("llm_cache", """
+                cache_key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            """),
+            ("hash_cache", """
+                digest TEXT NOT NULL,
+                hash_key TEXT NOT NULL,
+                hashes TEXT NOT NULL,
+                created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (digest, hash_key)
+            """),
+            ("download_failures", """
+                channel_id TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (channel_id, message_id)
+            """),
+            ("channel_cursors", """
+                channel_id TEXT PRIMARY KEY,
+                last_message_id INTEGER NOT NULL,
+                updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            """),
             ("image_hashes", """
                 image_name TEXT PRIMARY KEY, 
                 phash TEXT NOT NULL,
@@ -47,6 +107,14 @@ class DatabaseManager:
             """)
         ]
 
+        indexes = [
+            ("idx_seen_media_photo", "seen_media (photo_id)"),
+            ("idx_seen_media_origin", "seen_media (origin_channel_id, origin_message_id)"),
+            ("idx_hash_chunks_lookup", "hash_chunks (layout, chunk_index, chunk_value)"),
+            ("idx_hash_chunks_image", "hash_chunks (layout, image_name)"),
+            ("idx_llm_cache_last_used", "llm_cache (last_used)"),
+        ]
+
         with self.transaction():
             for table_name, schema in tables:
                 self.cursor.execute(f"""
@@ -54,6 +122,8 @@ class DatabaseManager:
                         {schema}
                     )
                 """)
+            for index_name, columns in indexes:
+                self.cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {columns}")
 
     def migrate_database(self):
         try:
@@ -78,10 +148,68 @@ class DatabaseManager:
                     
                     self.cursor.execute("DROP TABLE image_hashes")
                     self.cursor.execute("ALTER TABLE image_hashes_new RENAME TO image_hashes")
+
+                self.cursor.execute("PRAGMA user_version")
+                version = self.cursor.fetchone()[0]
+                if version < 1:
+                    self._migrate_hashes_to_hex()
+                    self.cursor.execute("PRAGMA user_version = 1")
+                if version < 2:
+                    self._migrate_region_signature_views()
+                    self.cursor.execute("PRAGMA user_version = 2")
         except sqlite3.Error as e:
             logger.error(f"Error en migración: {e}")
             raise
 
+    @staticmethod
+    def _bits_to_hex(bits):
+        """Convierte un hash '0'/'1' al hexadecimal de sus bits empaquetados."""
+        if not isinstance(bits, str) or not bits or not set(bits) <= {"0", "1"}:
+            return bits
+        padded = bits + "0" * (-len(bits) % 8)
+        return format(int(padded, 2), f"0{len(padded) // 4}x")
+
+    def _migrate_hashes_to_hex(self):
+        """Los hashes se guardaban como cadenas de '0'/'1'; ahora en hexadecimal."""
+        self.cursor.execute("SELECT image_name, phash, hash_info FROM image_hashes")
+        rows = self.cursor.fetchall()
+        for image_name, phash, hash_info in rows:
+            if hash_info:
+                info = json.loads(hash_info)
+                for h_type in ("phash", "ahash", "ghash"):
+                    if h_type in info:
+                        info[h_type] = self._bits_to_hex(info[h_type])
+                hash_info = json.dumps(info)
+            self.cursor.execute(
+                "UPDATE image_hashes SET phash = ?, hash_info = ? WHERE image_name = ?",
+                (self._bits_to_hex(phash), hash_info, image_name)
+            )
+        if rows:
+            logger.info(f"Migrated {len(rows)} image hashes to hexadecimal encoding")
+
+    def _migrate_region_signature_views(self):
+        """region_signatures guarda ahora una firma por imagen y vista."""
+        self.cursor.execute("PRAGMA table_info(region_signatures)")
+        columns = {column[1] for column in self.cursor.fetchall()}
+        if 'view' in columns:
+            return
+        self.cursor.execute("""
+            CREATE TABLE region_signatures_new (
+                image_name TEXT NOT NULL,
+                view TEXT NOT NULL DEFAULT 'full',
+                side INTEGER NOT NULL,
+                signature BLOB NOT NULL,
+                created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (image_name, view)
+            )
+        """)
+        self.cursor.execute("""
+            INSERT INTO region_signatures_new (image_name, side, signature, created_date)
+            SELECT image_name, side, signature, created_date FROM region_signatures
+        """)
+        self.cursor.execute("DROP TABLE region_signatures")
+        self.cursor.execute("ALTER TABLE region_signatures_new RENAME TO region_signatures")
+
     def add_image_hash(self, image_name, phash):
         with self.transaction():
             self.cursor.execute(
@@ -97,6 +225,204 @@ class DatabaseManager:
                 (image_name, phash, json.dumps(hash_info))
             )
 
+    def get_image_hash_infos(self, image_names=None):
+        """
+        Devuelve [(image_name, hash_info)] de image_hashes, de todas las
+        imágenes o solo de las indicadas.
+        """
+        try:
+            if image_names is None:
+                self.cursor.execute(
+                    "SELECT image_name, hash_info FROM image_hashes WHERE hash_info IS NOT NULL"
+                )
+                rows = self.cursor.fetchall()
+            else:
+                image_names = list(image_names)
+                rows = []
+                # Por lotes, para no superar el límite de parámetros de SQLite
+                for i in range(0, len(image_names), 500):
+                    batch = image_names[i:i + 500]
+                    placeholders = ", ".join("?" * len(batch))
+                    self.cursor.execute(
+                        f"""SELECT image_name, hash_info FROM image_hashes
+                        WHERE hash_info IS NOT NULL AND image_name IN ({placeholders})""",
+                        batch
+                    )
+                    rows.extend(self.cursor.fetchall())
+            return [(image_name, json.loads(hash_info)) for image_name, hash_info in rows]
+        except sqlite3.Error as e:
+            logger.error(f"Error reading image hashes: {e}")
+            return []
+
+    def get_unindexed_image_hashes(self, layout):
+        try:
+            self.cursor.execute(
+                """SELECT image_name, hash_info FROM image_hashes
+                WHERE hash_info IS NOT NULL AND image_name NOT IN (
+                    SELECT image_name FROM hash_chunks WHERE layout = ?
+                )""",
+                (layout,)
+            )
+            return [
+                (image_name, json.loads(hash_info))
+                for image_name, hash_info in self.cursor.fetchall()
+            ]
+        except sqlite3.Error as e:
+            logger.error(f"Error reading unindexed image hashes: {e}")
+            return []
+
+    def add_hash_chunks(self, layout, image_name, chunks):
+        with self.transaction():
+            self.cursor.execute(
+                "DELETE FROM hash_chunks WHERE layout = ? AND image_name = ?",
+                (layout, image_name)
+            )
+            self.cursor.executemany(
+                """INSERT INTO hash_chunks (layout, chunk_index, chunk_value, image_name)
+                VALUES (?, ?, ?, ?)""",
+                [(layout, index, chunk, image_name) for index, chunk in enumerate(chunks)]
+            )
+
+    def find_hash_chunk_matches(self, layout, chunks):
+        """Imágenes que comparten al menos un trozo (en la misma posición) con chunks."""
+        if not chunks:
+            return []
+        try:
+            values = ", ".join(["(?, ?)"] * len(chunks))
+            params = [value for index, chunk in enumerate(chunks) for value in (index, chunk)]
+            self.cursor.execute(
+                f"""WITH query(chunk_index, chunk_value) AS (VALUES {values})
+                SELECT DISTINCT h.image_name FROM query
+                JOIN hash_chunks h
+                  ON h.layout = ?
+                 AND h.chunk_index = query.chunk_index
+                 AND h.chunk_value = query.chunk_value""",
+                params + [layout]
+            )
+            return [row[0] for row in self.cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error querying hash index: {e}")
+            return []
+
+    def find_image_by_digest(self, digest):
+        """Nombre de la imagen registrada con ese SHA-256, o None."""
+        try:
+            self.cursor.execute(
+                "SELECT image_name FROM image_digests WHERE digest = ?",
+                (digest,)
+            )
+            row = self.cursor.fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Error checking image digest: {e}")
+            return None
+
+    def add_image_digest(self, digest, image_name):
+        with self.transaction():
+            self.cursor.execute(
+                "INSERT OR IGNORE INTO image_digests (digest, image_name) VALUES (?, ?)",
+                (digest, image_name)
+            )
+
+    def add_region_signature(self, image_name, side, signature, view="full"):
+        with self.transaction():
+            self.cursor.execute(
+                """INSERT OR REPLACE INTO region_signatures (image_name, view, side, signature)
+                VALUES (?, ?, ?, ?)""",
+                (image_name, view, side, signature)
+            )
+
+    def get_region_signature(self, image_name, view="full"):
+        """Devuelve (side, signature) de la imagen o None."""
+        try:
+            self.cursor.execute(
+                "SELECT side, signature FROM region_signatures WHERE image_name = ? AND view = ?",
+                (image_name, view)
+            )
+            return self.cursor.fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Error reading region signature: {e}")
+            return None
+
+    def get_cached_hashes(self, digest, hash_key):
+        try:
+            self.cursor.execute(
+                "SELECT hashes FROM hash_cache WHERE digest = ? AND hash_key = ?",
+                (digest, hash_key)
+            )
+            row = self.cursor.fetchone()
+            return json.loads(row[0]) if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Error reading hash cache: {e}")
+            return None
+
+    def add_cached_hashes(self, digest, hash_key, hashes):
+        with self.transaction():
+            self.cursor.execute(
+                """INSERT OR REPLACE INTO hash_cache (digest, hash_key, hashes)
+                VALUES (?, ?, ?)""",
+                (digest, hash_key, json.dumps(hashes))
+            )
+
+    def get_ocr_text(self, digest, processor):
+        try:
+            self.cursor.execute(
+                "SELECT text FROM ocr_cache WHERE digest = ? AND processor = ?",
+                (digest, processor)
+            )
+            row = self.cursor.fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Error reading OCR cache: {e}")
+            return None
+
+    def add_ocr_text(self, digest, processor, text):
+        with self.transaction():
+            self.cursor.execute(
+                """INSERT OR REPLACE INTO ocr_cache (digest, processor, text)
+                VALUES (?, ?, ?)""",
+                (digest, processor, text)
+            )
+
+    def get_llm_response(self, cache_key, ttl_seconds):
+        """Respuesta guardada si tiene menos de ttl_seconds; marca su último uso."""
+        try:
+            self.cursor.execute(
+                """SELECT response FROM llm_cache
+                WHERE cache_key = ? AND created_date >= datetime('now', ?)""",
+                (cache_key, f"-{int(ttl_seconds)} seconds")
+            )
+            row = self.cursor.fetchone()
+            if row:
+                with self.transaction():
+                    self.cursor.execute(
+                        "UPDATE llm_cache SET last_used = CURRENT_TIMESTAMP WHERE cache_key = ?",
+                        (cache_key,)
+                    )
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Error reading LLM cache: {e}")
+            return None
+
+    def add_llm_response(self, cache_key, model, response, ttl_seconds, max_entries):
+        """Guarda la respuesta y quita las caducadas y las menos usadas por encima de max_entries."""
+        with self.transaction():
+            self.cursor.execute(
+                """INSERT OR REPLACE INTO llm_cache (cache_key, model, response)
+                VALUES (?, ?, ?)""",
+                (cache_key, model, response)
+            )
+            self.cursor.execute(
+                "DELETE FROM llm_cache WHERE created_date < datetime('now', ?)",
+                (f"-{int(ttl_seconds)} seconds",)
+            )
+            self.cursor.execute(
+                """DELETE FROM llm_cache WHERE cache_key NOT IN (
+                    SELECT cache_key FROM llm_cache ORDER BY last_used DESC, rowid DESC LIMIT ?
+                )""",
+                (max_entries,)
+            )
+
     def is_hash_processed(self, phash):
         try:
             self.cursor.execute(
@@ -144,6 +470,74 @@ class DatabaseManager:
             logger.error(f"Error checking downloaded image: {e}")
             return False
 
+    def find_seen_media(self, photo_id, origin_channel_id, origin_message_id):
+        """
+        Busca una foto ya vista por su id de Telegram o por el mensaje
+        original del que se reenvió. Devuelve (channel_id, message_id) o None.
+        """
+        try:
+            self.cursor.execute(
+                """SELECT channel_id, message_id FROM seen_media
+                WHERE photo_id = ?
+                   OR (origin_channel_id = ? AND origin_message_id = ?)
+                LIMIT 1""",
+                (photo_id, origin_channel_id, origin_message_id)
+            )
+            return self.cursor.fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Error checking seen media: {e}")
+            return None
+
+    def mark_media_seen(self, photo_id, origin_channel_id, origin_message_id, channel_id, message_id):
+        with self.transaction():
+            self.cursor.execute(
+                """INSERT INTO seen_media
+                (photo_id, origin_channel_id, origin_message_id, channel_id, message_id)
+                VALUES (?, ?, ?, ?, ?)""",
+                (photo_id, origin_channel_id, origin_message_id, str(channel_id), message_id)
+            )
+
+    def get_channel_cursor(self, channel_id):
+        try:
+            self.cursor.execute(
+                "SELECT last_message_id FROM channel_cursors WHERE channel_id = ?",
+                (str(channel_id),)
+            )
+            row = self.cursor.fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Error reading channel cursor: {e}")
+            return None
+
+    def update_channel_cursor(self, channel_id, last_message_id):
+        """Avanza el cursor del canal; nunca lo hace retroceder."""
+        with self.transaction():
+            self.cursor.execute(
+                """INSERT INTO channel_cursors (channel_id, last_message_id)
+                VALUES (?, ?)
+                ON CONFLICT(channel_id) DO UPDATE SET
+                    last_message_id = MAX(last_message_id, excluded.last_message_id),
+                    updated_date = CURRENT_TIMESTAMP""",
+                (str(channel_id), int(last_message_id))
+            )
+
+    def record_download_failure(self, channel_id, message_id):
+        """Suma un intento fallido de descarga del mensaje y devuelve cuántos lleva."""
+        with self.transaction():
+            self.cursor.execute(
+                """INSERT INTO download_failures (channel_id, message_id, attempts)
+                VALUES (?, ?, 1)
+                ON CONFLICT(channel_id, message_id) DO UPDATE SET
+                    attempts = attempts + 1,
+                    updated_date = CURRENT_TIMESTAMP""",
+                (str(channel_id), int(message_id))
+            )
+            self.cursor.execute(
+                "SELECT attempts FROM download_failures WHERE channel_id = ? AND message_id = ?",
+                (str(channel_id), int(message_id))
+            )
+            return self.cursor.fetchone()[0]
+
     def add_event_title(self, title):
         with self.transaction():
             self.cursor.execute(
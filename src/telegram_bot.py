@@ -1,9 +1,12 @@
+import asyncio
 import json
 import logging
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
-from telethon import TelegramClient
+from telethon import TelegramClient, events
+from telethon.errors import FloodWaitError
+from telethon.utils import get_peer_id
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +21,14 @@ class TelegramBot:
         channels,  # Lista de diccionarios {id, name}
         start_date=None,
         max_posters_per_day=50,
+        max_concurrent_channels=4,
+        max_downloads_per_channel=2,
+        max_concurrent_downloads=8,
+        max_flood_retries=3,
+        initial_lookback_days=1,
+        skip_seen_media=True,
+        ocr_min_long_edge=0,
+        max_download_attempts=3,
     ):
         self.client = TelegramClient(session_file, api_id, api_hash)
         self.phone = phone
@@ -29,7 +40,20 @@ class TelegramBot:
             else None
         )
         self.max_posters_per_day = max_posters_per_day
+        self.max_concurrent_channels = max(1, max_concurrent_channels)
+        self.max_downloads_per_channel = max(1, max_downloads_per_channel)
+        self.max_concurrent_downloads = max(1, max_concurrent_downloads)
+        self.max_flood_retries = max_flood_retries
+        self.initial_lookback_days = initial_lookback_days
+        self.skip_seen_media = skip_seen_media
+        self.ocr_min_long_edge = ocr_min_long_edge
+        self.max_download_attempts = max(1, max_download_attempts)
         self._is_started = False
+        self._daily_counts = {}
+        self._flood_until = 0.0
+        self._download_semaphore = None
+        self._stalled_channels = set()
+        self._claimed_media = set()
 
     async def start(self):
         """Iniciar el cliente de Telegram."""
@@ -53,6 +77,128 @@ class TelegramBot:
                 logger.error(f"Error stopping TelegramClient: {e}")
                 raise
 
+    def _register_flood_wait(self, seconds):
+        """Pausar todas las tareas hasta que expire el FloodWait de Telegram."""
+        loop = asyncio.get_running_loop()
+        self._flood_until = max(self._flood_until, loop.time() + seconds + 1)
+        logger.warning(f"FloodWaitError: pausing Telegram requests for {seconds}s")
+
+    async def _wait_for_flood(self):
+        delay = self._flood_until - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _call_with_flood_wait(self, func, *args, **kwargs):
+        """Ejecutar una llamada a Telegram reintentando tras un FloodWaitError."""
+        attempt = 0
+        while True:
+            await self._wait_for_flood()
+            try:
+                return await func(*args, **kwargs)
+            except FloodWaitError as e:
+                self._register_flood_wait(e.seconds)
+                attempt += 1
+                if attempt > self.max_flood_retries:
+                    raise
+
+    def _reserve_daily_slot(self, date_key):
+        """
+        Reservar un hueco del límite diario antes de lanzar la descarga.
+        Al ejecutarse sin await entre la comprobación y el incremento,
+        las tareas concurrentes no pueden superar max_posters_per_day.
+        """
+        count = self._daily_counts.get(date_key, 0)
+        if count >= self.max_posters_per_day:
+            return False
+        self._daily_counts[date_key] = count + 1
+        return True
+
+    def _prune_daily_counts(self):
+        """
+        Olvidar los días que ya no se recorren: sin esto, en el daemon los
+        contadores de cada día se acumularían mientras viva el proceso.
+        """
+        oldest = datetime.now(timezone.utc) - timedelta(days=max(1, self.initial_lookback_days))
+        oldest_key = oldest.strftime("%Y-%m-%d")
+        self._daily_counts = {
+            date_key: count for date_key, count in self._daily_counts.items()
+            if date_key >= oldest_key
+        }
+
+    def _release_daily_slot(self, date_key):
+        if self._daily_counts.get(date_key, 0) > 0:
+            self._daily_counts[date_key] -= 1
+
+    def _give_up_download(self, channel, message_ids):
+        """
+        Anotar un intento fallido de descarga del mensaje (el primero de
+        message_ids). Tras max_download_attempts se da por perdido y se marca
+        como descargado para que no vuelva a frenar el cursor del canal.
+        Devuelve True si se ha dado por perdido.
+        """
+        primary_id = min(message_ids)
+        attempts = self.db_manager.record_download_failure(channel['id'], primary_id)
+        if attempts < self.max_download_attempts:
+            return False
+        logger.warning(
+            f"Giving up on message {primary_id} from {channel['name']} "
+            f"after {attempts} failed downloads"
+        )
+        for message_id in message_ids:
+            self.db_manager.mark_image_as_downloaded(str(message_id))
+        return True
+
+    def _media_keys(self, message):
+        """
+        Identificadores de una foto independientes del canal que la publica:
+        el id de la foto en Telegram y el mensaje original (canal, id) del que
+        procede si es un reenvío, o el propio mensaje si no lo es.
+        """
+        fwd = message.fwd_from
+        if fwd and fwd.from_id and fwd.channel_post:
+            return message.photo.id, get_peer_id(fwd.from_id), fwd.channel_post
+        return message.photo.id, message.chat_id, message.id
+
+    def _claim_keys(self, message):
+        photo_id, origin_channel_id, origin_message_id = self._media_keys(message)
+        return {("photo", photo_id), ("origin", origin_channel_id, origin_message_id)}
+
+    def _media_in_progress(self, message):
+        """
+        Si otra descarga de esta ejecución tiene reservada la misma foto. Ese
+        mensaje no se puede dar por visto: si la otra descarga falla, hay que
+        reintentarlo.
+        """
+        return self.skip_seen_media and bool(self._claim_keys(message) & self._claimed_media)
+
+    def _claim_media(self, message, channel_name):
+        """
+        Reservar una foto para descargarla. Devuelve False si ya se vio antes
+        en la base de datos (comprobar antes _media_in_progress).
+        """
+        if not self.skip_seen_media:
+            return True
+        photo_id, origin_channel_id, origin_message_id = self._media_keys(message)
+        keys = self._claim_keys(message)
+        seen = self.db_manager.find_seen_media(photo_id, origin_channel_id, origin_message_id)
+        if seen:
+            logger.info(
+                f"Skipping already seen media {photo_id} from {channel_name} "
+                f"(message {message.id}, first seen: {seen})"
+            )
+            return False
+        self._claimed_media.update(keys)
+        return True
+
+    def _release_media(self, message):
+        photo_id, origin_channel_id, origin_message_id = self._media_keys(message)
+        self._claimed_media.discard(("photo", photo_id))
+        self._claimed_media.discard(("origin", origin_channel_id, origin_message_id))
+
+    def _ensure_download_semaphore(self):
+        if self._download_semaphore is None:
+            self._download_semaphore = asyncio.Semaphore(self.max_concurrent_downloads)
+
     async def download_images(self, image_folder):
         """Descargar imágenes de los canales configurados."""
         if not self._is_started:
@@ -60,75 +206,362 @@ class TelegramBot:
 
         image_folder_path = Path(image_folder)
         image_folder_path.mkdir(parents=True, exist_ok=True)
-        new_images_downloaded = 0
-        daily_counts = {}
+        # _daily_counts no se reinicia: en el daemon cada resync debe respetar
+        # lo ya descargado ese día por el listener y por resyncs anteriores
+        self._prune_daily_counts()
+        self._ensure_download_semaphore()
+        channel_semaphore = asyncio.Semaphore(self.max_concurrent_channels)
 
-        for channel in self.channels:
-            channel_id = channel['id']
-            channel_name = channel['name']
-            try:
-                entity = await self.client.get_entity(int(channel_id))
-                logger.info(f"Processing channel: {channel_name} (ID: {channel_id})")
-
-                async for message in self.client.iter_messages(
-                    entity, reverse=True, offset_date=self.start_date
-                ):
-                    if self.start_date and message.date < self.start_date:
-                        break
-
-                    date_key = message.date.strftime("%Y-%m-%d")
-                    if date_key not in daily_counts:
-                        daily_counts[date_key] = 0
-
-                    if daily_counts[date_key] >= self.max_posters_per_day:
-                        logger.info(f"Reached max posters limit for {date_key}")
-                        continue
-
-                    if message.photo:
-                        message_id = str(message.id)
-                        if not self.db_manager.is_image_downloaded(message_id):
-                            try:
-                                file_path = image_folder_path / f"{channel_id}_{message_id}.jpg"
-                                await message.download_media(file=str(file_path))
-                                logger.info(f"New image saved to {file_path}")
-
-                                # Guardar metadata y caption
-                                metadata = {
-                                    "text": message.text or "",
-                                    "channel_name": channel_name,
-                                    "channel_id": channel_id,
-                                    "source": "Generado automáticamente via CalGen Bot",
-                                    "date": message.date.isoformat()
-                                }
-                                
-                                metadata_file_path = (
-                                    image_folder_path / f"{channel_id}_{message_id}.json"
-                                )
-                                with open(
-                                    metadata_file_path, "w", encoding="utf-8"
-                                ) as metadata_file:
-                                    json.dump(metadata, metadata_file, ensure_ascii=False, indent=2)
-
-                                self.db_manager.mark_image_as_downloaded(message_id)
-                                new_images_downloaded += 1
-                                daily_counts[date_key] += 1
-
-                                logger.debug(f"Saved metadata for image {message_id} from channel {channel_name}")
-
-                            except Exception as e:
-                                logger.error(f"Error downloading image from {channel_name}: {e}")
-                        else:
-                            logger.debug(f"Image {message_id} from {channel_name} already downloaded")
+        async def process_channel(channel):
+            async with channel_semaphore:
+                return await self._download_channel(channel, image_folder_path)
 
-            except Exception as e:
-                logger.error(f"Error processing channel {channel_name}: {e}")
+        results = await asyncio.gather(
+            *(process_channel(channel) for channel in self.channels)
+        )
+        new_images_downloaded = sum(results)
 
         logger.info(f"Total new images downloaded: {new_images_downloaded}")
         return new_images_downloaded
 
+    async def _download_channel(self, channel, image_folder_path):
+        """
+        Recorrer un canal y lanzar sus descargas con concurrencia limitada.
+
+        Si no hay start_date explícito, solo se piden los mensajes posteriores
+        al cursor guardado del canal (min_id). Sin cursor previo se recorre
+        la ventana de initial_lookback_days. Los mensajes de un mismo álbum
+        (grouped_id) se agrupan en un único cartel. Los carteles que superan
+        max_posters_per_day se saltan: no frenan el cursor.
+        """
+        channel_id = channel['id']
+        channel_name = channel['name']
+        channel_slots = asyncio.Semaphore(self.max_downloads_per_channel)
+        scheduled = {}
+        tasks = []
+
+        cursor = None if self.start_date else self.db_manager.get_channel_cursor(channel_id)
+        if cursor:
+            window_start = None
+            iter_kwargs = {"min_id": cursor}
+        else:
+            window_start = self.start_date or (
+                datetime.now(timezone.utc) - timedelta(days=self.initial_lookback_days)
+            )
+            iter_kwargs = {"offset_date": window_start}
+        last_seen_id = cursor or 0
+        # Mensajes con la foto reservada por otra descarga en curso
+        in_progress_ids = []
+
+        async def schedule(messages):
+            photos = [message for message in messages if message.photo]
+            if not photos:
+                return
+
+            message_id = str(photos[0].id)
+            if self.db_manager.is_image_downloaded(message_id):
+                logger.debug(f"Image {message_id} from {channel_name} already downloaded")
+                return
+            if self._media_in_progress(photos[0]):
+                logger.info(
+                    f"Media of message {message_id} from {channel_name} is being downloaded "
+                    "by another task, retrying it later"
+                )
+                in_progress_ids.append(photos[0].id)
+                return
+            if not self._claim_media(photos[0], channel_name):
+                self.db_manager.mark_image_as_downloaded(message_id)
+                return
+
+            date_key = photos[0].date.strftime("%Y-%m-%d")
+            if not self._reserve_daily_slot(date_key):
+                logger.info(f"Reached max posters limit for {date_key}, skipping message {photos[0].id}")
+                self._release_media(photos[0])
+                return
+
+            await channel_slots.acquire()
+            task = asyncio.create_task(
+                self._download_post(
+                    messages, channel, image_folder_path, date_key, channel_slots
+                )
+            )
+            for message in messages:
+                scheduled[message.id] = task
+            tasks.append(task)
+
+        try:
+            entity = await self._call_with_flood_wait(self.client.get_entity, int(channel_id))
+            logger.info(f"Processing channel: {channel_name} (ID: {channel_id})")
+
+            attempt = 0
+            while True:
+                await self._wait_for_flood()
+                album = []
+                try:
+                    async for message in self.client.iter_messages(
+                        entity, reverse=True, **iter_kwargs
+                    ):
+                        if window_start and message.date < window_start:
+                            break
+
+                        last_seen_id = max(last_seen_id, message.id)
+                        if album and message.grouped_id != album[0].grouped_id:
+                            await schedule(album)
+                            album = []
+
+                        if message.id in scheduled:
+                            continue
+                        if message.grouped_id:
+                            album.append(message)
+                        elif message.photo:
+                            await schedule([message])
+
+                    if album:
+                        await schedule(album)
+                    break
+                except FloodWaitError as e:
+                    # Reanudar el recorrido; los mensajes ya programados se saltan
+                    self._register_flood_wait(e.seconds)
+                    attempt += 1
+                    if attempt > self.max_flood_retries:
+                        raise
+
+        except Exception as e:
+            logger.error(f"Error processing channel {channel_name}: {e}")
+
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        failed_ids = list(in_progress_ids)
+        messages_by_task = {}
+        for message_id, task in scheduled.items():
+            messages_by_task.setdefault(task, []).append(message_id)
+        for task, message_ids in messages_by_task.items():
+            if task.cancelled() or task.exception() or not task.result():
+                # Los fallos permanentes dejan de frenar el cursor tras varios intentos
+                if not self._give_up_download(channel, message_ids):
+                    failed_ids.extend(message_ids)
+        # El cursor no debe saltarse mensajes que hay que reintentar
+        new_cursor = min(failed_ids) - 1 if failed_ids else last_seen_id
+        if new_cursor > (cursor or 0):
+            try:
+                self.db_manager.update_channel_cursor(channel_id, new_cursor)
+                logger.debug(f"Cursor for {channel_name} advanced to {new_cursor}")
+            except Exception as e:
+                logger.error(f"Error updating cursor for {channel_name}: {e}")
+        if not failed_ids:
+            self._stalled_channels.discard(str(channel_id))
+
+        return sum(1 for result in results if isinstance(result, Path))
+
+    def _select_photo_size(self, photo):
+        """
+        Elegir el tamaño más pequeño cuyo lado mayor alcance ocr_min_long_edge.
+        Con ocr_min_long_edge = 0 (o sin tamaños con dimensiones) se descarga
+        el mayor, como hace Telethon por defecto.
+        """
+        if not self.ocr_min_long_edge:
+            return None
+        sizes = [
+            size for size in getattr(photo, "sizes", None) or []
+            if getattr(size, "w", None) and getattr(size, "h", None)
+        ]
+        if not sizes:
+            return None
+        sizes.sort(key=lambda size: max(size.w, size.h))
+        for size in sizes:
+            if max(size.w, size.h) >= self.ocr_min_long_edge:
+                return size
+        return sizes[-1]
+
+    async def _download_photo(self, message, file_path, buffers=None):
+        """
+        Descargar la foto a memoria y escribirla una sola vez en disco.
+        Si se pasa buffers, los bytes se guardan ahí para que el pipeline
+        no tenga que volver a leer el archivo.
+        """
+        # Telethon solo reconoce algunos tipos de tamaño como objeto (no
+        # PhotoSizeProgressive, el mayor casi siempre); por su tipo ('y', 'x'...) sí
+        size = self._select_photo_size(message.photo)
+        thumb = size.type if size is not None else None
+        async with self._download_semaphore:
+            data = await self._call_with_flood_wait(
+                message.download_media, file=bytes, thumb=thumb
+            )
+        if not data:
+            raise ValueError(f"Empty download for message {message.id}")
+        with open(file_path, "wb") as image_file:
+            image_file.write(data)
+        if buffers is not None:
+            buffers[file_path.name] = data
+        logger.info(f"New image saved to {file_path} ({len(data)} bytes)")
+        return file_path
+
+    async def _download_post(
+        self, messages, channel, image_folder_path, date_key, channel_slots, buffers=None
+    ):
+        """
+        Descargar las fotos de un mensaje o álbum y guardar una sola metadata.
+
+        La primera foto da nombre al cartel; el resto del álbum se lista en
+        metadata["album"] para que se procese como un único trabajo.
+        Devuelve la ruta de la primera foto o None.
+        """
+        channel_id = channel['id']
+        channel_name = channel['name']
+        photos = [message for message in messages if message.photo]
+        primary = photos[0]
+        message_id = str(primary.id)
+        try:
+            results = await asyncio.gather(
+                *(
+                    self._download_photo(
+                        message, image_folder_path / f"{channel_id}_{message.id}.jpg", buffers
+                    )
+                    for message in photos
+                ),
+                return_exceptions=True,
+            )
+            if isinstance(results[0], BaseException):
+                raise results[0]
+            file_path = results[0]
+
+            album_files = []
+            for message, result in zip(photos[1:], results[1:]):
+                if isinstance(result, BaseException):
+                    logger.error(f"Error downloading album image {message.id} from {channel_name}: {result}")
+                else:
+                    album_files.append(result.name)
+
+            # Guardar metadata y caption (en un álbum, el primer texto no vacío)
+            metadata = {
+                "text": next((message.text for message in messages if message.text), ""),
+                "channel_name": channel_name,
+                "channel_id": channel_id,
+                "source": "Generado automáticamente via CalGen Bot",
+                "date": primary.date.isoformat()
+            }
+            if album_files:
+                metadata["album"] = album_files
+
+            metadata_file_path = image_folder_path / f"{channel_id}_{message_id}.json"
+            with open(metadata_file_path, "w", encoding="utf-8") as metadata_file:
+                json.dump(metadata, metadata_file, ensure_ascii=False, indent=2)
+
+            for message in photos:
+                self.db_manager.mark_image_as_downloaded(str(message.id))
+                if self.skip_seen_media:
+                    self.db_manager.mark_media_seen(
+                        *self._media_keys(message), channel_id, message.id
+                    )
+            logger.debug(f"Saved metadata for image {message_id} from channel {channel_name}")
+            return file_path
+        except Exception as e:
+            self._release_daily_slot(date_key)
+            self._release_media(primary)
+            logger.error(f"Error downloading image from {channel_name}: {e}")
+            return None
+        finally:
+            channel_slots.release()
+
+    def listen(self, image_folder, on_image):
+        """
+        Registrar handlers de NewMessage y Album para los canales configurados.
+
+        Cada cartel nuevo se descarga al momento y su ruta se entrega a la
+        corrutina on_image(file_path, buffers), donde buffers contiene los
+        bytes ya descargados de cada foto por nombre de archivo. Si una descarga falla, el cursor de
+        ese canal deja de avanzar hasta el siguiente download_images.
+
+        Telethon ejecuta los handlers a la vez, así que el cursor solo avanza
+        hasta justo antes del mensaje más antiguo que sigue en curso en ese
+        canal: un mensaje posterior que termina antes no puede saltarse uno
+        anterior cuya descarga todavía puede fallar.
+        """
+        image_folder_path = Path(image_folder)
+        image_folder_path.mkdir(parents=True, exist_ok=True)
+        self._ensure_download_semaphore()
+        channels_by_id = {int(channel['id']): channel for channel in self.channels}
+        channel_slots = {
+            chat_id: asyncio.Semaphore(self.max_downloads_per_channel)
+            for chat_id in channels_by_id
+        }
+        in_flight = {chat_id: set() for chat_id in channels_by_id}
+        completed = {chat_id: 0 for chat_id in channels_by_id}
+
+        async def handle_post(chat_id, messages):
+            channel = channels_by_id.get(chat_id)
+            if channel is None:
+                return
+            message_ids = {message.id for message in messages}
+            in_flight[chat_id].update(message_ids)
+            try:
+                succeeded = await download_post(channel, messages)
+            finally:
+                in_flight[chat_id].difference_update(message_ids)
+
+            channel_key = str(channel['id'])
+            if not succeeded:
+                self._stalled_channels.add(channel_key)
+                return
+            completed[chat_id] = max(completed[chat_id], max(message_ids))
+            if channel_key not in self._stalled_channels:
+                # Solo hasta los mensajes terminados sin huecos por detrás
+                pending = in_flight[chat_id]
+                cursor = min(pending) - 1 if pending else completed[chat_id]
+                cursor = min(cursor, completed[chat_id])
+                if cursor > 0:
+                    self.db_manager.update_channel_cursor(channel['id'], cursor)
+
+        async def download_post(channel, messages):
+            """Descarga y entrega el cartel; devuelve False si hay que reintentarlo."""
+            photos = [message for message in messages if message.photo]
+
+            if (
+                photos
+                and not self.db_manager.is_image_downloaded(str(photos[0].id))
+                and self._media_in_progress(photos[0])
+            ):
+                # Si la otra descarga falla, el resync tiene que volver a él
+                return False
+            if (
+                photos
+                and not self.db_manager.is_image_downloaded(str(photos[0].id))
+                and self._claim_media(photos[0], channel['name'])
+            ):
+                date_key = photos[0].date.strftime("%Y-%m-%d")
+                if not self._reserve_daily_slot(date_key):
+                    logger.info(f"Reached max posters limit for {date_key}, skipping message {photos[0].id}")
+                    self._release_media(photos[0])
+                    return True
+
+                slots = channel_slots[int(channel['id'])]
+                await slots.acquire()
+                buffers = {}
+                file_path = await self._download_post(
+                    messages, channel, image_folder_path, date_key, slots, buffers
+                )
+                if file_path is None:
+                    return self._give_up_download(channel, [message.id for message in messages])
+                await on_image(file_path, buffers)
+            return True
+
+        async def on_new_message(event):
+            await handle_post(event.chat_id, [event.message])
+
+        async def on_album(event):
+            await handle_post(event.chat_id, list(event.messages))
+
+        chats = list(channels_by_id)
+        self.client.add_event_handler(
+            on_new_message,
+            events.NewMessage(chats=chats, func=lambda e: e.message.grouped_id is None),
+        )
+        self.client.add_event_handler(on_album, events.Album(chats=chats))
+        logger.info(f"Listening for new messages in {len(channels_by_id)} channels")
+
     async def __aenter__(self):
         await self.start()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.stop()
\ No newline at end of file
+        await self.stop()
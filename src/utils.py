@@ -1,7 +1,13 @@
+import hashlib
+import io
 import json
 import logging
 import re
 import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
 
@@ -9,7 +15,7 @@ import numpy as np
 import requests
 import yaml
 from dateutil.rrule import rrulestr
-from PIL import Image
+from PIL import Image, ImageChops
 
 logger = logging.getLogger(__name__)
 
@@ -57,48 +63,557 @@ from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+
+def open_image(image):
+    """Abre una imagen desde una ruta o desde sus bytes ya cargados en memoria."""
+    if isinstance(image, (bytes, bytearray)):
+        return Image.open(io.BytesIO(image))
+    return Image.open(image)
+
+
+# Número de bits a 1 de cada byte, para contar distancias Hamming sobre
+# hashes empaquetados con np.packbits.
+POPCOUNT_TABLE = np.unpackbits(
+    np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1
+).sum(axis=1).astype(np.uint8)
+
+
+def pack_hash(bits):
+    """Empaqueta un array de booleanos en un array uint8 (8 bits por byte)."""
+    return np.packbits(np.asarray(bits, dtype=bool).flatten())
+
+
+def hash_to_hex(packed_hash):
+    return packed_hash.tobytes().hex()
+
+
+def hash_from_string(value):
+    """
+    Convierte un hash guardado en hexadecimal a su forma empaquetada.
+    Las cadenas antiguas de '0'/'1' las convierte la migración a user_version 1;
+    aquí no se intentan reconocer, porque un hexadecimal de solo ceros y unos
+    (el phash de un cartel liso, por ejemplo) es indistinguible de ellas.
+    """
+    if isinstance(value, np.ndarray):
+        return value
+    return np.frombuffer(bytes.fromhex(value), dtype=np.uint8)
+
+
+def content_digest(image):
+    """SHA-256 del contenido de una imagen (ruta o bytes), leyendo por bloques."""
+    if isinstance(image, (bytes, bytearray)):
+        return hashlib.sha256(image).hexdigest()
+    digest = hashlib.sha256()
+    with open(image, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def reduce_for_decode(img, size, mode):
+    """
+    Reduce la imagen al decodificarla cuando solo hace falta una versión
+    pequeña: en JPEG con draft (escalado 1/2, 1/4 o 1/8 en el dominio DCT,
+    sin decodificar la imagen completa) y en otros formatos con reduce().
+    Se deja margen sobre size (el doble en JPEG, ocho veces con reduce(),
+    que promedia por bloques) para que el resize final dé casi los mismos
+    hashes que desde la imagen completa.
+    """
+    if img.format == "JPEG":
+        img.draft(mode, (size[0] * 2, size[1] * 2))
+        return img
+    factor = min(img.width // (size[0] * 8), img.height // (size[1] * 8))
+    if factor >= 2:
+        return img.reduce(factor)
+    return img
+
+
+def compute_image_hashes(image, hash_size, fast_decode=False):
+    """
+    Calcula phash, ahash y ghash de una imagen (ruta o bytes). Función de
+    módulo para poder ejecutarla también en otros procesos. Con fast_decode
+    solo se decodifica la resolución que necesitan los hashes.
+    """
+    with open_image(image) as img:
+        if fast_decode:
+            img = reduce_for_decode(img, (hash_size + 1, hash_size), "L")
+
+        # Convertir a escala de grises
+        img_gray = img.convert("L")
+
+        # Para phash, redimensionar a (hash_size+1, hash_size)
+        img_resized = img_gray.resize((hash_size + 1, hash_size), Image.LANCZOS)
+        pixels = np.array(img_resized)
+        diff = pixels[:, 1:] > pixels[:, :-1]
+        phash = pack_hash(diff)
+
+        # Hash de media (ahash)
+        img_tiny = img_gray.resize((8, 8), Image.LANCZOS)
+        pixels = np.array(img_tiny)
+        mean = pixels.mean()
+        ahash = pack_hash(pixels > mean)
+
+        # Hash de gradiente (ghash)
+        gradient = np.gradient(pixels)[0]
+        ghash = pack_hash(gradient > 0)
+
+        return {
+            "phash": phash,
+            "ahash": ahash,
+            "ghash": ghash
+        }
+
+
+# Matriz de la DCT-II de 32 puntos para el pHash clásico
+DCT_SIZE = 32
+DCT_MATRIX = np.cos(
+    np.pi * np.outer(np.arange(DCT_SIZE), 2 * np.arange(DCT_SIZE) + 1) / (2 * DCT_SIZE)
+)
+
+# Fracción de la imagen que se queda el recorte central
+CENTER_CROP = 0.6
+
+# Vista de la imagen sobre la que se calcula cada clave robusta, y tamaño
+# de cada clave
+ROBUST_KEY_VIEWS = {"trim": "trim", "center": "center", "dct": "full"}
+ROBUST_KEY_BYTES = 8
+
+
+def trim_borders(img, tolerance=16, max_passes=3):
+    """
+    Recorta los bordes uniformes (bandas negras, marcos de captura de
+    pantalla) comparando con el color de la esquina superior izquierda.
+    Se repite para quitar también el fondo del cartel que queda dentro de
+    la banda, de modo que el original y la copia con bandas acaben en el
+    mismo recorte.
+    """
+    for _ in range(max_passes):
+        gray = img.convert("L")
+        background = Image.new("L", gray.size, gray.getpixel((0, 0)))
+        mask = ImageChops.difference(gray, background).point(lambda p: 255 if p > tolerance else 0)
+        bbox = mask.getbbox()
+        if not bbox or bbox == (0, 0, img.width, img.height) \
+                or (bbox[2] - bbox[0]) < img.width // 4 or (bbox[3] - bbox[1]) < img.height // 4:
+            break
+        img = img.crop(bbox)
+    return img
+
+
+def image_view(img, view):
+    """La imagen completa ("full"), sin bordes ("trim") o su centro ("center")."""
+    if view == "trim":
+        return trim_borders(img)
+    if view == "center":
+        img = trim_borders(img)
+        margin_x = int(img.width * (1 - CENTER_CROP) / 2)
+        margin_y = int(img.height * (1 - CENTER_CROP) / 2)
+        return img.crop((margin_x, margin_y, img.width - margin_x, img.height - margin_y))
+    return img
+
+
+def difference_hash(img_gray):
+    """Hash de diferencias de 64 bits (9x8 píxeles)."""
+    pixels = np.array(img_gray.resize((9, 8), Image.LANCZOS))
+    return pack_hash(pixels[:, 1:] > pixels[:, :-1])
+
+
+def dct_hash(img_gray):
+    """pHash de 64 bits: coeficientes de baja frecuencia de la DCT frente a su mediana."""
+    pixels = np.array(img_gray.resize((DCT_SIZE, DCT_SIZE), Image.LANCZOS), dtype=np.float64)
+    coefficients = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:8, :8]
+    return pack_hash(coefficients > np.median(coefficients.ravel()[1:]))
+
+
+def compute_robust_keys(image, fast_decode=False):
+    """
+    Claves de 64 bits resistentes a recortes y reescalados: hash de
+    diferencias de la imagen sin bordes y de su recorte central, y pHash por
+    DCT de la imagen completa.
+    """
+    with open_image(image) as img:
+        if fast_decode:
+            img = reduce_for_decode(img, (DCT_SIZE * 2, DCT_SIZE * 2), "L")
+        img_gray = img.convert("L")
+        return {
+            "trim": difference_hash(image_view(img_gray, "trim")),
+            "center": difference_hash(image_view(img_gray, "center")),
+            "dct": dct_hash(img_gray),
+        }
+
+
+def region_thumbnail(image, side, fast_decode=False, view="full"):
+    """Miniatura RGB side x side (uint8) sobre la que se comparan las regiones."""
+    with open_image(image) as img:
+        if fast_decode:
+            img = reduce_for_decode(img, (side, side), "RGB")
+        img = image_view(img.convert("RGB"), view)
+        return np.array(img.resize((side, side), Image.BILINEAR))
+
+
+def region_features(thumbnail, grid_size):
+    """
+    Características de cada celda de la cuadrícula a partir de la miniatura:
+    los píxeles, el histograma normalizado (64 bins) y los gradientes en
+    escala de grises. Todo como vistas por bloques de forma
+    (grid_size, grid_size, ...), para comparar todas las celdas a la vez.
+    """
+    side = thumbnail.shape[0]
+    cell = side // grid_size
+    blocks = thumbnail.reshape(grid_size, cell, grid_size, cell, 3).swapaxes(1, 2)
+
+    # Histograma por celda con un único bincount (mismos bins que
+    # np.histogram(bins=64, range=(0, 255)))
+    bins = np.minimum(blocks.astype(np.int32) * 64 // 255, 63)
+    cell_ids = np.arange(grid_size * grid_size).reshape(grid_size, grid_size, 1, 1, 1)
+    hist = np.bincount(
+        (cell_ids * 64 + bins).ravel(), minlength=grid_size * grid_size * 64
+    ).reshape(grid_size, grid_size, 64).astype(np.float32)
+    hist /= cell * cell * 3
+
+    gray = blocks.mean(axis=4, dtype=np.float32)
+    return {
+        "thumbnail": thumbnail,
+        "blocks": blocks,
+        "hist": hist,
+        "grad_x": np.gradient(gray, axis=2),
+        "grad_y": np.gradient(gray, axis=3),
+    }
+
+
+class HashCache:
+    """
+    Caché de hashes indexada por el contenido de la imagen (SHA-256).
+
+    Un LRU acotado en memoria delante de la tabla hash_cache de SQLite: una
+    misma imagen solo se decodifica y se hashea una vez, aunque llegue con
+    otro nombre o en otra ejecución. Sin db_manager funciona solo en memoria.
+    """
+
+    def __init__(self, db_manager=None, max_entries=1024):
+        self.db_manager = db_manager
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest, hash_key):
+        key = (digest, hash_key)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+        if self.db_manager is not None:
+            stored = self.db_manager.get_cached_hashes(digest, hash_key)
+            if stored:
+                hashes = {h_type: hash_from_string(value) for h_type, value in stored.items()}
+                self._remember(key, hashes)
+                self.hits += 1
+                return hashes
+
+        self.misses += 1
+        return None
+
+    def put(self, digest, hash_key, hashes):
+        self._remember((digest, hash_key), hashes)
+        if self.db_manager is not None:
+            self.db_manager.add_cached_hashes(
+                digest, hash_key,
+                {h_type: hash_to_hex(value) for h_type, value in hashes.items()}
+            )
+
+    def _remember(self, key, hashes):
+        self._entries[key] = hashes
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class TokenBucket:
+    """
+    Límite de ritmo por minuto (peticiones o tokens) compartido entre hilos.
+    Se llena a rate_per_minute / 60 por segundo hasta rate_per_minute;
+    acquire espera hasta que haya saldo y consume puede dejarlo en negativo
+    para cobrar después lo que se gastó de más.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        """Espera hasta poder consumir amount (como mucho la capacidad del cubo)."""
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def consume(self, amount):
+        with self._lock:
+            self._refill()
+            self.tokens -= amount
+
+
+class HashMatrix:
+    """
+    Hashes empaquetados de varias imágenes apilados por tipo, para calcular
+    la distancia Hamming ponderada contra todas ellas en una sola pasada.
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.keys = []
+        # Posición de cada clave, para que `in` no recorra la lista
+        self._positions = {}
+        self._rows = {h_type: [] for h_type in weights}
+        self._matrix = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def items(self):
+        """Pares (clave, hashes) de las imágenes de la matriz."""
+        for i, key in enumerate(self.keys):
+            yield key, {h_type: rows[i] for h_type, rows in self._rows.items()}
+
+    def add(self, key, hashes):
+        """Añade los hashes de una imagen. Ignora los de tamaño incompatible."""
+        if not hashes or any(h_type not in hashes for h_type in self.weights):
+            return False
+        if self.keys and any(
+            hashes[h_type].shape != self._rows[h_type][0].shape for h_type in self.weights
+        ):
+            return False
+        self._positions.setdefault(key, len(self.keys))
+        self.keys.append(key)
+        for h_type in self.weights:
+            self._rows[h_type].append(hashes[h_type])
+        self._matrix = None
+        return True
+
+    def distances(self, hashes):
+        """Distancia ponderada de hashes a cada imagen, en el orden de self.keys."""
+        if not self.keys:
+            return np.empty(0)
+        if self._matrix is None:
+            self._matrix = {h_type: np.vstack(rows) for h_type, rows in self._rows.items()}
+
+        total = np.zeros(len(self.keys))
+        for h_type, weight in self.weights.items():
+            matrix = self._matrix[h_type]
+            if hashes[h_type].shape != matrix.shape[1:]:
+                return np.full(len(self.keys), np.inf)
+            xor = np.bitwise_xor(matrix, hashes[h_type])
+            total += weight * POPCOUNT_TABLE[xor].sum(axis=1)
+        return total
+
+    def best_match(self, hashes):
+        """Devuelve (clave, distancia) de la imagen más parecida."""
+        distances = self.distances(hashes)
+        if not len(distances):
+            return None, float('inf')
+        index = int(np.argmin(distances))
+        return self.keys[index], float(distances[index])
+
+    def within(self, hashes, threshold):
+        """Lista de (clave, distancia) con distancia <= threshold, de menor a mayor."""
+        distances = self.distances(hashes)
+        indexes = np.flatnonzero(distances <= threshold)
+        indexes = indexes[np.argsort(distances[indexes], kind="stable")]
+        return [(self.keys[i], float(distances[i])) for i in indexes]
+
+
 class DuplicateDetector:
-    def __init__(self, config):
+    # Pesos de cada tipo de hash en la distancia ponderada
+    HASH_WEIGHTS = {"phash": 0.5, "ahash": 0.3, "ghash": 0.2}
+
+    def __init__(self, config, db_manager=None):
+        self.db_manager = db_manager
         self.hash_size = config.get("duplicate_detection", {}).get("hash_size", 16)
         self.similarity_threshold = config.get("duplicate_detection", {}).get("similarity_threshold", 4)
         self.region_threshold = config.get("duplicate_detection", {}).get("region_threshold", 30)
         self.grid_size = config.get("duplicate_detection", {}).get("grid_size", 4)
         self.min_differences = config.get("duplicate_detection", {}).get("min_differences", 1)
+        self.region_size = config.get("duplicate_detection", {}).get("region_size", 64)
+        self.region_cache_size = config.get("duplicate_detection", {}).get("region_cache_size", 256)
+        self._region_cache = OrderedDict()
+        self.hash_cache = HashCache(
+            db_manager,
+            config.get("duplicate_detection", {}).get("hash_cache_size", 1024)
+        )
+        self.hash_workers = config.get("duplicate_detection", {}).get("hash_workers")
+        self.fast_decode = config.get("duplicate_detection", {}).get("fast_decode", True)
+        self.robust_keys = config.get("duplicate_detection", {}).get("robust_keys", False)
+        self.robust_key_threshold = config.get("duplicate_detection", {}).get("robust_key_threshold", 12)
+        self.robust_key_min_matches = config.get("duplicate_detection", {}).get("robust_key_min_matches", 2)
+        # Las coincidencias por clave robusta se confirman con una cuadrícula
+        # más fina que la normal: con 2x2 un cartel de la misma plantilla y
+        # otro evento apenas cambia la media de cada celda
+        self.robust_key_grid_size = max(
+            config.get("duplicate_detection", {}).get("robust_key_grid_size", 8), self.grid_size
+        )
+        self.robust_key_min_differences = config.get("duplicate_detection", {}).get(
+            "robust_key_min_differences", 0
+        )
+        max_differences = self.grid_size * self.grid_size - 1
+        if self.min_differences > max_differences:
+            logger.warning(
+                f"min_differences ({self.min_differences}) no deja ninguna región para distinguir "
+                f"imágenes con grid_size {self.grid_size}; se usa {max_differences}"
+            )
+            self.min_differences = max_differences
+
+    @property
+    def hash_key(self):
+        """Identifica el algoritmo y tamaño de los hashes en la caché."""
+        return f"v1:{self.hash_size}:fast" if self.fast_decode else f"v1:{self.hash_size}"
 
     def calculate_image_hash(self, image_path):
         """
         Calcula múltiples hashes de la imagen usando diferentes métodos para mayor precisión.
+        Acepta una ruta o los bytes de la imagen. Cada hash es un array uint8
+        con los bits empaquetados. Los resultados se guardan en la caché por
+        contenido, así que cada imagen se decodifica una sola vez.
         """
         try:
-            with Image.open(image_path) as img:
-                # Convertir a escala de grises
-                img_gray = img.convert("L")
-
-                # Para phash, redimensionar a (hash_size+1, hash_size)
-                img_resized = img_gray.resize((self.hash_size + 1, self.hash_size), Image.LANCZOS)
-                pixels = np.array(img_resized)
-                diff = pixels[:, 1:] > pixels[:, :-1]
-                phash = "".join(["1" if d else "0" for d in diff.flatten()])
-
-                # Hash de media (ahash)
-                img_tiny = img_gray.resize((8, 8), Image.LANCZOS)
-                pixels = np.array(img_tiny)
-                mean = pixels.mean()
-                ahash = "".join(["1" if p > mean else "0" for p in pixels.flatten()])
-
-                # Hash de gradiente (ghash)
-                gradient = np.gradient(pixels)[0]
-                ghash = "".join(["1" if g > 0 else "0" for g in gradient.flatten()])
+            digest = content_digest(image_path)
+            hashes = self.hash_cache.get(digest, self.hash_key)
+            if hashes is None:
+                hashes = compute_image_hashes(image_path, self.hash_size, self.fast_decode)
+                self.hash_cache.put(digest, self.hash_key, hashes)
+            return hashes
+        except Exception as e:
+            logger.error(f"Error calculando hash para {self._describe(image_path)}: {e}")
+            return None
 
-                return {
-                    "phash": phash,
-                    "ahash": ahash,
-                    "ghash": ghash
-                }
+    def calculate_robust_keys(self, image):
+        """
+        Claves resistentes a recortes (ver compute_robust_keys), también en la
+        caché por contenido.
+        """
+        key = "keys:v1:fast" if self.fast_decode else "keys:v1"
+        try:
+            digest = content_digest(image)
+            keys = self.hash_cache.get(digest, key)
+            if keys is None:
+                keys = compute_robust_keys(image, self.fast_decode)
+                self.hash_cache.put(digest, key, keys)
+            return keys
         except Exception as e:
-            logger.error(f"Error calculando hash para {image_path}: {e}")
+            logger.error(f"Error calculando claves para {self._describe(image)}: {e}")
             return None
 
+    def find_exact_duplicate(self, image, image_name):
+        """
+        Busca por SHA-256 una imagen ya registrada con exactamente el mismo
+        contenido, antes de decodificar nada. Devuelve (digest, nombre de la
+        imagen coincidente o None).
+        """
+        digest = content_digest(image)
+        if self.db_manager is None:
+            return digest, None
+        match = self.db_manager.find_image_by_digest(digest)
+        if match == image_name:
+            match = None
+        return digest, match
+
+    def record_digest(self, digest, image_name):
+        """Registra el SHA-256 de una imagen nueva para las próximas ejecuciones."""
+        if self.db_manager is not None:
+            self.db_manager.add_image_digest(digest, image_name)
+
+    def hash_images(self, image_paths, max_workers=None):
+        """
+        Calcula los hashes de varias imágenes repartiendo la decodificación
+        entre procesos. Genera (image_path, hashes) en el orden de entrada:
+        todas las imágenes se envían al pool desde el principio y cada una se
+        entrega en cuanto ella y las anteriores han terminado. hashes es None
+        si la imagen no se pudo leer.
+        """
+        max_workers = max_workers or self.hash_workers
+        image_paths = list(image_paths)
+        digests = {}
+        cached = {}
+        for image_path in image_paths:
+            try:
+                digest = content_digest(image_path)
+            except OSError as e:
+                logger.error(f"Error leyendo {image_path}: {e}")
+                continue
+            hashes = self.hash_cache.get(digest, self.hash_key)
+            if hashes is not None:
+                cached[image_path] = hashes
+            else:
+                digests[image_path] = digest
+
+        if len(digests) < 2 or max_workers == 1:
+            for image_path in image_paths:
+                if image_path in cached:
+                    yield image_path, cached[image_path]
+                elif image_path in digests:
+                    yield image_path, self.calculate_image_hash(image_path)
+                else:
+                    yield image_path, None
+            return
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                image_path: executor.submit(
+                    compute_image_hashes, str(image_path), self.hash_size, self.fast_decode
+                )
+                for image_path in digests
+            }
+            for image_path in image_paths:
+                if image_path in cached:
+                    yield image_path, cached[image_path]
+                    continue
+                if image_path not in futures:
+                    yield image_path, None
+                    continue
+                try:
+                    hashes = futures[image_path].result()
+                except Exception as e:
+                    logger.error(f"Error calculando hash para {image_path}: {e}")
+                    yield image_path, None
+                    continue
+                self.hash_cache.put(digests[image_path], self.hash_key, hashes)
+                yield image_path, hashes
+
+    def serialize_hashes(self, hashes):
+        """Hashes en hexadecimal, para guardarlos en la base de datos."""
+        return {h_type: hash_to_hex(value) for h_type, value in hashes.items()}
+
+    def deserialize_hashes(self, hashes):
+        """Inverso de serialize_hashes."""
+        return {h_type: hash_from_string(hashes[h_type]) for h_type in self.HASH_WEIGHTS}
+
+    def new_hash_matrix(self):
+        return HashMatrix(self.HASH_WEIGHTS)
+
     def compare_hashes(self, hash1, hash2):
         """
         Compara los hashes usando múltiples métricas y un promedio ponderado.
@@ -109,16 +624,16 @@ class DuplicateDetector:
 
         # Distancias Hamming por cada tipo de hash
         distances = {}
-        for h_type in hash1.keys():
-            dist = sum(h1 != h2 for h1, h2 in zip(hash1[h_type], hash2[h_type]))
-            distances[h_type] = dist
+        for h_type in self.HASH_WEIGHTS:
+            if hash1[h_type].shape != hash2[h_type].shape:
+                return False, float('inf')
+            xor = np.bitwise_xor(hash1[h_type], hash2[h_type])
+            distances[h_type] = int(POPCOUNT_TABLE[xor].sum())
 
         # <-- LOG de distancias Hamming
         logger.debug(f"Distancias Hamming por hash: {distances}")
 
-        # Promedio ponderado (ajusta si lo prefieres)
-        weights = {"phash": 0.5, "ahash": 0.3, "ghash": 0.2}
-        weighted_distance = sum(distances[k] * weights[k] for k in distances)
+        weighted_distance = sum(distances[k] * self.HASH_WEIGHTS[k] for k in distances)
         
         logger.debug(f"Distancia ponderada total = {weighted_distance:.2f}, Umbral = {self.similarity_threshold}")
 
@@ -126,151 +641,246 @@ class DuplicateDetector:
         is_similar = weighted_distance <= self.similarity_threshold
         return is_similar, weighted_distance
 
-    def analyze_image_regions(self, img1_path, img2_path):
-        """
-        Analiza las diferencias entre regiones de las imágenes usando múltiples métricas
-        y retorna la lista de regiones que superan el umbral.
-        """
-        region_differences = []
-        try:
-            with Image.open(img1_path) as img1, Image.open(img2_path) as img2:
-                img1 = img1.convert("RGB")
-                img2 = img2.convert("RGB")
-
-                # Redimensionar img2 si no coincide
-                if img1.size != img2.size:
-                    img2 = img2.resize(img1.size, Image.LANCZOS)
-
-                img1_array = np.array(img1)
-                img2_array = np.array(img2)
-
-                # Dividir en regiones
-                height, width, _ = img1_array.shape
-                h_step = height // self.grid_size
-                w_step = width // self.grid_size
-
-                for i in range(self.grid_size):
-                    for j in range(self.grid_size):
-                        # Coordenadas de la región
-                        top = i * h_step
-                        left = j * w_step
-                        # Última región podría llegar hasta el borde si no divide exacto
-                        bottom = (i + 1) * h_step if i < self.grid_size - 1 else height
-                        right = (j + 1) * w_step if j < self.grid_size - 1 else width
-
-                        region1 = img1_array[top:bottom, left:right]
-                        region2 = img2_array[top:bottom, left:right]
-
-                        # Múltiples métricas
-                        pixel_diff = self._calculate_pixel_difference(region1, region2)
-                        hist_diff = self._calculate_histogram_difference(region1, region2)
-                        edge_diff = self._calculate_edge_difference(region1, region2)
-
-                        # Pesos ajustables; normalización previa en hist_diff
-                        combined_diff = (0.4 * pixel_diff +
-                                         0.3 * hist_diff +
-                                         0.3 * edge_diff)
-
-                        # <-- LOG de depuración de cada región
-                        logger.debug(f"Región ({i},{j}): "
-                                     f"pixel_diff={pixel_diff:.2f}, "
-                                     f"hist_diff={hist_diff:.2f}, "
-                                     f"edge_diff={edge_diff:.2f}, "
-                                     f"combined={combined_diff:.2f}")
-
-                        if combined_diff > self.region_threshold:
-                            region_differences.append((i, j, combined_diff))
-        except Exception as e:
-            logger.error(f"Error analizando regiones entre {img1_path} y {img2_path}: {e}")
-        
-        return region_differences
+    @property
+    def region_side(self):
+        """Lado de la miniatura de regiones: múltiplo de grid_size, con celdas de al menos 2 px."""
+        return self.region_side_for(self.grid_size)
 
-    def _calculate_pixel_difference(self, region1, region2):
-        """
-        Diferencia promedio de píxeles (0 a 255).
-        """
-        return float(np.mean(np.abs(region1 - region2)))
+    def region_side_for(self, grid_size):
+        return max(self.region_size // grid_size, 2) * grid_size
 
-    def _calculate_histogram_difference(self, region1, region2):
+    def get_region_features(self, image, view="full", grid_size=None):
         """
-        Calcula la diferencia entre histogramas de color con normalización.
-        Devolverá un valor en ~[0, 2].
+        Características por región de una imagen (ruta o bytes), calculadas
+        sobre una miniatura de region_side x region_side de la vista indicada
+        (ver image_view), con grid_size celdas por lado (por defecto el de la
+        configuración). Se guardan en un LRU por contenido para no volver a
+        decodificar la imagen en cada comparación.
         """
-        # <-- NORMALIZACIÓN
-        hist1, _ = np.histogram(region1, bins=64, range=(0, 255))
-        hist2, _ = np.histogram(region2, bins=64, range=(0, 255))
-        hist1 = hist1.astype(float)
-        hist2 = hist2.astype(float)
-
-        # Evita que una región grande dispare el hist_diff
-        if hist1.sum() > 0:
-            hist1 /= hist1.sum()
-        if hist2.sum() > 0:
-            hist2 /= hist2.sum()
-
-        return float(np.sum(np.abs(hist1 - hist2)))
+        grid_size = grid_size or self.grid_size
+        side = self.region_side_for(grid_size)
+        key = (content_digest(image), side, grid_size, view)
+        features = self._region_cache.get(key)
+        if features is not None:
+            self._region_cache.move_to_end(key)
+            return features
+
+        features = region_features(
+            region_thumbnail(image, side, self.fast_decode, view), grid_size
+        )
+        self._region_cache[key] = features
+        while len(self._region_cache) > self.region_cache_size:
+            self._region_cache.popitem(last=False)
+        return features
+
+    def region_features_from_signature(self, side, signature, grid_size=None):
+        """Características por región a partir de una miniatura guardada en SQLite."""
+        grid_size = grid_size or self.grid_size
+        target_side = self.region_side_for(grid_size)
+        thumbnail = np.frombuffer(signature, dtype=np.uint8).reshape(side, side, 3)
+        if side != target_side:
+            thumbnail = np.array(
+                Image.fromarray(thumbnail).resize((target_side, target_side), Image.BILINEAR)
+            )
+        return region_features(thumbnail, grid_size)
 
-    def _calculate_edge_difference(self, region1, region2):
+    def analyze_image_regions(self, img1_path, img2_path, view="full", grid_size=None):
         """
-        Calcula la diferencia en los bordes usando gradiente Sobel simplificado.
-        Se hace con la media en escala de grises de la región.
+        Analiza las diferencias entre regiones de las imágenes usando múltiples métricas
+        y retorna la lista de regiones que superan el umbral. Cada imagen puede
+        ser una ruta, sus bytes o sus características ya calculadas (con la
+        misma cuadrícula).
         """
-        gray1 = np.mean(region1, axis=2)
-        gray2 = np.mean(region2, axis=2)
-
-        grad1_x = np.gradient(gray1)[0]
-        grad2_x = np.gradient(gray2)[0]
-        grad1_y = np.gradient(gray1)[1]
-        grad2_y = np.gradient(gray2)[1]
-
-        edge_diff_x = np.mean(np.abs(grad1_x - grad2_x))
-        edge_diff_y = np.mean(np.abs(grad1_y - grad2_y))
-
-        return float((edge_diff_x + edge_diff_y) / 2)
-
-    def check_duplicate(self, img_path, processed_hashes, processed_files):
+        try:
+            features1 = img1_path if isinstance(img1_path, dict) \
+                else self.get_region_features(img1_path, view, grid_size)
+            features2 = img2_path if isinstance(img2_path, dict) \
+                else self.get_region_features(img2_path, view, grid_size)
+            return self._compare_region_features(features1, features2)
+        except Exception as e:
+            logger.error(f"Error analizando regiones entre {self._describe(img1_path)} y {self._describe(img2_path)}: {e}")
+            return []
+
+    def _compare_region_features(self, features1, features2):
+        """Compara todas las celdas de una vez; devuelve [(i, j, diferencia)] sobre el umbral."""
+        # Diferencia promedio de píxeles (0 a 255)
+        pixel_diff = np.abs(
+            features1["blocks"].astype(np.int16) - features2["blocks"]
+        ).mean(axis=(2, 3, 4))
+
+        # Diferencia entre histogramas normalizados, en ~[0, 2]
+        hist_diff = np.abs(features1["hist"] - features2["hist"]).sum(axis=2)
+
+        # Diferencia de gradientes en escala de grises
+        edge_diff = (
+            np.abs(features1["grad_x"] - features2["grad_x"]).mean(axis=(2, 3)) +
+            np.abs(features1["grad_y"] - features2["grad_y"]).mean(axis=(2, 3))
+        ) / 2
+
+        # Pesos ajustables; normalización previa en hist_diff
+        combined = 0.4 * pixel_diff + 0.3 * hist_diff + 0.3 * edge_diff
+
+        if logger.isEnabledFor(logging.DEBUG):
+            for i, j in np.ndindex(combined.shape):
+                logger.debug(f"Región ({i},{j}): "
+                             f"pixel_diff={pixel_diff[i, j]:.2f}, "
+                             f"hist_diff={hist_diff[i, j]:.2f}, "
+                             f"edge_diff={edge_diff[i, j]:.2f}, "
+                             f"combined={combined[i, j]:.2f}")
+
+        return [
+            (int(i), int(j), float(combined[i, j]))
+            for i, j in zip(*np.nonzero(combined > self.region_threshold))
+        ]
+
+    def _describe(self, image):
+        if isinstance(image, (bytes, bytearray)):
+            return f"<{len(image)} bytes>"
+        return str(image)
+
+    def check_duplicate(self, img_path, processed_hashes, processed_files,
+                        current_hashes=None, image_data=None, hash_index=None):
         """
         Verifica si una imagen es duplicada usando múltiples criterios:
          1) Distancia de hash <= similarity_threshold
          2) Si pasa el hash, se analiza por regiones; si las regiones distintas <= min_differences => duplicado
+
+        Si ya se tienen los hashes o los bytes de la imagen, se pasan en
+        current_hashes / image_data para no volver a leerla y decodificarla.
+        Con hash_index (HashIndex) se consultan además las imágenes indexadas:
+        si su archivo ya no está en la carpeta de img_path, las regiones se
+        comparan con la firma guardada en la base de datos. Con robust_keys
+        se buscan también copias recortadas o con bandas (_check_robust_keys).
         """
         logger.info(f"Verificando duplicados para: {img_path}")
-        
+        image_source = image_data if image_data is not None else img_path
+
         # Hash de la imagen actual
-        current_hashes = self.calculate_image_hash(img_path)
+        if current_hashes is None:
+            current_hashes = self.calculate_image_hash(image_source)
         if not current_hashes:
             return False, None
 
-        # 1) Comparar con archivos procesados en esta sesión
+        # 1) Archivos procesados en esta sesión y 2) hashes almacenados
+        # previamente cuya imagen sigue en disco; todos a la misma matriz
+        candidates = self.new_hash_matrix()
         for processed_file in processed_files:
             if str(processed_file) != str(img_path):
-                stored_hashes = processed_hashes.get(str(processed_file))
+                # processed_hashes puede venir indexado por ruta o por nombre;
+                # si no está, el hash sale de la caché por contenido
+                stored_hashes = processed_hashes.get(str(processed_file)) \
+                    or processed_hashes.get(Path(processed_file).name)
                 if not stored_hashes:
                     stored_hashes = self.calculate_image_hash(processed_file)
-                
-                similar, distance = self.compare_hashes(current_hashes, stored_hashes)
-                if similar:
-                    logger.debug(f"Hash similar (dist={distance:.2f}) con {processed_file.name}, comprobando regiones...")
-                    differences = self.analyze_image_regions(img_path, processed_file)
-                    logger.debug(f"{len(differences)} regiones superan el threshold (region_threshold={self.region_threshold})")
-                    if len(differences) <= self.min_differences:
-                        logger.info(f"Imagen {img_path.name} es duplicado de {processed_file.name}")
-                        return True, processed_file
-
-        # 2) Comparar con hashes almacenados previamente (si guardas hashes de ejecuciones anteriores)
+                candidates.add(str(processed_file), stored_hashes)
+
         for processed_path, stored_hashes in processed_hashes.items():
-            if Path(processed_path).exists():
-                similar, distance = self.compare_hashes(current_hashes, stored_hashes)
-                if similar:
-                    logger.debug(f"Hash similar (dist={distance:.2f}) con {processed_path}, comprobando regiones...")
-                    differences = self.analyze_image_regions(img_path, processed_path)
-                    logger.debug(f"{len(differences)} regiones superan el threshold (region_threshold={self.region_threshold})")
-                    if len(differences) <= self.min_differences:
-                        logger.info(f"Imagen {img_path.name} es duplicado (almacenado) de {Path(processed_path).name}")
-                        return True, Path(processed_path)
+            if processed_path not in candidates and processed_path != str(img_path) \
+                    and Path(processed_path).exists():
+                candidates.add(processed_path, stored_hashes)
+
+        # Distancias contra todos los candidatos de una vez
+        matches = candidates.within(current_hashes, self.similarity_threshold)
+
+        # 3) Vecinos en el índice persistente, estén o no en disco; el índice
+        # ya devuelve solo los que están dentro del umbral
+        indexed = set()
+        if hash_index is not None:
+            for image_name, distance in hash_index.query(current_hashes, self.similarity_threshold):
+                processed_path = str(Path(img_path).parent / image_name)
+                if processed_path not in candidates and processed_path != str(img_path):
+                    matches.append((processed_path, distance))
+                    indexed.add(processed_path)
+            matches.sort(key=lambda match: match[1])
+
+        # Las regiones solo se analizan para los similares, empezando por el
+        # más cercano
+        for processed_path, distance in matches:
+            region_source = processed_path = Path(processed_path)
+            if str(processed_path) in indexed and not processed_path.exists():
+                region_source = hash_index.region_features(processed_path.name)
+                if region_source is None:
+                    continue
+            logger.debug(f"Hash similar (dist={distance:.2f}) con {processed_path.name}, comprobando regiones...")
+            differences = self.analyze_image_regions(image_source, region_source)
+            logger.debug(f"{len(differences)} regiones superan el threshold (region_threshold={self.region_threshold})")
+            if len(differences) <= self.min_differences:
+                logger.info(f"Imagen {img_path.name} es duplicado de {processed_path.name}")
+                return True, processed_path
+
+        if self.robust_keys and hash_index is not None:
+            return self._check_robust_keys(img_path, image_source, hash_index)
+        return False, None
+
+    def _check_robust_keys(self, img_path, image_source, hash_index):
+        """
+        Busca en el índice imágenes con al menos robust_key_min_matches
+        claves robustas cercanas y confirma cada coincidencia comparando por
+        regiones la vista de la imagen de la que sale esa clave (sin bordes,
+        centro o completa). Una sola clave no basta: carteles distintos hechos
+        con la misma plantilla suelen coincidir en alguna, y por eso también
+        las regiones se comparan con robust_key_grid_size celdas por lado y
+        admitiendo solo robust_key_min_differences regiones distintas.
+        """
+        keys = self.calculate_robust_keys(image_source)
+        if not keys:
+            return False, None
+
+        for image_name, distances in hash_index.key_matches(keys):
+            if len(distances) < self.robust_key_min_matches:
+                continue
+            processed_path = Path(img_path).parent / image_name
+            if processed_path == Path(img_path):
+                continue
+            for key_type in sorted(distances, key=distances.get):
+                view = ROBUST_KEY_VIEWS[key_type]
+                region_source = processed_path
+                if not processed_path.exists():
+                    region_source = hash_index.region_features(
+                        image_name, view, self.robust_key_grid_size
+                    )
+                    if region_source is None:
+                        continue
+                logger.debug(
+                    f"Clave {key_type} similar (dist={distances[key_type]}) con {image_name}, "
+                    f"comprobando regiones ({view})..."
+                )
+                differences = self.analyze_image_regions(
+                    image_source, region_source, view, self.robust_key_grid_size
+                )
+                if len(differences) <= self.robust_key_min_differences:
+                    logger.info(
+                        f"Imagen {img_path.name} es duplicado recortado de {image_name} ({key_type})"
+                    )
+                    return True, processed_path
 
         return False, None
 
+    def filter_duplicates(self, image_paths, buffers=None):
+        """
+        Devuelve las imágenes de la lista que no son duplicadas de otra
+        anterior de la misma lista (por ejemplo, las fotos de un álbum).
+        buffers puede contener los bytes ya cargados de cada imagen por nombre.
+        """
+        buffers = buffers or {}
+        unique_files = []
+        unique_hashes = {}
+        for img_path in image_paths:
+            image_data = buffers.get(Path(img_path).name)
+            current_hashes = self.calculate_image_hash(
+                image_data if image_data is not None else img_path
+            )
+            is_duplicate, _ = self.check_duplicate(
+                img_path, unique_hashes, unique_files,
+                current_hashes=current_hashes, image_data=image_data
+            )
+            if is_duplicate:
+                continue
+            if current_hashes:
+                unique_hashes[str(img_path)] = current_hashes
+            unique_files.append(img_path)
+        return unique_files
+
 
 class GooglePlacesService:
     def __init__(self, api_key):
@@ -567,6 +1177,50 @@ def clean_directories(directories):
                     logging.error(f"Failed to delete file {item}: {e}")
 
 
+# Patrones del texto de un post de Telegram (en castellano) para decidir si
+# ya trae fecha, hora y lugar sin necesidad de leer el cartel
+SPANISH_MONTHS = (
+    "enero|febrero|marzo|abril|mayo|junio|julio|agosto|"
+    "septiembre|setiembre|octubre|noviembre|diciembre"
+)
+CAPTION_DATE_PATTERNS = [
+    re.compile(r"\b\d{1,2}\s*(?:de\s+)?(?:" + SPANISH_MONTHS + r")\b", re.IGNORECASE),
+    re.compile(r"\b(?:" + SPANISH_MONTHS + r")\s+\d{1,2}\b", re.IGNORECASE),
+    # dd/mm, o dd-mm-aaaa / dd.mm.aaaa con año: sin año, "20.00" o "18-20"
+    # son horas
+    re.compile(r"(?<![\d:.])(?:0?[1-9]|[12]\d|3[01])/(?:0?[1-9]|1[0-2])(?:/\d{2,4})?\b"),
+    re.compile(r"(?<![\d:.])(?:0?[1-9]|[12]\d|3[01])([.-])(?:0?[1-9]|1[0-2])\1\d{2,4}\b"),
+]
+CAPTION_TIME_PATTERNS = [
+    re.compile(r"\b(?:[01]?\d|2[0-3])[:.h][0-5]\d\b", re.IGNORECASE),
+    re.compile(r"\b(?:[01]?\d|2[0-3])\s*(?:h|hs|hrs|horas)\b", re.IGNORECASE),
+    re.compile(r"\ba\s+las?\s+\d{1,2}\b", re.IGNORECASE),
+]
+CAPTION_PLACE_PATTERNS = [
+    re.compile(
+        r"(?:\bc/|\b(?:calle|avda|avenida|plaza|pza|paseo|ronda|glorieta|camino|"
+        r"travesía|parque|centro social|ateneo|biblioteca|lugar)\b)",
+        re.IGNORECASE
+    ),
+    re.compile(r"\b(?:en|frente a)\s+(?:el|la|los|las)\s+[A-ZÁÉÍÓÚÑ]"),
+    re.compile(r"\b28\d{3}\b"),
+    re.compile("\U0001F4CD"),  # 📍
+]
+
+
+def caption_is_complete(text, min_length=40):
+    """
+    Comprobación local y barata de si el texto del post ya trae fecha, hora
+    y lugar del evento, de modo que baste para la extracción sin OCR.
+    """
+    if not text or len(text.strip()) < min_length:
+        return False
+    return all(
+        any(pattern.search(text) for pattern in patterns)
+        for patterns in (CAPTION_DATE_PATTERNS, CAPTION_TIME_PATTERNS, CAPTION_PLACE_PATTERNS)
+    )
+
+
 def get_next_occurrence(
     rrule_str: str, original_date: datetime, current_date: datetime
 ) -> datetime:
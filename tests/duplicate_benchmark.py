@@ -0,0 +1,268 @@
+"""
+Benchmark de precisión y velocidad de DuplicateDetector.
+
+Genera un corpus sintético etiquetado de carteles (copias exactas,
+recompresiones, recortes, bandas y carteles casi iguales pero distintos),
+lo pasa por el mismo flujo que PosterPipeline.is_duplicate y mide
+precisión/recall, imágenes por segundo y pico de memoria para cada
+combinación de parámetros.
+
+El pico de memoria es el RSS máximo del proceso (ru_maxrss), que incluye
+las reservas en C de Pillow y numpy. Como ru_maxrss nunca baja, cada
+combinación se ejecuta en un proceso hijo propio.
+
+Uso:
+    python tests/duplicate_benchmark.py --posters 20 \\
+        --hash-size 16 64 --similarity-threshold 4 25 --grid-size 2 4
+"""
+import argparse
+import io
+import itertools
+import random
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from hash_index import HashIndex  # noqa: E402
+from sqlite_tracker import DatabaseManager  # noqa: E402
+from utils import DuplicateDetector  # noqa: E402
+
+# Variantes de cada cartel y si deben detectarse como duplicado del original
+VARIANTS = {
+    "exact": True,
+    "recompressed": True,
+    "rescaled": True,
+    "cropped": True,
+    "letterboxed": True,
+    "near_different": False,
+}
+
+SWEEP_PARAMETERS = ["hash_size", "similarity_threshold", "region_threshold", "grid_size", "min_differences"]
+
+
+def _random_color(rng):
+    return tuple(int(c) for c in rng.integers(0, 255, 3))
+
+
+def make_template(seed, size=(960, 1280)):
+    """Fondo y bloques de color de un cartel."""
+    rng = np.random.default_rng(seed)
+    img = Image.new("RGB", size, _random_color(rng))
+    draw = ImageDraw.Draw(img)
+    for _ in range(25):
+        x, y = rng.integers(0, size[0] - 50), rng.integers(0, size[1] - 50)
+        draw.rectangle([x, y, x + rng.integers(40, 400), y + rng.integers(40, 300)], fill=_random_color(rng))
+    return img
+
+
+def add_event_text(img, seed):
+    """Bloque con el texto del evento (fecha, lugar), distinto para cada seed."""
+    img = img.copy()
+    rng = np.random.default_rng(seed)
+    draw = ImageDraw.Draw(img)
+    left, top = int(img.width * 0.1), int(img.height * 0.45)
+    draw.rectangle([left, top, img.width - left, top + img.height // 4], fill=_random_color(rng))
+    for line in range(5):
+        draw.text(
+            (left + 20, top + 20 + line * 50),
+            f"EVENTO {seed} - {rng.integers(1, 31)}/{rng.integers(1, 13)} {rng.integers(10, 23)}:00",
+            fill=(0, 0, 0)
+        )
+    return img.filter(ImageFilter.GaussianBlur(1))
+
+
+def encode(img, quality=90):
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def make_variant(img, original_bytes, variant, seed):
+    """Bytes de una variante del cartel img."""
+    width, height = img.size
+    if variant == "exact":
+        return original_bytes
+    if variant == "recompressed":
+        return encode(img, quality=60)
+    if variant == "rescaled":
+        return encode(img.resize((int(width * 0.7), int(height * 0.7)), Image.BILINEAR), quality=80)
+    if variant == "cropped":
+        dx, dy = int(width * 0.05), int(height * 0.05)
+        return encode(img.crop((dx, dy, width - dx, height - dy)))
+    if variant == "letterboxed":
+        framed = Image.new("RGB", (int(width * 1.3), height), (0, 0, 0))
+        framed.paste(img, ((framed.width - width) // 2, 0))
+        return encode(framed)
+    if variant == "near_different":
+        # Misma plantilla, otro evento
+        return encode(add_event_text(make_template(seed), seed + 10_000))
+    raise ValueError(f"Unknown variant: {variant}")
+
+
+def generate_corpus(folder, num_posters=10, seed=0):
+    """
+    Escribe el corpus en folder y devuelve [(path, grupo, variante)] en el
+    orden en que se procesan. Dos imágenes son duplicadas si comparten
+    grupo; cada original aparece antes que sus variantes.
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    originals, variants = [], []
+    for poster in range(num_posters):
+        poster_seed = seed * 1000 + poster
+        img = add_event_text(make_template(poster_seed), poster_seed)
+        original_bytes = encode(img)
+        path = folder / f"{poster:04d}_original.jpg"
+        path.write_bytes(original_bytes)
+        originals.append((path, f"poster{poster}", "original"))
+
+        for variant, is_duplicate in VARIANTS.items():
+            path = folder / f"{poster:04d}_{variant}.jpg"
+            path.write_bytes(make_variant(img, original_bytes, variant, poster_seed))
+            group = f"poster{poster}" if is_duplicate else f"poster{poster}_{variant}"
+            variants.append((path, group, variant))
+
+    random.Random(seed).shuffle(variants)
+    return originals + variants
+
+
+def run_detector(config, corpus):
+    """
+    Procesa el corpus como PosterPipeline.is_duplicate (digest exacto,
+    hashes, índice y regiones) con una base de datos en memoria. Devuelve
+    {path: nombre de la imagen de la que es duplicado o None}.
+    """
+    db_manager = DatabaseManager(":memory:")
+    try:
+        detector = DuplicateDetector(config, db_manager)
+        hash_index = HashIndex(db_manager, detector)
+        predictions = {}
+        for path, _, _ in corpus:
+            digest, exact_match = detector.find_exact_duplicate(path, path.name)
+            if exact_match:
+                predictions[path] = exact_match
+                continue
+            hashes = detector.calculate_image_hash(path)
+            is_duplicate, matching_file = detector.check_duplicate(
+                path, {}, [], current_hashes=hashes, hash_index=hash_index
+            )
+            if is_duplicate:
+                predictions[path] = Path(matching_file).name
+                continue
+            hash_index.register(path.name, path, hashes, digest)
+            predictions[path] = None
+        return predictions
+    finally:
+        db_manager.close()
+
+
+def score(corpus, predictions):
+    """Precisión, recall y recall por variante de las predicciones."""
+    group_of = {path.name: group for path, group, _ in corpus}
+    seen_groups = set()
+    true_positives = false_positives = expected = 0
+    variant_hits = {}
+    for path, group, variant in corpus:
+        is_duplicate = group in seen_groups
+        seen_groups.add(group)
+        match = predictions[path]
+        if is_duplicate:
+            expected += 1
+        if match is not None:
+            if is_duplicate and group_of.get(match) == group:
+                true_positives += 1
+            else:
+                false_positives += 1
+        if variant != "original":
+            hits, total = variant_hits.get(variant, (0, 0))
+            correct = (match is not None) == VARIANTS[variant]
+            variant_hits[variant] = (hits + int(correct), total + 1)
+
+    predicted = true_positives + false_positives
+    return {
+        "precision": true_positives / predicted if predicted else 1.0,
+        "recall": true_positives / expected if expected else 1.0,
+        "variants": {variant: hits / total for variant, (hits, total) in variant_hits.items()},
+    }
+
+
+def peak_rss_mb():
+    """RSS máximo del proceso en MB (ru_maxrss va en KB en Linux y en bytes en macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def _timed_run(config, corpus):
+    start = time.perf_counter()
+    predictions = run_detector(config, corpus)
+    return predictions, time.perf_counter() - start, peak_rss_mb()
+
+
+def run_benchmark(parameters, corpus, base_config=None):
+    """Ejecuta el detector con cada combinación de parameters ({nombre: [valores]})."""
+    results = []
+    names = list(parameters)
+    for values in itertools.product(*(parameters[name] for name in names)):
+        settings = dict(base_config or {}, **dict(zip(names, values)))
+        config = {"duplicate_detection": settings}
+
+        # Un proceso por combinación para que el pico de RSS sea solo el suyo
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            predictions, elapsed, peak_memory = executor.submit(_timed_run, config, corpus).result()
+
+        results.append({
+            **dict(zip(names, values)),
+            **score(corpus, predictions),
+            "images_per_second": len(corpus) / elapsed,
+            "peak_memory_mb": peak_memory,
+        })
+    return results
+
+
+def print_results(results, parameter_names):
+    header = parameter_names + ["precision", "recall", "img/s", "peak MB"] + list(VARIANTS)
+    print(" | ".join(header))
+    for result in results:
+        row = [str(result[name]) for name in parameter_names]
+        row += [
+            f"{result['precision']:.2f}",
+            f"{result['recall']:.2f}",
+            f"{result['images_per_second']:.1f}",
+            f"{result['peak_memory_mb']:.1f}",
+        ]
+        row += [f"{result['variants'].get(variant, 0):.2f}" for variant in VARIANTS]
+        print(" | ".join(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--posters", type=int, default=10, help="Carteles base del corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--hash-size", type=int, nargs="+", default=[16])
+    parser.add_argument("--similarity-threshold", type=float, nargs="+", default=[4])
+    parser.add_argument("--region-threshold", type=float, nargs="+", default=[10])
+    parser.add_argument("--grid-size", type=int, nargs="+", default=[2])
+    parser.add_argument("--min-differences", type=int, nargs="+", default=[1])
+    parser.add_argument("--robust-keys", action="store_true", help="Activar las claves robustas a recortes")
+    parser.add_argument("--no-fast-decode", action="store_true")
+    args = parser.parse_args()
+
+    parameters = {name: getattr(args, name) for name in SWEEP_PARAMETERS}
+    base_config = {"robust_keys": args.robust_keys, "fast_decode": not args.no_fast_decode}
+
+    with tempfile.TemporaryDirectory() as folder:
+        corpus = generate_corpus(folder, args.posters, args.seed)
+        print(f"Corpus: {len(corpus)} imágenes ({args.posters} carteles x {len(VARIANTS) + 1} variantes)")
+        print_results(run_benchmark(parameters, corpus, base_config), SWEEP_PARAMETERS)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import pytz
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from calendar_generator import EntityExtractor  # noqa: E402
+from pipeline import PosterPipeline  # noqa: E402
+from utils import caption_is_complete  # noqa: E402
+
+CONFIG = {"external_api": {"use": True, "service": "groq", "model_name": "model", "api_key": "key"}}
+# Domingo 12 de octubre a mediodía, hora de Madrid
+REFERENCE = datetime(2025, 10, 12, 12, 0, tzinfo=pytz.timezone("Europe/Madrid")).timestamp()
+
+
+def test_caption_is_complete_needs_a_real_date():
+    place = "en la Plaza de Oporto, os esperamos"
+    # Horas con punto o guion no son fechas
+    assert not caption_is_complete(f"Asamblea abierta 18:00 - 20.00 {place}")
+    assert not caption_is_complete(f"Asamblea abierta de 18.30 a 20.30 {place}")
+    assert not caption_is_complete(f"Asamblea abierta de 18-20h {place}")
+
+    assert caption_is_complete(f"Asamblea abierta el 14 de octubre a las 18:00 {place}")
+    assert caption_is_complete(f"Asamblea abierta el 14/10 a las 18:00 {place}")
+    assert caption_is_complete(f"Asamblea abierta el 14.10.2025 a las 18.30 {place}")
+
+
+def make_pipeline(tmp_path):
+    """PosterPipeline con lo justo para finish_from_caption."""
+    pipeline = PosterPipeline.__new__(PosterPipeline)
+    pipeline.extractor = EntityExtractor(CONFIG)
+    pipeline.text_output_folder = tmp_path
+    pipeline.ics_output_folder = tmp_path
+    pipeline.caption_only_posters = 0
+    pipeline.export_events = lambda img_file, events, metadata, ics_file: len(events)
+    pipeline.mark_processed = lambda img_file, album_files: None
+    return pipeline
+
+
+def test_caption_fallback_needs_day_and_month_from_the_model(tmp_path):
+    pipeline = make_pipeline(tmp_path)
+    metadata = {"text": "Asamblea abierta 18:00 - 20.00", "telegram_timestamp": REFERENCE}
+    poster = {"img_file": tmp_path / "1_1.jpg", "metadata": metadata, "album_files": []}
+
+    # Solo hora: tras resolverla tiene DTSTART (el día de referencia), pero
+    # hay que leer el cartel para saber la fecha
+    time_only = pipeline.extractor.resolve_events(
+        [{"SUMMARY": "Asamblea", "DTSTART": "18:00", "DTEND": "20:00"}], metadata
+    )
+    assert time_only[0]["DTSTART"]
+    assert pipeline.finish_from_caption(poster, time_only) is None
+    assert pipeline.caption_only_posters == 0
+
+    dated = pipeline.extractor.resolve_events(
+        [{"SUMMARY": "Asamblea", "DTSTART": "10-14T18:00:00"}], metadata
+    )
+    assert pipeline.finish_from_caption(poster, dated) == 1
+    assert pipeline.caption_only_posters == 1
@@ -0,0 +1,51 @@
+import sys
+from pathlib import Path
+
+from duplicate_benchmark import SWEEP_PARAMETERS, VARIANTS, generate_corpus, run_benchmark
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from utils import DuplicateDetector  # noqa: E402
+
+
+def test_benchmark_sweep(tmp_path):
+    corpus = generate_corpus(tmp_path, num_posters=2)
+    assert len(corpus) == 2 * (len(VARIANTS) + 1)
+
+    parameters = {name: [value] for name, value in zip(SWEEP_PARAMETERS, [16, 4, 10, 2, 1])}
+    parameters["similarity_threshold"] = [4, 8]
+    results = run_benchmark(parameters, corpus)
+
+    assert len(results) == 2
+    for result in results:
+        assert 0 <= result["precision"] <= 1
+        assert 0 <= result["recall"] <= 1
+        assert result["images_per_second"] > 0
+        assert result["peak_memory_mb"] > 0
+        # Copias idénticas y recompresiones siempre se detectan
+        assert result["variants"]["exact"] == 1
+        assert result["variants"]["recompressed"] == 1
+
+
+def test_robust_keys_keep_near_different_posters_apart(tmp_path):
+    # Misma plantilla, otro evento: las claves robustas coinciden, así que
+    # las regiones tienen que poder separarlos, también con la cuadrícula
+    # 2x2 de settings.yaml.example
+    corpus = generate_corpus(tmp_path, num_posters=6)
+    shipped = {name: [value] for name, value in zip(SWEEP_PARAMETERS, [64, 25, 10, 2, 1])}
+    [with_keys, without_keys] = [
+        run_benchmark(shipped, corpus, {"robust_keys": robust_keys})[0]
+        for robust_keys in (True, False)
+    ]
+
+    assert with_keys["variants"]["near_different"] == 1
+    assert with_keys["variants"]["letterboxed"] == 1
+    assert with_keys["precision"] == 1
+    assert with_keys["recall"] > without_keys["recall"]
+
+
+def test_min_differences_is_clamped_to_the_grid(caplog):
+    # Configuración del antiguo settings.yaml.example: 4 regiones de 4
+    detector = DuplicateDetector({"duplicate_detection": {"grid_size": 2, "min_differences": 4}})
+    assert detector.min_differences == 3
+    assert "min_differences" in caplog.text
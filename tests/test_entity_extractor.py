@@ -0,0 +1,172 @@
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import httpx
+from groq import RateLimitError
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import calendar_generator  # noqa: E402
+from calendar_generator import EntityExtractor  # noqa: E402
+from sqlite_tracker import DatabaseManager  # noqa: E402
+from utils import TokenBucket  # noqa: E402
+
+CONFIG = {"external_api": {"use": True, "service": "groq", "model_name": "model", "api_key": "key"}}
+
+
+class ScriptedClient:
+    """Sustituto del cliente Groq que devuelve respuestas fijas en orden."""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.requests = []
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, **request):
+        self.requests.append(request)
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        message = SimpleNamespace(content=json.dumps(reply))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def make_extractor(replies, db_manager=None):
+    extractor = EntityExtractor(CONFIG, db_manager)
+    extractor.client = ScriptedClient(replies)
+    return extractor
+
+
+def test_valid_events_skip_the_repair_call():
+    extractor = make_extractor([])
+    events = [{"SUMMARY": "Concierto", "DTSTART": "10-12T19:00:00", "RRULE": "", "EXTRA": 1}]
+
+    assert extractor.validate_and_fix_json(events) == [{"SUMMARY": "Concierto", "DTSTART": "10-12T19:00:00"}]
+    assert extractor.client.requests == []
+
+
+def test_only_invalid_events_are_sent_for_repair():
+    extractor = make_extractor([{"events": [{"SUMMARY": "Charla", "DTSTART": "10-13"}]}])
+    events = [
+        {"SUMMARY": "Concierto", "DTSTART": "19:00", "ALL_DAY": "false"},
+        {"SUMMARY": "Charla", "DTSTART": "el lunes"},
+        {"SUMMARY": "Taller", "RRULE": "cada semana"},
+    ]
+
+    validated = extractor.validate_and_fix_json(events)
+
+    assert validated == [
+        {"SUMMARY": "Concierto", "DTSTART": "19:00", "ALL_DAY": False},
+        {"SUMMARY": "Charla", "DTSTART": "10-13"},
+    ]
+    (request,) = extractor.client.requests
+    assert request["response_format"] == {"type": "json_object"}
+    prompt = request["messages"][0]["content"]
+    assert "el lunes" in prompt and "cada semana" in prompt and "Concierto" not in prompt
+
+
+def test_cached_response_is_reused_but_dates_are_resolved_again(monkeypatch):
+    monkeypatch.setattr(calendar_generator, "get_geolocation", lambda config, address: None)
+    db_manager = DatabaseManager(":memory:")
+    reply = {"events": [{"SUMMARY": "Concierto", "DTSTART": "19:00"}]}
+    extractor = make_extractor([reply, reply], db_manager)
+
+    first = extractor.extract_event_info("Concierto  hoy\n a las 19:00", {"telegram_timestamp": 1760000000})
+    second = extractor.extract_event_info("Concierto hoy a las 19:00", {"telegram_timestamp": 1760086400})
+
+    assert len(extractor.client.requests) == 1
+    assert extractor.cache_stats()["hits"] == 1
+    assert (second[0]["DTSTART"] - first[0]["DTSTART"]).days == 1
+    db_manager.close()
+
+
+def test_extract_many_batches_posters_and_retries_malformed_items(monkeypatch):
+    monkeypatch.setattr(calendar_generator, "get_geolocation", lambda config, address: None)
+    batch_reply = {"posters": [
+        {"id": "0", "events": [{"SUMMARY": "Concierto", "DTSTART": "10-12"}]},
+        {"id": "1", "events": "sin eventos"},
+    ]}
+    retry_reply = {"events": [{"SUMMARY": "Taller", "DTSTART": "10-14"}]}
+    extractor = make_extractor([batch_reply, retry_reply, retry_reply])
+    extractor.batch_extraction = True
+
+    texts = ["Concierto el 12 de octubre", "Charla el 13 de octubre", "Taller el 14 de octubre"]
+    results = extractor.extract_many([(text, None) for text in texts])
+
+    assert [[event["SUMMARY"] for event in events] for events in results] == [
+        ["Concierto"], ["Taller"], ["Taller"]
+    ]
+    batch_prompt = extractor.client.requests[0]["messages"][0]["content"]
+    assert all(f"### Cartel {item_id}\n{text}" in batch_prompt for item_id, text in enumerate(texts))
+    # Un cartel mal formado y otro que falta en la respuesta se piden por separado
+    assert len(extractor.client.requests) == 3
+
+
+def test_pack_batches_respects_token_budget():
+    extractor = make_extractor([])
+    extractor.batch_token_budget = 100
+    # 196 caracteres: 50 tokens estimados, dos por lote
+    entries = [(index, "x" * 196) for index in range(5)]
+
+    assert [len(batch) for batch in extractor.pack_batches(entries)] == [2, 2, 1]
+
+
+def rate_limit_error(retry_after):
+    request = httpx.Request("POST", "https://api.groq.com/openai/v1/chat/completions")
+    response = httpx.Response(429, headers={"retry-after": retry_after}, request=request)
+    return RateLimitError("Rate limit reached", response=response, body=None)
+
+
+def test_rate_limited_request_waits_retry_after_and_retries(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(calendar_generator.time, "sleep", sleeps.append)
+    extractor = make_extractor([rate_limit_error("7"), {"events": [{"SUMMARY": "Concierto", "DTSTART": "10-12"}]}])
+
+    assert extractor.request_events("Concierto el 12 de octubre") == [{"SUMMARY": "Concierto", "DTSTART": "10-12"}]
+    assert sleeps == [7.0]
+    assert len(extractor.client.requests) == 2
+
+
+class SlowClient(ScriptedClient):
+    """Responde siempre lo mismo tras una latencia fija y cuenta las peticiones simultáneas."""
+
+    def __init__(self, reply, latency=0.05):
+        super().__init__([])
+        self.reply = reply
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def create(self, **request):
+        with self._lock:
+            self.requests.append(request)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self._lock:
+            self.in_flight -= 1
+        message = SimpleNamespace(content=json.dumps(self.reply))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def test_extract_many_runs_requests_concurrently_within_the_rate_limit(monkeypatch):
+    monkeypatch.setattr(calendar_generator, "get_geolocation", lambda config, address: None)
+    extractor = EntityExtractor(CONFIG)
+    extractor.client = SlowClient({"events": [{"SUMMARY": "Concierto", "DTSTART": "10-12"}]})
+    # Cubo casi vacío: 600 peticiones por minuto son 10 por segundo
+    extractor.request_bucket = TokenBucket(600)
+    extractor.request_bucket.tokens = 4
+
+    start = time.perf_counter()
+    results = extractor.extract_many([(f"Cartel {i}", None) for i in range(6)])
+    elapsed = time.perf_counter() - start
+
+    assert [len(events) for events in results] == [1] * 6
+    assert extractor.client.max_in_flight == 4
+    # Las dos últimas esperan a que el cubo se rellene (0,1 s por petición)
+    assert 0.15 <= elapsed < 6 * extractor.client.latency + 0.2
@@ -0,0 +1,52 @@
+import io
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from utils import POPCOUNT_TABLE, compute_image_hashes  # noqa: E402
+
+# Fracción máxima de bits que puede cambiar cada hash entre la decodificación
+# rápida (draft / reduce) y la completa
+MAX_BIT_DISAGREEMENT = 0.05
+
+
+def make_poster(seed, image_format="JPEG", size=(960, 1280)):
+    """Cartel sintético del tamaño típico de una foto de Telegram."""
+    rng = np.random.default_rng(seed)
+    img = Image.new("RGB", size, tuple(int(c) for c in rng.integers(0, 255, 3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(30):
+        x, y = rng.integers(0, size[0] - 50), rng.integers(0, size[1] - 50)
+        draw.rectangle(
+            [x, y, x + rng.integers(20, 300), y + rng.integers(20, 200)],
+            fill=tuple(int(c) for c in rng.integers(0, 255, 3))
+        )
+    for _ in range(20):
+        position = (int(rng.integers(0, size[0] - 100)), int(rng.integers(0, size[1] - 20)))
+        draw.text(position, "CONCIERTO 21:00", fill=(0, 0, 0))
+    img = img.filter(ImageFilter.GaussianBlur(1))
+
+    buffer = io.BytesIO()
+    img.save(buffer, image_format, quality=85)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("hash_size", [16, 64])
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG"])
+def test_fast_decode_matches_full_decode(hash_size, image_format):
+    for seed in range(8):
+        image = make_poster(seed, image_format)
+        full = compute_image_hashes(image, hash_size)
+        fast = compute_image_hashes(image, hash_size, fast_decode=True)
+
+        for h_type, full_hash in full.items():
+            assert fast[h_type].shape == full_hash.shape
+            differing_bits = int(POPCOUNT_TABLE[full_hash ^ fast[h_type]].sum())
+            assert differing_bits <= MAX_BIT_DISAGREEMENT * full_hash.size * 8, (
+                f"{h_type} (seed {seed}): {differing_bits} bits distintos"
+            )
@@ -0,0 +1,57 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from sqlite_tracker import DatabaseManager  # noqa: E402
+from utils import DuplicateDetector, HashCache, hash_from_string, hash_to_hex  # noqa: E402
+
+
+def test_hex_hash_made_of_zeros_and_ones_keeps_its_shape():
+    # El phash de un cartel liso: 64 ceros en hexadecimal, no 64 bits
+    flat = np.zeros(32, dtype=np.uint8)
+    ones = np.full(32, 0x11, dtype=np.uint8)
+    for packed in (flat, ones):
+        restored = hash_from_string(hash_to_hex(packed))
+        assert restored.shape == packed.shape
+        assert np.array_equal(restored, packed)
+
+
+def test_hash_cache_round_trip_through_sqlite():
+    db_manager = DatabaseManager(":memory:")
+    hashes = {"phash": np.zeros(32, dtype=np.uint8), "ahash": np.arange(32, dtype=np.uint8)}
+    HashCache(db_manager).put("digest", "key", hashes)
+
+    # Una caché nueva solo puede leerlos de la base de datos
+    restored = HashCache(db_manager).get("digest", "key")
+    for h_type, packed in hashes.items():
+        assert restored[h_type].shape == packed.shape
+        assert np.array_equal(restored[h_type], packed)
+    db_manager.close()
+
+
+def test_hash_images_yields_in_input_order(tmp_path):
+    rng = np.random.default_rng(3)
+    paths = []
+    for i in range(6):
+        path = tmp_path / f"{i}.png"
+        Image.fromarray(rng.integers(0, 255, (64, 48, 3), dtype=np.uint8)).save(path)
+        paths.append(path)
+    missing = tmp_path / "missing.png"
+    paths.insert(3, missing)
+
+    detector = DuplicateDetector({})
+    # Una ya está en la caché: no por eso debe adelantarse
+    cached = detector.calculate_image_hash(paths[4])
+
+    results = list(detector.hash_images(paths, max_workers=2))
+    assert [path for path, _ in results] == paths
+    assert results[3][1] is None
+    assert np.array_equal(results[4][1]["phash"], cached["phash"])
+    for path, hashes in results:
+        if path != missing:
+            expected = DuplicateDetector({}).calculate_image_hash(path)
+            assert np.array_equal(hashes["phash"], expected["phash"])
@@ -0,0 +1,89 @@
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from hash_index import HashIndex  # noqa: E402
+from sqlite_tracker import DatabaseManager  # noqa: E402
+from utils import POPCOUNT_TABLE, ROBUST_KEY_BYTES, DuplicateDetector, hash_from_string  # noqa: E402
+
+
+def flip_bits(packed, count, rng):
+    """Copia de packed con count bits distintos elegidos al azar."""
+    bits = np.unpackbits(packed)
+    positions = rng.choice(bits.size, size=count, replace=False)
+    bits[positions] ^= 1
+    return np.packbits(bits)
+
+
+def populate(detector, db_manager, query_hashes, query_keys, rng, count=300):
+    """Guarda hashes y claves a distancias repartidas alrededor de los umbrales."""
+    for i in range(count):
+        hashes = {
+            h_type: flip_bits(packed, int(rng.integers(0, 20)), rng)
+            for h_type, packed in query_hashes.items()
+        }
+        keys = {
+            key_type: flip_bits(key, int(rng.integers(0, 20)), rng)
+            for key_type, key in query_keys.items()
+        }
+        serialized = detector.serialize_hashes(hashes)
+        hash_info = {
+            "processed_date": datetime.now().isoformat(),
+            "hash_size": detector.hash_size,
+            **serialized,
+            "keys": detector.serialize_hashes(keys),
+        }
+        db_manager.add_image_hash_with_info(f"img_{i}", serialized["phash"], hash_info)
+
+
+def random_hashes(detector, rng):
+    phash_bytes = detector.hash_size * detector.hash_size // 8
+    return {
+        h_type: rng.integers(0, 256, phash_bytes, dtype=np.uint8)
+        for h_type in detector.HASH_WEIGHTS
+    }
+
+
+@pytest.mark.parametrize("key_threshold", [5, 12])
+def test_index_matches_brute_force(key_threshold):
+    rng = np.random.default_rng(7)
+    db_manager = DatabaseManager(":memory:")
+    detector = DuplicateDetector(
+        {"duplicate_detection": {"robust_keys": True, "robust_key_threshold": key_threshold}},
+        db_manager,
+    )
+    query_hashes = random_hashes(detector, rng)
+    query_keys = {
+        key_type: rng.integers(0, 256, ROBUST_KEY_BYTES, dtype=np.uint8)
+        for key_type in ("trim", "center", "dct")
+    }
+    populate(detector, db_manager, query_hashes, query_keys, rng)
+
+    # El índice se construye con backfill sobre lo ya guardado
+    index = HashIndex(db_manager, detector)
+    assert index.keys_exhaustive == (key_threshold + 1 > ROBUST_KEY_BYTES)
+
+    brute = detector.new_hash_matrix()
+    for image_name, hash_info in db_manager.get_image_hash_infos():
+        brute.add(image_name, detector.deserialize_hashes(hash_info))
+    expected = brute.within(query_hashes, detector.similarity_threshold)
+    assert expected
+
+    candidate_names = {image_name for image_name, _ in index.candidates(query_hashes)}
+    assert {image_name for image_name, _ in expected} <= candidate_names
+    assert sorted(index.query(query_hashes)) == sorted(expected)
+
+    expected_keys = {}
+    for image_name, hash_info in db_manager.get_image_hash_infos():
+        for key_type, stored in hash_info["keys"].items():
+            distance = int(POPCOUNT_TABLE[hash_from_string(stored) ^ query_keys[key_type]].sum())
+            if distance <= key_threshold:
+                expected_keys.setdefault(image_name, {})[key_type] = distance
+    assert expected_keys
+    assert dict(index.key_matches(query_keys)) == expected_keys
+    db_manager.close()
@@ -1,9 +1,11 @@
 import os
+import sys
 import logging
 from pathlib import Path
 
-# from src.utils import DuplicateDetector, load_config
-from src.utils import DuplicateDetector, load_config
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from utils import DuplicateDetector, load_config  # noqa: E402
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
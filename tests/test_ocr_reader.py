@@ -0,0 +1,171 @@
+import io
+import sys
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from calendar_generator import OCRReader  # noqa: E402
+import ocr_backends  # noqa: E402
+from ocr_backends import OCR_BACKENDS, OCRBackend, OCRPreprocessor  # noqa: E402
+
+GOOGLE_CONFIG = {
+    "project_id": "project",
+    "location": "eu",
+    "processor_id": "processor",
+    "max_concurrent_requests": 4,
+}
+
+
+class LocalProcessor:
+    """Sustituto local de DocumentProcessorServiceClient con latencia fija."""
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def processor_path(self, project_id, location, processor_id):
+        return f"projects/{project_id}/locations/{location}/processors/{processor_id}"
+
+    def process_document(self, request):
+        with self._lock:
+            self.requests.append(request.name)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self._lock:
+            self.in_flight -= 1
+        text = request.raw_document.content.decode()
+        return SimpleNamespace(document=SimpleNamespace(text=f"texto {text}"))
+
+
+def test_read_many_keeps_order_and_limits_concurrency():
+    processor = LocalProcessor()
+    reader = OCRReader("documentai", GOOGLE_CONFIG, client=processor)
+    images = [(Path(f"{i}.jpg"), f"cartel {i}".encode()) for i in range(8)]
+
+    start = time.perf_counter()
+    texts = reader.read_many(images)
+    elapsed = time.perf_counter() - start
+
+    assert texts == [f"texto cartel {i}" for i in range(8)]
+    assert processor.max_in_flight == 4
+    # 8 peticiones de 50 ms con 4 a la vez: dos rondas, no ocho
+    assert elapsed < 8 * processor.latency
+    assert set(processor.requests) == {"projects/project/locations/eu/processors/processor"}
+
+
+def test_read_reuses_client_and_skips_unsupported_files():
+    processor = LocalProcessor(latency=0)
+    reader = OCRReader("documentai", GOOGLE_CONFIG, client=processor)
+
+    assert reader.read(Path("a.jpg"), content=b"a") == "texto a"
+    assert reader.read(Path("b.png"), content=b"b") == "texto b"
+    assert reader.read(Path("c.txt"), content=b"c") is None
+    assert reader.get_client() is processor
+    assert len(processor.requests) == 2
+
+
+class ScoredLocalBackend(OCRBackend):
+    """Motor local falso: la confianza va en el nombre del archivo (0.9.jpg)."""
+    cache_key = "scored"
+
+    def __init__(self, ocr_config=None, google_config=None, client=None):
+        pass
+
+    def read_one(self, image_path, content):
+        return f"local {content.decode()}", float(image_path.stem)
+
+
+def test_hybrid_sends_only_low_confidence_images_to_document_ai(monkeypatch):
+    monkeypatch.setitem(OCR_BACKENDS, "scored", ScoredLocalBackend)
+    processor = LocalProcessor(latency=0)
+    reader = OCRReader(
+        "hybrid", GOOGLE_CONFIG, client=processor,
+        ocr_config={"local_backend": "scored", "min_confidence": 0.75}
+    )
+    images = [(Path(f"{confidence}.jpg"), name.encode())
+              for confidence, name in [(0.9, "a"), (0.3, "b"), (0.8, "c")]]
+
+    assert reader.read_many(images) == ["local a", "texto b", "local c"]
+    assert len(processor.requests) == 1
+    assert reader.get_client() is processor
+
+
+class FailingProcessor(LocalProcessor):
+    def process_document(self, request):
+        raise RuntimeError("Document AI no disponible")
+
+
+def test_hybrid_keeps_local_text_when_document_ai_fails(monkeypatch):
+    monkeypatch.setitem(OCR_BACKENDS, "scored", ScoredLocalBackend)
+    reader = OCRReader(
+        "hybrid", GOOGLE_CONFIG, client=FailingProcessor(latency=0),
+        ocr_config={"local_backend": "scored", "min_confidence": 0.75}
+    )
+
+    assert reader.read_many([(Path("0.5.jpg"), b"a")]) == ["local a"]
+
+
+class BatchedReader:
+    """Sustituto de easyocr.Reader: anota el tamaño de cada lote de readtext_batched."""
+
+    def __init__(self):
+        self.batches = []
+
+    def readtext_batched(self, images, n_width=None, n_height=None, detail=1, batch_size=1):
+        self.batches.append([image.shape for image in images])
+        return [[([], f"{image.shape[1]}x{image.shape[0]}", 0.5)] for image in images]
+
+
+def encode_png(size):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (255, 255, 255)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_easyocr_reads_same_sized_images_in_one_batch(monkeypatch):
+    fake = BatchedReader()
+    monkeypatch.setitem(ocr_backends._MODELS, "easyocr:es", fake)
+    reader = OCRReader("easyocr")
+    images = [
+        (Path("a.png"), encode_png((40, 60))),
+        (Path("b.png"), encode_png((50, 50))),
+        (Path("c.png"), b"no es una imagen"),
+        (Path("d.png"), encode_png((40, 60))),
+    ]
+
+    assert reader.read_many(images) == ["40x60", "50x50", None, "40x60"]
+    assert sorted(len(batch) for batch in fake.batches) == [1, 2]
+    # Sin Document AI no hay cliente
+    assert reader.get_client() is None
+
+
+def test_preprocess_shrinks_large_images_and_keeps_the_rest():
+    img = Image.new("RGB", (3000, 4000), (0, 0, 0))
+    ImageDraw.Draw(img).rectangle([500, 500, 2500, 3500], fill=(240, 230, 200))
+    buffer = io.BytesIO()
+    img.save(buffer, "PNG")
+    large = buffer.getvalue()
+
+    preprocessor = OCRPreprocessor({"enabled": True, "max_long_edge": 1000})
+    path, content = preprocessor.process(Path("cartel.png"), large)
+
+    assert path == Path("cartel.jpg")
+    with Image.open(io.BytesIO(content)) as processed:
+        assert processed.mode == "L"
+        # Sin la banda negra y con el lado mayor a 1000 píxeles
+        assert processed.size == (667, 1000)
+    # Lo que no es una imagen que se pueda reescribir se envía tal cual
+    assert preprocessor.process(Path("cartel.pdf"), b"%PDF-1.4") == (Path("cartel.pdf"), b"%PDF-1.4")
+
+    stats = preprocessor.stats()
+    assert stats["bytes_in"] == len(large) + 8
+    assert stats["bytes_out"] == len(content) + 8
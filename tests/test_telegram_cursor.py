@@ -0,0 +1,193 @@
+import asyncio
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+from telethon import TelegramClient
+from telethon.tl import types
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from sqlite_tracker import DatabaseManager  # noqa: E402
+from telegram_bot import TelegramBot  # noqa: E402
+
+CHANNEL = {"id": 1001, "name": "canal"}
+DATE = datetime.now(timezone.utc)
+
+
+def make_message(message_id, failing, date=DATE):
+    async def download_media(file=None, thumb=None):
+        if message_id in failing:
+            raise ValueError("media no disponible")
+        return b"jpeg"
+
+    return SimpleNamespace(
+        id=message_id, photo=SimpleNamespace(id=10_000 + message_id, sizes=[]),
+        date=date, grouped_id=None, fwd_from=None, chat_id=CHANNEL["id"],
+        text="", download_media=download_media,
+    )
+
+
+class FakeClient:
+    """Canal con los mensajes 1..count; los de failing no se pueden descargar."""
+
+    def __init__(self, count, failing=()):
+        self.messages = [make_message(message_id, set(failing)) for message_id in range(1, count + 1)]
+
+    async def get_entity(self, channel_id):
+        return channel_id
+
+    async def iter_messages(self, entity, reverse=True, min_id=0, offset_date=None):
+        for message in self.messages:
+            if message.id > min_id:
+                yield message
+
+    def add_event_handler(self, callback, event):
+        self.handlers = getattr(self, "handlers", [])
+        self.handlers.append(callback)
+
+
+def make_bot(tmp_path, db_manager, client, session="session", **kwargs):
+    bot = TelegramBot(
+        1, "hash", "phone", str(tmp_path / session), db_manager, [CHANNEL],
+        start_date=None, **kwargs
+    )
+    bot.client = client
+    bot._is_started = True
+    return bot
+
+
+def test_cursor_stops_before_failed_message_and_moves_on_after_max_attempts(tmp_path):
+    db_manager = DatabaseManager(":memory:")
+
+    async def scenario():
+        bot = make_bot(tmp_path, db_manager, FakeClient(5, failing={3}), max_download_attempts=2)
+        assert await bot.download_images(tmp_path / "images") == 4
+        assert db_manager.get_channel_cursor(CHANNEL["id"]) == 2
+
+        # Segundo intento fallido: se da por perdido y el cursor lo pasa
+        assert await bot.download_images(tmp_path / "images") == 0
+        assert db_manager.get_channel_cursor(CHANNEL["id"]) == 5
+
+    asyncio.run(scenario())
+    db_manager.close()
+
+
+def test_daily_limit_skips_extra_posts_and_resets_the_next_day(tmp_path):
+    db_manager = DatabaseManager(":memory:")
+    client = FakeClient(5)
+
+    async def scenario():
+        bot = make_bot(tmp_path, db_manager, client, max_posters_per_day=2, max_downloads_per_channel=1)
+        assert await bot.download_images(tmp_path / "images") == 2
+        # Los que pasan del límite se saltan y no frenan el cursor
+        assert db_manager.get_channel_cursor(CHANNEL["id"]) == 5
+        assert str(CHANNEL["id"]) not in bot._stalled_channels
+
+        # Al día siguiente el mismo bot (como en el daemon) vuelve a tener hueco
+        tomorrow = DATE + timedelta(days=1)
+        client.messages += [make_message(message_id, set(), tomorrow) for message_id in (6, 7, 8)]
+        assert await bot.download_images(tmp_path / "images") == 2
+        assert db_manager.get_channel_cursor(CHANNEL["id"]) == 8
+        assert bot._daily_counts[tomorrow.strftime("%Y-%m-%d")] == 2
+
+        # Y los días que ya no se recorren se olvidan
+        bot._daily_counts["2000-01-01"] = 2
+        assert await bot.download_images(tmp_path / "images") == 0
+        assert "2000-01-01" not in bot._daily_counts
+
+    asyncio.run(scenario())
+    db_manager.close()
+
+
+def test_listener_does_not_move_cursor_past_message_still_downloading(tmp_path):
+    db_manager = DatabaseManager(":memory:")
+    client = FakeClient(2, failing={1})
+    gate = asyncio.Event()
+    slow_download = client.messages[0].download_media
+
+    async def gated_download(file=None, thumb=None):
+        await gate.wait()
+        return await slow_download(file=file, thumb=thumb)
+
+    client.messages[0].download_media = gated_download
+
+    async def on_image(file_path, buffers):
+        pass
+
+    async def scenario():
+        bot = make_bot(tmp_path, db_manager, client)
+        bot.listen(tmp_path / "images", on_image)
+        on_new_message = client.handlers[0]
+        first = asyncio.create_task(
+            on_new_message(SimpleNamespace(chat_id=CHANNEL["id"], message=client.messages[0]))
+        )
+        await asyncio.sleep(0)
+
+        # El mensaje 2 termina antes que el 1, que sigue descargándose
+        await on_new_message(SimpleNamespace(chat_id=CHANNEL["id"], message=client.messages[1]))
+        assert not db_manager.get_channel_cursor(CHANNEL["id"])
+
+        # El 1 falla: el cursor no debe haberlo saltado
+        gate.set()
+        await first
+        assert not db_manager.get_channel_cursor(CHANNEL["id"])
+
+        # Un resync lo reintenta y ya puede avanzar hasta el final
+        client.messages[0].download_media = make_message(1, set()).download_media
+        assert await bot.download_images(tmp_path / "images") == 1
+        assert db_manager.get_channel_cursor(CHANNEL["id"]) == 2
+
+    asyncio.run(scenario())
+    db_manager.close()
+
+
+def test_selected_photo_size_is_requested_by_type(tmp_path):
+    sizes = [
+        types.PhotoStrippedSize(type="i", bytes=b"\x01\x02"),
+        types.PhotoSize(type="m", w=320, h=240, size=12_000),
+        types.PhotoSize(type="x", w=800, h=600, size=60_000),
+        types.PhotoSizeProgressive(type="y", w=1280, h=960, sizes=[20_000, 60_000, 110_000]),
+    ]
+    requested = []
+
+    async def download_media(file=None, thumb=None):
+        requested.append(thumb)
+        # Lo que haría Telethon con ese thumb
+        if TelegramClient._get_thumb(sizes, thumb) is None:
+            return None
+        return b"jpeg"
+
+    message = make_message(1, set())
+    message.photo = SimpleNamespace(id=10_001, sizes=sizes)
+    message.download_media = download_media
+
+    async def scenario():
+        bot = make_bot(tmp_path, DatabaseManager(":memory:"), FakeClient(0), ocr_min_long_edge=1000)
+        bot._ensure_download_semaphore()
+        assert bot._select_photo_size(message.photo).type == "y"
+        assert await bot._download_photo(message, tmp_path / "1.jpg") == tmp_path / "1.jpg"
+
+    asyncio.run(scenario())
+    assert requested == ["y"]
+
+
+def test_reshare_of_media_in_progress_is_retried_if_that_download_fails(tmp_path):
+    db_manager = DatabaseManager(":memory:")
+    client = FakeClient(2, failing={1})
+    # El mensaje 2 vuelve a publicar la foto del 1
+    client.messages[1].photo = client.messages[0].photo
+
+    async def scenario():
+        bot = make_bot(tmp_path, db_manager, client, max_download_attempts=1)
+        assert await bot.download_images(tmp_path / "images") == 0
+        # El 1 se da por perdido; el 2 no se marca como visto
+        assert db_manager.get_channel_cursor(CHANNEL["id"]) == 1
+        assert not db_manager.is_image_downloaded("2")
+
+        assert await bot.download_images(tmp_path / "images") == 1
+        assert db_manager.get_channel_cursor(CHANNEL["id"]) == 2
+
+    asyncio.run(scenario())
+    db_manager.close()